@@ -21,8 +21,9 @@ logger = get_logger(__name__)
 class LammpsCalcDb(CalcDb):
 
     def __init__(self, host="localhost", port=27017, database="lammps", collection="tasks",
-                 user=None, password=None):
-        super(LammpsCalcDb, self).__init__(host, port, database, collection, user, password)
+                 user=None, password=None, id_block_size=1):
+        super(LammpsCalcDb, self).__init__(host, port, database, collection, user, password,
+                                           id_block_size=id_block_size)
 
     def build_indexes(self, indexes=None, background=True):
         indexes = indexes or []
@@ -35,4 +36,5 @@ class LammpsCalcDb(CalcDb):
         self.collection.delete_many({})
         self.db.counter.delete_one({"_id": "taskid"})
         self.db.counter.insert_one({"_id": "taskid", "c": 0})
+        self.task_id_allocator.reset()
         self.build_indexes()
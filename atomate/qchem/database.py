@@ -25,9 +25,10 @@ class QChemCalcDb(CalcDb):
                  database="qchem",
                  collection="tasks",
                  user=None,
-                 password=None):
+                 password=None,
+                 id_block_size=1):
         super(QChemCalcDb, self).__init__(host, port, database, collection,
-                                          user, password)
+                                          user, password, id_block_size=id_block_size)
 
     def build_indexes(self, indexes=None, background=True):
         """
@@ -55,4 +56,5 @@ class QChemCalcDb(CalcDb):
         self.collection.delete_many({})
         self.db.counter.delete_one({"_id": "taskid"})
         self.db.counter.insert_one({"_id": "taskid", "c": 0})
+        self.task_id_allocator.reset()
         self.build_indexes()
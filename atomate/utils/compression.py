@@ -0,0 +1,117 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+"""
+This module defines a registry of the compression codecs used for GridFS payloads.
+
+A codec is named by its family and an optional level, e.g. "zlib", "zlib-9", "bz2", "lzma-6".
+zlib and bz2 are always available, lzma when the lzma module (python 3) or backports.lzma is
+importable, and the faster zstd and lz4 codecs when the zstandard and lz4 packages are installed.
+The family (without the level) is all that is needed to decompress.
+"""
+
+import bz2
+import zlib
+
+_codecs = {}
+
+
+def register_codec(family, compress, decompress):
+    """
+    Register a compression codec.
+
+    Args:
+        family (str): name of the codec family, e.g. "zlib"
+        compress (callable): compress(data, level) -> bytes. level is None for the default level
+        decompress (callable): decompress(data) -> bytes
+    """
+    _codecs[family] = (compress, decompress)
+
+
+def available_codecs():
+    """
+    Returns:
+        ([str]) the registered codec families
+    """
+    return sorted(_codecs.keys())
+
+
+def parse_codec(codec):
+    """
+    Split a codec name into the family and the level.
+
+    Args:
+        codec (str): e.g. "zlib-9" or "zlib"
+
+    Returns:
+        (str, int): the family and the level (None for the default level)
+    """
+    family, _, level = codec.partition("-")
+    if family not in _codecs:
+        raise ValueError("Unknown compression codec {}, the available codecs are {}".format(
+            codec, available_codecs()))
+    return family, int(level) if level else None
+
+
+def compress(data, codec):
+    """
+    Compress data.
+
+    Args:
+        data (bytes): data to compress
+        codec (str): codec name, e.g. "zlib-9". None means no compression
+
+    Returns:
+        (bytes) the compressed data
+    """
+    if not codec:
+        return data
+    family, level = parse_codec(codec)
+    return _codecs[family][0](data, level)
+
+
+def decompress(data, codec):
+    """
+    Decompress data.
+
+    Args:
+        data (bytes): compressed data
+        codec (str): codec name or family, e.g. "zlib". None means no compression
+
+    Returns:
+        (bytes) the decompressed data
+    """
+    if not codec:
+        return data
+    family, _ = parse_codec(codec)
+    return _codecs[family][1](data)
+
+
+# zlib defaults to the fast level 1, as GridFS payloads always used, denser levels are opt-in
+register_codec("zlib", lambda d, l: zlib.compress(d, 1 if l is None else l), zlib.decompress)
+register_codec("bz2", lambda d, l: bz2.compress(d, 9 if l is None else l), bz2.decompress)
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+if lzma is not None:
+    register_codec("lzma", lambda d, l: lzma.compress(d, preset=l), lzma.decompress)
+
+try:
+    import zstandard
+    register_codec("zstd", lambda d, l: zstandard.ZstdCompressor(level=3 if l is None else l)
+                   .compress(d), lambda d: zstandard.ZstdDecompressor().decompress(d))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    register_codec("lz4", lambda d, l: lz4.frame.compress(d, compression_level=l or 0),
+                   lz4.frame.decompress)
+except ImportError:
+    pass
@@ -7,14 +7,18 @@ This module defines a base class for derived database classes that store calcula
 """
 
 import datetime
+import os
+import threading
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 import six
-from pymongo import MongoClient, ReturnDocument
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
 
 from monty.json import jsanitize
 from monty.serialization import loadfn
 
-from atomate.utils.utils import get_logger
+from atomate.utils.utils import get_logger, get_mongo_client
 
 __author__ = 'Kiran Mathew'
 __credits__ = 'Anubhav Jain'
@@ -22,33 +26,236 @@ __email__ = 'kmathew@lbl.gov'
 
 logger = get_logger(__name__)
 
+_id_allocators = {}
+_id_allocators_lock = threading.Lock()
+_initialized_dbs = set()
+
+
+class IdAllocator(object):
+    """
+    Hi/lo allocator for the integer ids kept in a counter collection, e.g. the "taskid" and
+    "materialid" counters. A single $inc by block_size reserves a block of ids, which are then
+    handed out locally, so the counter document is only written once per block. The ids are
+    unique across all allocators of the same counter; ids left in a block when the process exits
+    are skipped. A process forked from the one that reserved a block does not inherit it, so that
+    parent and child never hand out the same ids.
+    """
+
+    def __init__(self, counter, counter_id, block_size=1):
+        """
+        Args:
+            counter (pymongo.collection): the counter collection
+            counter_id (str): the _id of the counter document, e.g. "taskid"
+            block_size (int): number of ids reserved at a time
+        """
+        self.counter = counter
+        self.counter_id = counter_id
+        self.block_size = max(1, int(block_size))
+        self._next = 1
+        self._last = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def allocate(self, n):
+        """
+        Get n new ids. They are taken from the current block first; the rest (at least
+        block_size) is reserved with a single counter update.
+
+        Args:
+            n (int): number of ids
+
+        Returns:
+            ([int]) the ids
+        """
+        if self._pid != os.getpid():
+            # forked: the block belongs to the parent (the lock may have been held at fork time)
+            self._lock = threading.Lock()
+            self._next, self._last = 1, 0
+            self._pid = os.getpid()
+        with self._lock:
+            ids = list(range(self._next, min(self._next + n, self._last + 1)))
+            self._next += len(ids)
+            missing = n - len(ids)
+            if missing > 0:
+                size = max(missing, self.block_size)
+                c = self.counter.find_one_and_update(
+                    {"_id": self.counter_id}, {"$inc": {"c": size}}, upsert=True,
+                    return_document=ReturnDocument.AFTER)["c"]
+                ids.extend(range(c - size + 1, c - size + 1 + missing))
+                self._next, self._last = c - size + 1 + missing, c
+        return ids
+
+    def next_id(self):
+        """
+        Returns:
+            (int) a new id
+        """
+        return self.allocate(1)[0]
+
+    def reset(self):
+        """
+        Drop the ids left in the current block, e.g. after the counter is reset.
+        """
+        with self._lock:
+            self._next, self._last = 1, 0
+
+
+class ObjectCache(object):
+    """
+    Thread-safe least-recently-used cache of decoded objects, bounded by the total (estimated)
+    size of the cached objects in bytes, with hit and miss counters.
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size (int): maximum total size of the cached objects in bytes
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Args:
+            key: the cache key
+
+        Returns:
+            (bool, object): whether the key was found, and the cached object (None if not found)
+        """
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return True, entry[0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, obj, size):
+        """
+        Cache an object, evicting the least recently used objects if the cache is full. Objects
+        larger than the cache are not cached.
+
+        Args:
+            key: the cache key
+            obj: the object
+            size (int): the size of the object in bytes
+        """
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (obj, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def info(self):
+        """
+        Returns:
+            (dict) hits, misses, number of entries, size and max_size
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "size": self.size, "max_size": self.max_size}
+
+
+def _get_plan_stages(plan):
+    """
+    Returns:
+        ([str]) the stages of an explained query plan, from the root to the leaves
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for v in plan.values():
+            stages.extend(_get_plan_stages(v))
+    elif isinstance(plan, list):
+        for v in plan:
+            stages.extend(_get_plan_stages(v))
+    return stages
+
+
+def get_id_allocator(counter, counter_id, block_size=1):
+    """
+    Get the process-wide IdAllocator of a counter, so that all the CalcDb and builder instances
+    of a process share the same block of ids. The allocator reserves the largest block size
+    requested for the counter in the process.
+
+    Args:
+        counter (pymongo.collection): the counter collection
+        counter_id (str): the _id of the counter document, e.g. "taskid"
+        block_size (int): number of ids reserved at a time
+
+    Returns:
+        IdAllocator
+    """
+    key = (id(counter.database.client), counter.full_name, counter_id)
+    with _id_allocators_lock:
+        if key not in _id_allocators:
+            _id_allocators[key] = IdAllocator(counter, counter_id, block_size)
+        allocator = _id_allocators[key]
+        allocator.block_size = max(allocator.block_size, int(block_size))
+    return allocator
+
+
+def reset_process_state():
+    """
+    Forget which databases were initialized in this process and drop the local blocks of ids,
+    e.g. after the databases were dropped.
+    """
+    _initialized_dbs.clear()
+    with _id_allocators_lock:
+        for allocator in _id_allocators.values():
+            allocator.reset()
+
 
 class CalcDb(six.with_metaclass(ABCMeta)):
 
-    def __init__(self, host, port, database, collection, user, password):
+    # the queries issued by the firetasks and builders, checked by audit_indexes: (name,
+    # collection, filter) tuples, the collection name formatted with the tasks collection name
+    canonical_queries = []
+
+    # optional constructor arguments that can be set in the db file, see from_db_file
+    db_file_kwargs = ["id_block_size"]
+
+    def __init__(self, host, port, database, collection, user, password, id_block_size=1):
         self.host = host
         self.db_name = database
         self.user = user
         self.password = password
         self.port = int(port)
         try:
-            self.connection = MongoClient(self.host, self.port)
-            self.db = self.connection[self.db_name]
+            self.connection = get_mongo_client(self.host, self.port, self.db_name, self.user,
+                                               self.password)
+        except OperationFailure:
+            logger.error("Mongodb authentication failed")
+            raise ValueError
         except:
             logger.error("Mongodb connection failed")
             raise Exception
-        try:
-            if self.user:
-                self.db.authenticate(self.user, self.password)
-        except:
-            logger.error("Mongodb authentication failed")
-            raise ValueError
+        self.db = self.connection[self.db_name]
         self.collection = self.db[collection]
+        self.task_id_allocator = get_id_allocator(self.db.counter, "taskid", id_block_size)
 
-        # set counter collection
-        if self.db.counter.find({"_id": "taskid"}).count() == 0:
-            self.db.counter.insert_one({"_id": "taskid", "c": 0})
-            self.build_indexes()
+        # set counter collection, once per process
+        init_key = (self.__class__.__name__, self.host, self.port, self.db_name, collection)
+        if init_key not in _initialized_dbs:
+            if self.db.counter.find({"_id": "taskid"}).count() == 0:
+                self.db.counter.insert_one({"_id": "taskid", "c": 0})
+                self.build_indexes()
+            _initialized_dbs.add(init_key)
 
     @abstractmethod
     def build_indexes(self, indexes=None, background=True):
@@ -61,6 +268,33 @@ class CalcDb(six.with_metaclass(ABCMeta)):
          """
         pass
 
+    def audit_indexes(self, queries=None):
+        """
+        Explain the canonical queries of the database (see canonical_queries) and report the
+        ones that scan the whole collection instead of using an index.
+
+        Args:
+            queries (list): (name, collection, filter) tuples. The collection name is formatted
+                with the name of the tasks collection, e.g. "{tasks}_summary".
+                Default: canonical_queries
+
+        Returns:
+            ([dict]) one report per query, with the name, collection, filter, the stages of the
+                winning plan and whether the plan is a collection scan ("collscan")
+        """
+        reports = []
+        for name, collection, criteria in queries or self.canonical_queries:
+            coll = self.db[collection.format(tasks=self.collection.name)]
+            explain = coll.find(criteria).explain()
+            stages = _get_plan_stages(explain["queryPlanner"]["winningPlan"])
+            report = {"name": name, "collection": coll.name, "filter": criteria,
+                      "stages": stages, "collscan": "COLLSCAN" in stages}
+            if report["collscan"]:
+                logger.warning("Collection scan of {} for query {}: {}".format(
+                    coll.name, name, criteria))
+            reports.append(report)
+        return reports
+
     def insert(self, d, update_duplicates=True):
         """
         Insert the task document ot the database collection.
@@ -69,25 +303,100 @@ class CalcDb(six.with_metaclass(ABCMeta)):
             d (dict): task document
             update_duplicates (bool): whether to update the duplicates
         """
-        result = self.collection.find_one({"dir_name": d["dir_name"]}, ["dir_name", "task_id"])
-        if result is None or update_duplicates:
-            d["last_updated"] = datetime.datetime.utcnow()
-            if result is None:
+        return self.insert_many([d], update_duplicates=update_duplicates)[0]
+
+    def insert_many(self, docs, update_duplicates=True, ordered=True):
+        """
+        Insert task documents into the database collection, with one query for the duplicates,
+        one counter update for the new task_ids and one bulk write.
+
+        Args:
+            docs ([dict]): task documents
+            update_duplicates (bool): whether to update the duplicates
+            ordered (bool): whether the bulk write is ordered. Unordered writes are faster, but
+                docs must then have distinct dir_names.
+
+        Returns:
+            ([int]) the task_ids of the inserted documents, None for skipped duplicates
+        """
+        task_ids = self.assign_task_ids(docs, update_duplicates=update_duplicates)
+        self.bulk_upsert([d for d, t_id in zip(docs, task_ids) if t_id is not None],
+                         ordered=ordered)
+        return task_ids
+
+    def assign_task_ids(self, docs, update_duplicates=True):
+        """
+        Set the task_id and last_updated keys of task documents before they are inserted.
+        Documents whose dir_name is already in the collection (or earlier in docs) get the
+        existing task_id, new documents without a task_id get new ones from the counter.
+
+        Args:
+            docs ([dict]): task documents
+            update_duplicates (bool): whether to update the duplicates
+
+        Returns:
+            ([int]) the task_ids, None for duplicates that are skipped
+        """
+        dir_names = list(set(d["dir_name"] for d in docs))
+        existing = {r["dir_name"]: r["task_id"] for r in
+                    self.collection.find({"dir_name": {"$in": dir_names}},
+                                         ["dir_name", "task_id"])}
+        seen = set(existing)
+        n_new = 0
+        for d in docs:
+            if d["dir_name"] not in seen:
+                seen.add(d["dir_name"])
+                if not d.get("task_id"):
+                    n_new += 1
+        new_ids = iter(self.reserve_task_ids(n_new))
+
+        task_ids = []
+        now = datetime.datetime.utcnow()
+        for d in docs:
+            t_id = existing.get(d["dir_name"])
+            if t_id is not None and not update_duplicates:
+                logger.info("Skipping duplicate {}".format(d["dir_name"]))
+                task_ids.append(None)
+                continue
+            d["last_updated"] = now
+            if t_id is None:
                 if ("task_id" not in d) or (not d["task_id"]):
-                    d["task_id"] = self.db.counter.find_one_and_update(
-                        {"_id": "taskid"}, {"$inc": {"c": 1}},
-                        return_document=ReturnDocument.AFTER)["c"]
+                    d["task_id"] = next(new_ids)
+                existing[d["dir_name"]] = d["task_id"]
                 logger.info("Inserting {} with taskid = {}".format(d["dir_name"], d["task_id"]))
-            elif update_duplicates:
-                d["task_id"] = result["task_id"]
+            else:
+                d["task_id"] = t_id
                 logger.info("Updating {} with taskid = {}".format(d["dir_name"], d["task_id"]))
-            d = jsanitize(d, allow_bson=True)
-            self.collection.update_one({"dir_name": d["dir_name"]},
-                                       {"$set": d}, upsert=True)
-            return d["task_id"]
-        else:
-            logger.info("Skipping duplicate {}".format(d["dir_name"]))
-            return None
+            task_ids.append(d["task_id"])
+        return task_ids
+
+    def reserve_task_ids(self, n):
+        """
+        Reserve n new task_ids (see IdAllocator).
+
+        Args:
+            n (int): number of task_ids
+
+        Returns:
+            ([int]) the task_ids
+        """
+        if n < 1:
+            return []
+        return self.task_id_allocator.allocate(n)
+
+    def bulk_upsert(self, docs, ordered=True):
+        """
+        Upsert task documents (with task_ids already assigned) by dir_name in one bulk write.
+
+        Args:
+            docs ([dict]): task documents
+            ordered (bool): whether the bulk write is ordered
+        """
+        requests = [UpdateOne({"dir_name": d["dir_name"]},
+                              {"$set": jsanitize(d, allow_bson=True)}, upsert=True)
+                    for d in docs]
+        if requests:
+            self.collection.bulk_write(requests, ordered=ordered)
 
     @abstractmethod
     def reset(self):
@@ -98,7 +407,9 @@ class CalcDb(six.with_metaclass(ABCMeta)):
         """
         Create MMDB from database file. File requires host, port, database,
         collection, and optionally admin_user/readonly_user and
-        admin_password/readonly_password
+        admin_password/readonly_password, and the constructor arguments in
+        db_file_kwargs, e.g. id_block_size (number of task_ids reserved at a time,
+        see IdAllocator)
 
         Args:
             db_file (str): path to the file containing the credentials
@@ -122,5 +433,7 @@ class CalcDb(six.with_metaclass(ABCMeta)):
             user = creds.get("readonly_user")
             password = creds.get("readonly_password")
 
+        kwargs = {k: creds[k] for k in cls.db_file_kwargs if k in creds}
+
         return cls(creds["host"], int(creds["port"]), creds["database"], creds["collection"],
-                   user, password)
+                   user, password, **kwargs)
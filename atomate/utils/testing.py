@@ -14,6 +14,8 @@ from fireworks import LaunchPad
 
 from pymatgen import SETTINGS
 
+from atomate.utils.database import reset_process_state
+
 __author__ = 'Kiran Mathew'
 __credits__ = 'Anubhav Jain'
 __email__ = 'kmathew@lbl.gov'
@@ -86,4 +88,5 @@ class AtomateTest(unittest.TestCase):
             for coll in db.collection_names():
                 if coll != "system.indexes":
                     db[coll].drop()
+            reset_process_state()
             os.chdir(MODULE_DIR)
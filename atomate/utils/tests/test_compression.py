@@ -0,0 +1,38 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import unittest
+import zlib
+
+from atomate.utils.compression import available_codecs, compress, decompress, parse_codec
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = b"atomate " * 1000
+        self.assertIn("zlib", available_codecs())
+        self.assertIn("bz2", available_codecs())
+        for family in available_codecs():
+            for codec in [family, "{}-1".format(family)]:
+                compressed = compress(data, codec)
+                self.assertLess(len(compressed), len(data))
+                self.assertEqual(decompress(compressed, family), data)
+                self.assertEqual(decompress(compressed, codec), data)
+        self.assertEqual(compress(data, None), data)
+        self.assertEqual(decompress(data, None), data)
+
+    def test_zlib_default_level(self):
+        data = b"atomate " * 1000
+        self.assertEqual(compress(data, "zlib"), zlib.compress(data, 1))
+        self.assertEqual(compress(data, "zlib-9"), zlib.compress(data, 9))
+
+    def test_parse_codec(self):
+        self.assertEqual(parse_codec("zlib-9"), ("zlib", 9))
+        self.assertEqual(parse_codec("zlib"), ("zlib", None))
+        self.assertRaises(ValueError, parse_codec, "snappy")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os
+import unittest
+
+from atomate.utils.database import IdAllocator, ObjectCache, get_id_allocator
+from atomate.utils.utils import get_database
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+
+
+class IdAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_database(os.path.join(MODULE_DIR, "db.json"))
+        self.counter = self.db.counter_unittest
+        self.counter.insert_one({"_id": "testid", "c": 0})
+
+    def tearDown(self):
+        self.db.drop_collection("counter_unittest")
+
+    def test_allocate(self):
+        a1 = IdAllocator(self.counter, "testid", block_size=10)
+        a2 = IdAllocator(self.counter, "testid", block_size=10)
+        self.assertEqual(a1.next_id(), 1)
+        self.assertEqual(a2.next_id(), 11)
+        self.assertEqual(a1.allocate(3), [2, 3, 4])
+        # the rest of the block, then a new block
+        self.assertEqual(a1.allocate(8), [5, 6, 7, 8, 9, 10, 21, 22])
+        self.assertEqual(a2.allocate(25), list(range(12, 21)) + list(range(31, 47)))
+        self.assertEqual(self.counter.find_one({"_id": "testid"})["c"], 46)
+
+        a1.reset()
+        self.assertEqual(a1.next_id(), 47)
+
+    def test_fork(self):
+        a = IdAllocator(self.counter, "testid", block_size=10)
+        self.assertEqual(a.next_id(), 1)
+        # in a forked process, the rest of the parent's block is not used
+        a._pid = -1
+        self.assertEqual(a.next_id(), 11)
+        self.assertEqual(a.next_id(), 12)
+
+    def test_get_id_allocator(self):
+        a = get_id_allocator(self.counter, "testid", block_size=5)
+        self.assertIs(a, get_id_allocator(self.counter, "testid", block_size=5))
+        self.assertIsNot(a, get_id_allocator(self.counter, "otherid"))
+        # the largest requested block size is kept
+        self.assertEqual(get_id_allocator(self.counter, "testid", block_size=1000).block_size,
+                         1000)
+        self.assertEqual(get_id_allocator(self.counter, "testid").block_size, 1000)
+
+
+class ObjectCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = ObjectCache(100)
+        cache.put("a", 1, 40)
+        cache.put("b", 2, 40)
+        self.assertEqual(cache.get("a"), (True, 1))
+        # evicts b, the least recently used
+        cache.put("c", 3, 40)
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertEqual(cache.get("c"), (True, 3))
+        # too large to be cached
+        cache.put("d", 4, 101)
+        self.assertEqual(cache.get("d"), (False, None))
+        self.assertEqual(cache.info(), {"hits": 2, "misses": 2, "entries": 2, "size": 80,
+                                        "max_size": 100})
+        cache.clear()
+        self.assertEqual(cache.get("a"), (False, None))
+        self.assertEqual(cache.size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
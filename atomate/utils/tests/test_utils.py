@@ -8,9 +8,12 @@ from collections import defaultdict
 
 from pymongo.database import Database
 
+from pymatgen import Structure, Lattice
+
 from fireworks import FiretaskBase, Firework, Workflow, explicit_serialize, FWAction
 
-from atomate.utils.utils import env_chk, get_logger, get_mongolike, recursive_get_result, recursive_update, get_database, get_uri
+from atomate.utils.utils import env_chk, get_logger, get_mongolike, recursive_get_result, recursive_update, get_database, get_uri, \
+    get_structure_hash, get_symmetry_info
 
 from atomate.utils.testing import AtomateTest
 
@@ -115,3 +118,19 @@ class UtilsTests(AtomateTest):
         self.assertTrue(isinstance(db, Database))
         self.assertEqual(db.client.address[0], "localhost")
         self.assertEqual(db.name, "atomate_unittest")
+        # the client is cached
+        self.assertIs(get_database(os.path.join(MODULE_DIR, "db.json")).client, db.client)
+
+    def test_get_symmetry_info(self):
+        s = Structure(Lattice.cubic(4.1), ["Cs", "Cl"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+        s2 = s.copy()
+        s2.translate_sites([0, 1], [1, 0, 0])
+        self.assertEqual(get_structure_hash(s), get_structure_hash(s2))
+        s2.add_site_property("magmom", [1, -1])
+        self.assertNotEqual(get_structure_hash(s), get_structure_hash(s2))
+
+        info = get_symmetry_info(s)
+        self.assertEqual(info["spacegroup"]["number"], 221)
+        self.assertTrue(info["has_inversion"])
+        info["spacegroup"]["number"] = 0
+        self.assertEqual(get_symmetry_info(s)["spacegroup"]["number"], 221)
@@ -2,13 +2,19 @@
 
 from __future__ import division, print_function, unicode_literals, absolute_import
 
+import copy
+import hashlib
+import json
 import logging
 import os
 import sys
 import socket
+import threading
+from collections import OrderedDict
 from random import randint
 from time import time
 
+import numpy as np
 import six
 from pymongo import MongoClient
 from monty.json import MontyDecoder
@@ -17,6 +23,7 @@ from pymatgen import Composition
 
 from fireworks import Workflow
 from pymatgen.alchemy.materials import TransformedStructure
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
 __author__ = 'Anubhav Jain, Kiran Mathew'
 __email__ = 'ajain@lbl.gov, kmathew@lbl.gov'
@@ -157,6 +164,75 @@ def get_meta_from_structure(structure):
     return meta
 
 
+def get_structure_hash(structure, decimals=6):
+    """
+    Hash of everything that determines the symmetry of a structure: the lattice, the fractional
+    coordinates, the species and the magnetic moments (if any), rounded to the given number of
+    decimals.
+
+    Args:
+        structure (Structure): input structure
+        decimals (int): number of decimals the lattice and coordinates are rounded to
+
+    Returns:
+        (str) sha1 hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update(np.round(structure.lattice.matrix, decimals).tobytes())
+    sha.update(np.round(structure.frac_coords % 1, decimals).tobytes())
+    sha.update(",".join(site.species_string for site in structure).encode("utf-8"))
+    if "magmom" in structure.site_properties:
+        sha.update(str(np.round(np.array(structure.site_properties["magmom"], dtype=float),
+                                decimals).tolist()).encode("utf-8"))
+    return sha.hexdigest()
+
+
+_symmetry_cache = OrderedDict()
+SYMMETRY_CACHE_SIZE = 4096
+
+
+def get_symmetry_info(structure, symprec=0.1, angle_tolerance=5):
+    """
+    Space group information of a structure as stored in the task and boltztrap docs. The
+    spglib results are cached (least recently used first out) by structure hash and tolerances,
+    so repeated calls for the same structure, e.g. from the drone and the builders, only run
+    spglib once per process.
+
+    Args:
+        structure (Structure): input structure
+        symprec (float): distance tolerance for the symmetry search
+        angle_tolerance (float): angle tolerance for the symmetry search
+
+    Returns:
+        (dict) {"spacegroup": {"source", "symbol", "number", "point_group", "crystal_system",
+            "hall"}, "has_inversion": bool}, or None if spglib finds no symmetry at the given
+            tolerances.
+    """
+    key = (get_structure_hash(structure), symprec, angle_tolerance)
+    if key in _symmetry_cache:
+        info = _symmetry_cache.pop(key)
+    else:
+        sg = SpacegroupAnalyzer(structure, symprec, angle_tolerance)
+        dataset = sg.get_symmetry_dataset()
+        if not dataset:
+            info = None
+        else:
+            inversion = -np.eye(3)
+            has_inversion = any(np.allclose(r, inversion) and np.allclose(t, 0, atol=0.01)
+                                for r, t in zip(dataset["rotations"], dataset["translations"]))
+            info = {"spacegroup": {"source": "spglib",
+                                   "symbol": sg.get_space_group_symbol(),
+                                   "number": sg.get_space_group_number(),
+                                   "point_group": sg.get_point_group_symbol(),
+                                   "crystal_system": sg.get_crystal_system(),
+                                   "hall": sg.get_hall()},
+                    "has_inversion": has_inversion}
+        while len(_symmetry_cache) >= SYMMETRY_CACHE_SIZE:
+            _symmetry_cache.popitem(last=False)
+    _symmetry_cache[key] = info
+    return copy.deepcopy(info)
+
+
 def get_fws_and_tasks(workflow, fw_name_constraint=None, task_name_constraint=None):
     """
     Helper method: given a workflow, returns back the fw_ids and task_ids that match name 
@@ -335,18 +411,51 @@ def get_uri(dir_name):
     return "{}:{}".format(hostname, fullpath)
 
 
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(host, port, database=None, user=None, password=None, **kwargs):
+    """
+    Get a MongoClient from a process-wide cache, keyed by the host, port, credentials and client
+    options. The client (and its connection pool) is created, and authenticated against the
+    database if a user is given, only the first time, so repeated CalcDb/get_database calls in
+    the same process do not reconnect and re-authenticate. Clients are not shared across forked
+    processes.
+
+    Args:
+        host (str): host name or URI
+        port (int): port
+        database (str): database to authenticate against
+        user (str): user name, no authentication if None
+        password (str): password
+        **kwargs: other MongoClient keyword arguments
+
+    Returns:
+        MongoClient
+    """
+    key = json.dumps([os.getpid(), host, int(port), database if user else None, user, password,
+                      kwargs], sort_keys=True, default=str)
+    with _mongo_clients_lock:
+        if key not in _mongo_clients:
+            client = MongoClient(host=host, port=int(port), **kwargs)
+            if user:
+                client[database].authenticate(user, password)
+            _mongo_clients[key] = client
+        return _mongo_clients[key]
+
+
 def get_database(config_file=None, settings=None, admin=False, **kwargs):
     d = loadfn(config_file) if settings is None else settings
-    conn = MongoClient(host=d["host"], port=d["port"], **kwargs)
-    db = conn[d["database"]]
     try:
         user = d["admin_user"] if admin else d["readonly_user"]
         passwd = d["admin_password"] if admin else d["readonly_password"]
-        db.authenticate(user, passwd)
     except (KeyError, TypeError, ValueError):
         logger.warn("No {admin,readonly}_user/password found in config. file, "
             "accessing DB without authentication")
-    return db
+        user, passwd = None, None
+    conn = get_mongo_client(d["host"], d["port"], d["database"], user, passwd, **kwargs)
+    return conn[d["database"]]
 
 
 logger = get_logger(__name__)
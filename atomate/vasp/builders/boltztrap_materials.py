@@ -7,10 +7,11 @@ from tqdm import tqdm
 from atomate.utils.utils import get_logger , get_database
 
 from pymatgen import Structure
-from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator
 from pymatgen.electronic_structure.boltztrap import BoltztrapAnalyzer
 
 from atomate.vasp.builders.base import AbstractBuilder
+from atomate.vasp.builders.utils import get_structure_matcher, get_structure_fingerprint, \
+    get_fingerprint_query, get_match_structure, MatchStructureCache
 
 logger = get_logger(__name__)
 
@@ -28,6 +29,8 @@ class BoltztrapMaterialsBuilder(AbstractBuilder):
         """
         self._materials = materials_write
         self._boltztrap = boltztrap_read
+        # the structures of the materials, reduced for matching (see _match_material)
+        self._match_structures = MatchStructureCache()
 
     def run(self):
         logger.info("BoltztrapMaterialsBuilder starting...")
@@ -67,6 +70,7 @@ class BoltztrapMaterialsBuilder(AbstractBuilder):
         logger.info("Resetting BoltztrapMaterialsBuilder")
         self._materials.update_many({}, {"$unset": {"_boltztrapbuilder": 1,
                                                     "transport": 1}})
+        self._match_structures.clear()
         self._build_indexes()
         logger.info("Finished resetting BoltztrapMaterialsBuilder")
 
@@ -86,18 +90,17 @@ class BoltztrapMaterialsBuilder(AbstractBuilder):
         """
         formula = doc["formula_reduced_abc"]
         sgnum = doc["spacegroup"]["number"]
+        t_struct = get_match_structure(Structure.from_dict(doc["structure"]))
 
-        for m in self._materials.find({"formula_reduced_abc": formula, "sg_number": sgnum},
-                                      {"structure": 1, "material_id": 1}):
-
-            m_struct = Structure.from_dict(m["structure"])
-            t_struct = Structure.from_dict(doc["structure"])
-
-            sm = StructureMatcher(ltol=ltol, stol=stol, angle_tol=angle_tol,
-                                  primitive_cell=True, scale=True,
-                                  attempt_supercell=False, allow_subset=False,
-                                  comparator=ElementComparator())
+        # materials without fingerprint (see TasksMaterialsBuilder) are always fitted
+        q = {"formula_reduced_abc": formula, "sg_number": sgnum,
+             "$or": [get_fingerprint_query(get_structure_fingerprint(t_struct, reduced=True),
+                                           "structure_fingerprint", ltol),
+                     {"structure_fingerprint": {"$exists": False}}]}
 
+        sm = get_structure_matcher(ltol=ltol, stol=stol, angle_tol=angle_tol)
+        for m in self._materials.find(q, {"structure": 1, "material_id": 1}):
+            m_struct = self._match_structures.get(m["material_id"], m["structure"])
             if sm.fit(m_struct, t_struct):
                 return m["material_id"]
 
@@ -2,13 +2,16 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
 from tqdm import tqdm
 
 from atomate.vasp.builders.utils import dbid_to_int, dbid_to_str
 from atomate.utils.utils import get_database
 
 from atomate.utils.utils import get_logger
-from atomate.vasp.builders.tasks_materials import TasksMaterialsBuilder
+from atomate.vasp.builders.tasks_materials import get_task_map
 from atomate.vasp.builders.base import AbstractBuilder
 
 logger = get_logger(__name__)
@@ -17,73 +20,119 @@ __author__ = 'Alireza Faghanina <albalu@lbl.gov>, Anubhav Jain <ajain@lbl.gov>'
 
 
 class TagsBuilder(AbstractBuilder):
-    def __init__(self, materials_write, tasks_read, tasks_prefix="t"):
+    def __init__(self, materials_write, tasks_read, tasks_prefix="t", batch_size=1000,
+                 counter_write=None, watermark_lag=3600):
         """
         Starting with an existing materials collection, searches all its component tasks for 
         the "tags" and key in the tasks collection and copies them to the materials collection.
         Thus, the "tags" for a material will be the union of all the tags for its component tasks.
 
+        The materials of the tasks are looked up in the task_id -> material_id map maintained
+        by TasksMaterialsBuilder (see get_task_map). After a run without errors, its start time
+        is stored as a watermark, and the next run only considers the tasks added to a
+        material, and the tasks updated, since the watermark (minus watermark_lag).
+
         Args:
             materials_write (pymongo.collection): materials collection with write access.
             tasks_read (pymongo.collection): read-only(for safety) tasks collection.
             tasks_prefix (str): the string prefix for tasks, e.g. "t" for a task_id like "t-132"
-
+            batch_size (int): number of tasks looked up and materials updated at a time
+            counter_write (pymongo.collection): collection the watermark is stored in. Default:
+                the "counter" collection of the materials database
+            watermark_lag (float): seconds by which the tasks considered by a run overlap the
+                previous run, to cover tasks written while it ran and clock skew
         """
         self._materials = materials_write
         self._tasks = tasks_read
         self._tasks_prefix = tasks_prefix
+        self.batch_size = batch_size
+        self._counter = counter_write if counter_write is not None else \
+            materials_write.database["counter"]
+        self.watermark_lag = watermark_lag
 
     def run(self):
         logger.info("TagsBuilder starting...")
+        run_started = datetime.utcnow()
         self._build_indexes()
+        task_map = get_task_map(self._materials)
 
         logger.info("Initializing list of all new task_ids to process ...")
-        previous_task_ids = []
-        for m in self._materials.find({"_tagsbuilder": {"$exists": True}},
-                                      {"_tagsbuilder.all_task_ids": 1}):
-            previous_task_ids.extend(m["_tagsbuilder"]["all_task_ids"])
-
-        previous_task_ids = [dbid_to_int(t) for t in previous_task_ids]
-
-        q = {"tags": {"$exists": True}, "task_id": {"$nin": previous_task_ids},
-             "state": "successful"}
-
-        tasks = [t for t in self._tasks.find(q, {"task_id": 1, "tags": 1})]
-        pbar = tqdm(tasks)
-        for t in pbar:
+        watermark = self._get_watermark()
+        if watermark:
+            # the tasks added to a material and the tasks updated since the last run
+            since = watermark - timedelta(seconds=self.watermark_lag)
+            logger.info("Incremental run, considering the tasks updated since {}".format(since))
+            t_ids = set(d["task_id"] for d in
+                        task_map.find({"last_updated": {"$gte": since}}, ["task_id"]))
+            t_ids.update(dbid_to_str(self._tasks_prefix, d["task_id"]) for d in
+                         self._tasks.find({"tags": {"$exists": True}, "state": "successful",
+                                           "last_updated": {"$gte": since}}, ["task_id"]))
+        else:
+            t_ids = set(d["task_id"] for d in task_map.find({}, ["task_id"]))
+        t_ids = sorted(t_ids)
+
+        logger.info("There are {} task_ids to process.".format(len(t_ids)))
+
+        n_failed = 0
+        pbar = tqdm(total=len(t_ids))
+        for i in range(0, len(t_ids), self.batch_size):
+            batch = t_ids[i:i + self.batch_size]
+            pbar.update(len(batch))
             try:
-                pbar.set_description("Processing task_id: {}".format(t['task_id']))
-
-                # get the corresponding materials id
-                m = self._materials.find_one({"_tasksbuilder.all_task_ids":
-                                                  dbid_to_str(self._tasks_prefix, t["task_id"])},
-                                             {"material_id": 1, "tags": 1,
-                                              "_tagsbuilder": 1})
-                if m:
-                    all_tags = t["tags"]
-                    if "tags" in m and m["tags"]:
-                        all_tags.extend(m["tags"])
-
-                    all_tasks = [dbid_to_str(self._tasks_prefix, t["task_id"])]
-                    if "_tagsbuilder" in m:
-                        all_tasks.extend(m["_tagsbuilder"]["all_task_ids"])
-
-                    all_tags = list(set(all_tags))  # filter duplicates
-                    self._materials.update_one({"material_id": m["material_id"]},
-                                               {"$set": {"tags": all_tags,
-                                                         "_tagsbuilder.all_task_ids": all_tasks}})
+                # get the corresponding materials ids and the tags
+                m_ids = {d["task_id"]: d["material_id"] for d in
+                         task_map.find({"task_id": {"$in": batch}})}
+                tags = {d["task_id"]: d["tags"] for d in self._tasks.find(
+                    {"task_id": {"$in": [dbid_to_int(t_id) for t_id in batch]},
+                     "tags": {"$exists": True}, "state": "successful"}, ["task_id", "tags"])}
+
+                # union of the tags of the tasks of each material
+                updates = {}
+                for t_id in batch:
+                    if t_id in m_ids and dbid_to_int(t_id) in tags:
+                        m_tags, all_tasks = updates.setdefault(m_ids[t_id], (set(), []))
+                        m_tags.update(tags[dbid_to_int(t_id)] or [])
+                        all_tasks.append(t_id)
+
+                ops = [UpdateOne({"material_id": m_id},
+                                 {"$addToSet": {"tags": {"$each": sorted(m_tags)},
+                                                "_tagsbuilder.all_task_ids": {
+                                                    "$each": all_tasks}}})
+                       for m_id, (m_tags, all_tasks) in updates.items()]
+                if ops:
+                    self._materials.bulk_write(ops, ordered=False)
 
             except:
                 import traceback
+                n_failed += 1
                 logger.exception("<---")
-                logger.exception("There was an error processing task_id: {}".format(t["task_id"]))
+                logger.exception("There was an error processing task_ids: {}".format(batch))
                 logger.exception(traceback.format_exc())
                 logger.exception("--->")
+        pbar.close()
+
+        # failed batches are retried by the next run
+        if not n_failed:
+            self._counter.update_one({"_id": self._watermark_id},
+                                     {"$set": {"last_updated": run_started}}, upsert=True)
         logger.info("TagsBuilder finished processing.")
 
+    @property
+    def _watermark_id(self):
+        return "tagsbuilder_watermark.{}".format(self._materials.name)
+
+    def _get_watermark(self):
+        """
+        Returns:
+            (datetime) the start time of the last run without errors, None if there is none
+        """
+        d = self._counter.find_one({"_id": self._watermark_id})
+        return d["last_updated"] if d else None
+
     def reset(self):
         logger.info("Resetting TagsBuilder")
         self._materials.update_many({}, {"$unset": {"tags": 1, "_tagsbuilder": 1}})
+        self._counter.delete_one({"_id": self._watermark_id})
         self._build_indexes()
         logger.info("Finished resetting TagsBuilder")
 
@@ -92,13 +141,15 @@ class TagsBuilder(AbstractBuilder):
         self._materials.create_index("_tagsbuilder.all_task_ids")
 
     @classmethod
-    def from_file(cls, db_file, m="materials", t="tasks", **kwargs):
+    def from_file(cls, db_file, m="materials", t="tasks", c="counter", **kwargs):
         """
         Get a TagsCollector using only a db file.
 
         Args:
             db_file (str): path to db file
             m (str): name of "materials" collection
+            t (str): name of "tasks" collection
+            c (str): name of "counter" collection
             **kwargs: other parameters to feed into the builder, e.g. update_all
         """
         db_write = get_database(db_file, admin=True)
@@ -108,4 +159,4 @@ class TagsBuilder(AbstractBuilder):
         except:
             print("Warning: could not get read-only database; using write creds")
             db_read = get_database(db_file, admin=True)
-        return cls(db_write[m], db_read[t], **kwargs)
+        return cls(db_write[m], db_read[t], counter_write=db_write[c], **kwargs)
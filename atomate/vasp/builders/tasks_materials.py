@@ -2,19 +2,24 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
+import multiprocessing
 import os
-from datetime import datetime
+import traceback
+from datetime import datetime, timedelta
 
-from pymongo import ReturnDocument
+from pymongo import InsertOne, UpdateOne
 from tqdm import tqdm
 
+from atomate.utils.database import get_id_allocator
 from atomate.utils.utils import get_mongolike, get_logger
 from atomate.vasp.builders.base import AbstractBuilder
-from atomate.vasp.builders.utils import dbid_to_str, dbid_to_int
+from atomate.vasp.builders.utils import dbid_to_str, get_structure_matcher, \
+    get_structure_fingerprint, get_fingerprint_query, is_fingerprint_match, get_match_structure, \
+    MatchStructureCache
 from atomate.utils.utils import get_database
 from monty.serialization import loadfn
 from pymatgen import Structure
-from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator
 
 logger = get_logger(__name__)
 
@@ -33,10 +38,26 @@ There is lots of config for this builder in the accompanying "tasks_materials_se
 
 class TasksMaterialsBuilder(AbstractBuilder):
     def __init__(self, materials_write, counter_write, tasks_read, tasks_prefix="t",
-                 materials_prefix="m", query=None):
+                 materials_prefix="m", query=None, id_block_size=1, batch_size=1000,
+                 watermark_lag=3600, workers=1):
         """
         Create a materials collection from a tasks collection.
 
+        After a run that processed all its tasks without error, the start time of the run is
+        stored as a watermark in the counter collection, and the next run only considers the
+        tasks whose last_updated is later than the watermark (minus watermark_lag). Tasks
+        without last_updated are only picked up by a full run, e.g. after reset().
+
+        With workers > 1, the new tasks are partitioned into buckets of tasks that can only
+        match the same materials (same formula_reduced_abc and space group, or same formula if
+        parent structures are involved). Each bucket is matched to its materials in a process
+        pool, in memory, and the new and updated materials are written at the end with bulk
+        operations. Within a bucket the tasks are processed in order, so the materials created
+        are the same as in a serial run; the material_ids are allocated bucket by bucket.
+
+        The material of each processed task is also recorded in a task_id -> material_id map
+        (see get_task_map), for the builders that run on the materials afterwards.
+
         Args:
             materials_write (pymongo.collection): mongodb collection for materials (write access needed)
             counter_write (pymongo.collection): mongodb collection for counter (write access needed)
@@ -44,6 +65,12 @@ class TasksMaterialsBuilder(AbstractBuilder):
             tasks_prefix (str): a string prefix for tasks, e.g. "t" gives a task_id like "t-132"
             materials_prefix (str): a string prefix to prepend to material_ids
             query (dict): a pymongo query on tasks_read for which tasks to include in the builder
+            id_block_size (int): number of material_ids reserved from the counter at a time
+            batch_size (int): number of task_ids looked up or task documents read at a time
+            watermark_lag (float): seconds by which the tasks considered by an incremental run
+                overlap the previous run, to cover tasks written while it ran and clock skew
+            workers (int): number of worker processes. 1 processes the tasks one at a time in
+                this process.
         """
         x = loadfn(os.path.join(module_dir, "tasks_materials_settings.yaml"))
         self.supported_task_labels = x['supported_task_labels']
@@ -58,18 +85,34 @@ class TasksMaterialsBuilder(AbstractBuilder):
         self._counter = counter_write
         if self._counter.find({"_id": "materialid"}).count() == 0:
             self._counter.insert_one({"_id": "materialid", "c": 0})
+        self._material_ids = get_id_allocator(self._counter, "materialid", id_block_size)
+        self._task_map = get_task_map(self._materials)
 
         self._tasks = tasks_read
         self._t_prefix = tasks_prefix
         self._m_prefix = materials_prefix
         self.query = query
+        self.batch_size = batch_size
+        self.watermark_lag = watermark_lag
+        self.workers = workers
+        # the structures of the materials, reduced for matching (see _match_material)
+        self._match_structures = MatchStructureCache()
+
+        # the task fields needed to match and update the materials
+        task_fields = {"task_id", "task_label", "formula_anonymous", "formula_pretty",
+                       "formula_reduced_abc", "elements", "nelements", "chemsys",
+                       "parent_structure", "output.spacegroup", "output.structure",
+                       "output.energy_per_atom"}
+        for x in self.property_settings:
+            for p in x["properties"]:
+                task_fields.add("{}.{}".format(x["tasks_key"], p) if x.get("tasks_key") else p)
+        self._task_fields = sorted(task_fields)
 
     def run(self):
         logger.info("MaterialsTaskBuilder starting...")
         logger.info("Initializing list of all new task_ids to process ...")
-        previous_task_ids = []
-        for m in self._materials.find({}, {"_tasksbuilder.all_task_ids": 1}):
-            previous_task_ids.extend(m["_tasksbuilder"]["all_task_ids"])
+        run_started = datetime.utcnow()
+        self._build_fingerprint_indexes()
 
         q = {"state": "successful", "task_label": {"$in": self.supported_task_labels}}
 
@@ -80,36 +123,243 @@ class TasksMaterialsBuilder(AbstractBuilder):
                                  format(common_keys))
             q.update(self.query)
 
-        all_task_ids = [dbid_to_str(self._t_prefix, t["task_id"]) for t in
-                        self._tasks.find(q, {"task_id": 1})]
-        task_ids = [t_id for t_id in all_task_ids if t_id not in previous_task_ids]
+        watermark = self._get_watermark()
+        if watermark and "last_updated" not in q:
+            logger.info("Incremental run, considering the tasks updated since {}".format(
+                watermark))
+            q["last_updated"] = {"$gte": watermark - timedelta(seconds=self.watermark_lag)}
+        else:
+            watermark = None
+
+        candidate_ids = [t["task_id"] for t in self._tasks.find(q, {"task_id": 1})]
+        task_ids = self._get_new_task_ids(candidate_ids, all_materials=watermark is None)
 
         logger.info("There are {} new task_ids to process.".format(len(task_ids)))
 
-        pbar = tqdm(task_ids)
-        for t_id in pbar:
-            pbar.set_description("Processing task_id: {}".format(t_id))
-            try:
-                taskdoc = self._tasks.find_one({"task_id": dbid_to_int(t_id)})
-                m_id = self._match_material(taskdoc)
-                if not m_id:
-                    m_id = self._create_new_material(taskdoc)
-                self._update_material(m_id, taskdoc)
-
-            except:
-                import traceback
-                logger.exception("<---")
-                logger.exception("There was an error processing task_id: {}".format(t_id))
-                logger.exception(traceback.format_exc())
-                logger.exception("--->")
+        if self.workers > 1:
+            n_failed = self._process_tasks_parallel(task_ids)
+        else:
+            n_failed = self._process_tasks(task_ids)
+
+        # failed tasks are retried by the next run
+        if not n_failed:
+            self._set_watermark(run_started)
 
         logger.info("TasksMaterialsBuilder finished processing.")
 
+    def _process_tasks(self, task_ids):
+        """
+        Match the tasks to materials and update the materials, one task at a time.
+
+        Args:
+            task_ids ([int]): task_ids
+
+        Returns:
+            (int) the number of tasks that failed
+        """
+        n_failed = 0
+        map_ops = []
+        pbar = tqdm(total=len(task_ids))
+        try:
+            for taskdoc in self._iter_tasks(task_ids):
+                t_id = dbid_to_str(self._t_prefix, taskdoc["task_id"])
+                pbar.set_description("Processing task_id: {}".format(t_id))
+                pbar.update()
+                try:
+                    m_id = self._match_material(taskdoc)
+                    if not m_id:
+                        m_id = self._create_new_material(taskdoc)
+                    self._update_material(m_id, taskdoc)
+                    map_ops.append(_get_task_map_op(t_id, m_id))
+
+                except:
+                    n_failed += 1
+                    logger.exception("<---")
+                    logger.exception("There was an error processing task_id: {}".format(t_id))
+                    logger.exception(traceback.format_exc())
+                    logger.exception("--->")
+                if len(map_ops) >= self.batch_size:
+                    self._task_map.bulk_write(map_ops, ordered=False)
+                    map_ops = []
+        finally:
+            # the entries missing after a crash are restored by the next run, see
+            # _get_new_task_ids
+            if map_ops:
+                self._task_map.bulk_write(map_ops, ordered=False)
+        pbar.close()
+        return n_failed
+
+    def _process_tasks_parallel(self, task_ids):
+        """
+        Match the tasks to materials bucket by bucket in a process pool (see __init__), then
+        write the new and updated materials with bulk operations.
+
+        Args:
+            task_ids ([int]): task_ids
+
+        Returns:
+            (int) the number of tasks that failed
+        """
+        buckets = {}
+        parent_formulas = set()
+        for taskdoc in self._iter_tasks(task_ids):
+            formula = taskdoc["formula_reduced_abc"]
+            if "parent_structure" in taskdoc:
+                parent_formulas.add(formula)
+            buckets.setdefault((formula, taskdoc["output"]["spacegroup"]["number"]),
+                               []).append(taskdoc)
+        # a material created from a task with a parent structure can be matched by tasks of
+        # any space group, so all the tasks of its formula go in one bucket
+        for formula, sgnum in list(buckets.keys()):
+            if formula in parent_formulas:
+                buckets.setdefault((formula, None), []).extend(buckets.pop((formula, sgnum)))
+        keys = sorted(buckets.keys(), key=lambda k: (k[0], -1 if k[1] is None else k[1]))
+
+        def bucket_args():
+            for formula, sgnum in keys:
+                q = {"formula_reduced_abc": formula}
+                if sgnum is not None:
+                    q["sg_number"] = sgnum
+                materials = list(self._materials.find(q, _MATERIAL_FIELDS))
+                tasks = sorted(buckets[(formula, sgnum)], key=lambda t: t["task_id"])
+                yield (tasks, materials, self.property_settings, self.properties_root,
+                       self._t_prefix)
+
+        logger.info("Matching the tasks in {} buckets with {} workers".format(len(keys),
+                                                                                self.workers))
+        pool = multiprocessing.Pool(self.workers)
+        n_failed = 0
+        ops = []
+        map_ops = []
+        try:
+            pbar = tqdm(total=len(keys))
+            for (formula, sgnum), (materials, errors) in zip(
+                    keys, pool.imap(_process_bucket, bucket_args())):
+                pbar.set_description("Processing bucket: {} {}".format(formula, sgnum))
+                pbar.update()
+                for t_id, error in errors:
+                    n_failed += 1
+                    logger.error("There was an error processing task_id: {}\n{}".format(
+                        dbid_to_str(self._t_prefix, t_id), error))
+                # the new materials get their material_ids in the order they were created
+                new_materials = [m for m, updates, t_ids in materials if "material_id" not in m]
+                m_ids = iter(self._material_ids.allocate(len(new_materials)))
+                for m, updates, t_ids in materials:
+                    if "material_id" not in m:
+                        m["material_id"] = dbid_to_str(self._m_prefix, next(m_ids))
+                        m["_tasksbuilder"]["all_task_ids"] = t_ids
+                        ops.append(InsertOne(m))
+                    else:
+                        u = {"$push": {"_tasksbuilder.all_task_ids": {"$each": t_ids}}}
+                        if updates:
+                            u["$set"] = updates
+                        ops.append(UpdateOne({"material_id": m["material_id"]}, u))
+                    map_ops.extend(_get_task_map_op(t_id, m["material_id"]) for t_id in t_ids)
+                if len(ops) >= self.batch_size:
+                    self._write_materials(ops, map_ops)
+                    ops, map_ops = [], []
+            pbar.close()
+            if ops:
+                self._write_materials(ops, map_ops)
+        finally:
+            pool.terminate()
+            pool.join()
+        return n_failed
+
+    def _write_materials(self, ops, map_ops):
+        self._materials.bulk_write(ops, ordered=False)
+        if map_ops:
+            self._task_map.bulk_write(map_ops, ordered=False)
+
+    def _get_new_task_ids(self, task_ids, all_materials=False):
+        """
+        Remove the task_ids that were already processed. The task_map entries of the processed
+        candidates that have none (the run that processed them stopped before writing them)
+        are written on the way.
+
+        Args:
+            task_ids ([int]): candidate task_ids
+            all_materials (bool): whether to read the processed task_ids of all materials at
+                once (cheaper for a full run) instead of looking up the candidates in batches
+
+        Returns:
+            ([int]) the task_ids to process, in the order of task_ids
+        """
+        candidates = [dbid_to_str(self._t_prefix, t_id) for t_id in task_ids]
+        processed = {}  # task_id -> material_id
+        fields = {"material_id": 1, "_tasksbuilder.all_task_ids": 1}
+        if all_materials:
+            batches = [self._materials.find({}, fields)]
+        else:
+            batches = (self._materials.find(
+                {"_tasksbuilder.all_task_ids": {"$in": candidates[i:i + self.batch_size]}},
+                fields) for i in range(0, len(candidates), self.batch_size))
+        for materials in batches:
+            for m in materials:
+                processed.update((t_id, m["material_id"])
+                                 for t_id in m["_tasksbuilder"]["all_task_ids"])
+
+        done = [t_id for t_id in candidates if t_id in processed]
+        for i in range(0, len(done), self.batch_size):
+            batch = done[i:i + self.batch_size]
+            mapped = {d["task_id"] for d in
+                      self._task_map.find({"task_id": {"$in": batch}}, {"task_id": 1})}
+            map_ops = [_get_task_map_op(t_id, processed[t_id]) for t_id in batch
+                       if t_id not in mapped]
+            if map_ops:
+                logger.info("Restoring {} task_map entries".format(len(map_ops)))
+                self._task_map.bulk_write(map_ops, ordered=False)
+        return [t_id for t_id, t_str in zip(task_ids, candidates) if t_str not in processed]
+
+    def _iter_tasks(self, task_ids):
+        """
+        Read the task documents (only the fields used by the builder) in batches.
+
+        Args:
+            task_ids ([int]): task_ids
+
+        Yields:
+            (dict) the task documents, in the order of task_ids
+        """
+        for i in range(0, len(task_ids), self.batch_size):
+            batch = task_ids[i:i + self.batch_size]
+            docs = {d["task_id"]: d for d in
+                    self._tasks.find({"task_id": {"$in": batch}}, self._task_fields)}
+            for t_id in batch:
+                if t_id in docs:
+                    yield docs[t_id]
+
+    @property
+    def _watermark_id(self):
+        return "tasksbuilder_watermark.{}".format(self._materials.name)
+
+    def _get_watermark(self):
+        """
+        Returns:
+            (datetime) the start time of the last complete run with the same query, None if
+                there is none
+        """
+        d = self._counter.find_one({"_id": self._watermark_id})
+        if d and d["query"] == json.dumps(self.query, sort_keys=True, default=str):
+            return d["last_updated"]
+        return None
+
+    def _set_watermark(self, last_updated):
+        self._counter.update_one({"_id": self._watermark_id},
+                                 {"$set": {"last_updated": last_updated,
+                                           "query": json.dumps(self.query, sort_keys=True,
+                                                               default=str)}},
+                                 upsert=True)
+
     def reset(self):
         logger.info("Resetting TasksMaterialsBuilder")
         self._materials.delete_many({})
         self._counter.delete_one({"_id": "materialid"})
         self._counter.insert_one({"_id": "materialid", "c": 0})
+        self._material_ids.reset()
+        self._match_structures.clear()
+        self._counter.delete_one({"_id": self._watermark_id})
+        self._task_map.delete_many({})
         self._build_indexes()
         logger.info("Finished resetting TasksMaterialsBuilder.")
 
@@ -139,9 +389,19 @@ class TasksMaterialsBuilder(AbstractBuilder):
         Create indexes for faster searching
         """
         self._materials.create_index("material_id", unique=True)
+        self._build_fingerprint_indexes()
         for index in self.indexes:
             self._materials.create_index(index)
 
+    def _build_fingerprint_indexes(self):
+        """
+        Create the indexes of the structure fingerprint queries of _match_material. They are
+        also created on existing materials collections, at the start of each run.
+        """
+        for key in ["structure_fingerprint", "parent_structure.fingerprint"]:
+            self._materials.create_index([("formula_reduced_abc", 1), ("{}.nsites".format(key), 1),
+                                          ("{}.lmin".format(key), 1)])
+
     def _match_material(self, taskdoc, ltol=0.2, stol=0.3, angle_tol=5):
         """
         Returns the material_id that has the same structure as this task as
@@ -161,28 +421,55 @@ class TasksMaterialsBuilder(AbstractBuilder):
         # handle the "parent structure" option, which is used to intentionally force slightly
         # different structures to contribute to the same "material", e.g. from an ordering scheme
         if "parent_structure" in taskdoc:
-            t_struct = Structure.from_dict(taskdoc["parent_structure"]["structure"])
+            t_struct = get_match_structure(
+                Structure.from_dict(taskdoc["parent_structure"]["structure"]))
+            fingerprint = get_structure_fingerprint(t_struct, reduced=True)
             q = {"formula_reduced_abc": formula, "parent_structure.spacegroup.number": taskdoc[
-                "parent_structure"]["spacegroup"]["number"]}
+                "parent_structure"]["spacegroup"]["number"],
+                 "$or": [get_fingerprint_query(fingerprint, "parent_structure.fingerprint", ltol)]}
         else:
             sgnum = taskdoc["output"]["spacegroup"]["number"]
-            t_struct = Structure.from_dict(taskdoc["output"]["structure"])
-            q = {"formula_reduced_abc": formula, "sg_number": sgnum}
-
-        for m in self._materials.find(q, {"parent_structure": 1, "structure": 1, "material_id": 1}):
+            t_struct = get_match_structure(Structure.from_dict(taskdoc["output"]["structure"]))
+            fingerprint = get_structure_fingerprint(t_struct, reduced=True)
+            fp_query = get_fingerprint_query(fingerprint, "structure_fingerprint", ltol)
+            fp_query["parent_structure"] = {"$exists": False}
+            q = {"formula_reduced_abc": formula, "sg_number": sgnum,
+                 "$or": [fp_query,
+                         get_fingerprint_query(fingerprint, "parent_structure.fingerprint", ltol)]}
+
+        # only the materials whose fingerprints are compatible with the task are fitted. The
+        # materials created before the fingerprints were introduced are fitted as well, and get
+        # their fingerprints on the way
+        q["$or"].append({"structure_fingerprint": {"$exists": False}})
+
+        sm = get_structure_matcher(ltol=ltol, stol=stol, angle_tol=angle_tol)
+        for m in self._materials.find(q, {"parent_structure": 1, "structure": 1, "material_id": 1,
+                                          "structure_fingerprint": 1}):
+            if "structure_fingerprint" not in m:
+                self._set_fingerprints(m)
             s_dict = m["parent_structure"]["structure"] if "parent_structure" in m else m[
                 "structure"]
-            m_struct = Structure.from_dict(s_dict)
-            sm = StructureMatcher(ltol=ltol, stol=stol, angle_tol=angle_tol,
-                                  primitive_cell=True, scale=True,
-                                  attempt_supercell=False, allow_subset=False,
-                                  comparator=ElementComparator())
+            m_struct = self._match_structures.get(m["material_id"], s_dict)
 
             if sm.fit(m_struct, t_struct):
                 return m["material_id"]
 
         return None
 
+    def _set_fingerprints(self, m):
+        """
+        Store the structure fingerprints used by _match_material in a material document.
+
+        Args:
+            m (dict): the material document, with its structure and parent_structure
+        """
+        d = {"structure_fingerprint": get_structure_fingerprint(
+            Structure.from_dict(m["structure"]))}
+        if "parent_structure" in m:
+            d["parent_structure.fingerprint"] = get_structure_fingerprint(
+                Structure.from_dict(m["parent_structure"]["structure"]))
+        self._materials.update_one({"material_id": m["material_id"]}, {"$set": d})
+
     def _create_new_material(self, taskdoc):
         """
         Create a new material document.
@@ -193,98 +480,243 @@ class TasksMaterialsBuilder(AbstractBuilder):
         Returns:
             (int) - material_id of the new document
         """
-        doc = {"created_at": datetime.utcnow()}
-        doc["_tasksbuilder"] = {"all_task_ids": [], "prop_metadata":
-            {"labels": {}, "task_ids": {}}, "updated_at": datetime.utcnow()}
-        doc["spacegroup"] = taskdoc["output"]["spacegroup"]
-        doc["structure"] = taskdoc["output"]["structure"]
-        doc["material_id"] = dbid_to_str(
-            self._m_prefix, self._counter.find_one_and_update(
-                {"_id": "materialid"}, {"$inc": {"c": 1}},
-                return_document=ReturnDocument.AFTER)["c"])
-
-        doc["sg_symbol"] = doc["spacegroup"]["symbol"]
-        doc["sg_number"] = doc["spacegroup"]["number"]
-
-
-        for x in ["formula_anonymous", "formula_pretty", "formula_reduced_abc", "elements",
-                  "nelements", "chemsys"]:
-            doc[x] = taskdoc[x]
-
-        if "parent_structure" in taskdoc:
-            doc["parent_structure"] = taskdoc["parent_structure"]
-            t_struct = Structure.from_dict(taskdoc["parent_structure"]["structure"])
-            doc["parent_structure"]["formula_reduced_abc"] = t_struct.composition.reduced_formula
-
+        doc = _new_material_doc(taskdoc)
+        doc["material_id"] = dbid_to_str(self._m_prefix, self._material_ids.next_id())
         self._materials.insert_one(doc)
 
         return doc["material_id"]
 
     def _update_material(self, m_id, taskdoc):
         """
-        Update a material document based on a new task and using complex logic
+        Update a material document based on a new task and using complex logic (see
+        _get_material_updates). The material is read and written once; the task_map entry of
+        the task is written in batches by _process_tasks.
 
         Args:
             m_id (int): material_id for material document to update
             taskdoc (dict): a JSON-like task document
         """
-
-        # For each materials property, figure out what kind of task the data is currently based on
-        # as defined by the task label.  This is used to decide if the new taskdoc is a type of
-        # calculation that provides higher quality data for that property
-        prop_tlabels = self._materials.find_one(
-            {"material_id": m_id}, {"_tasksbuilder.prop_metadata.labels": 1})[
-            "_tasksbuilder"]["prop_metadata"]["labels"]
-
-        task_label = taskdoc["task_label"]  # task label of new doc that updates this material
-
-        # figure out what materials properties need to be updated based on new task
-        for x in self.property_settings:
-            for p in x["properties"]:
-                # check if this is a valid task for getting the property
-                if task_label in x["quality_scores"]:
-                    # assert: this is a valid task for the property
-                    # but is it the "best" task for that property (highest quality score)?
-                    t_quality = x["quality_scores"][task_label]
-                    m_quality = x["quality_scores"].get(prop_tlabels.get(p, None), None)
-                    # check if this task's quality is better than existing data
-                    # 3 possibilities:
-                    # i) materials property data not present, so this is best
-                    # ii) task quality higher based on task label
-                    # iii) task quality equal to materials; use lowest energy task
-                    if not m_quality or t_quality > m_quality \
-                            or (t_quality == m_quality
-                                and taskdoc["output"]["energy_per_atom"] <
-                                    self._materials.find_one({"material_id": m_id}, {
-                                        "_tasksbuilder": 1})["_tasksbuilder"]["prop_metadata"][
-                                        "energies"][p]):
-
-                        # this task has better quality data
-                        # figure out where the property data lives in the materials doc and
-                        # in the task doc
-                        materials_key = "{}.{}".format(x["materials_key"], p) \
-                            if x.get("materials_key") else p
-                        tasks_key = "{}.{}".format(x["tasks_key"], p) \
-                            if x.get("tasks_key") else p
-
-                        # insert property data AND metadata about this task
-                        self._materials.\
-                            update_one({"material_id": m_id},
-                                       {"$set": {materials_key: get_mongolike(taskdoc, tasks_key),
-                                                 "_tasksbuilder.prop_metadata.labels.{}".format(p): task_label,
-                                                 "_tasksbuilder.prop_metadata.task_ids.{}".format(p): dbid_to_str(
-                                                     self._t_prefix, taskdoc["task_id"]),
-                                                 "_tasksbuilder.prop_metadata.energies.{}".format(p): taskdoc["output"]["energy_per_atom"],
-                                                 "_tasksbuilder.updated_at": datetime.utcnow()}})
-
-                        # copy property to document root if in properties_root
-                        # i.e., intentionally duplicate some data to the root level
-                        if p in self.properties_root:
-                            self._materials.\
-                            update_one({"material_id": m_id},
-                                       {"$set": {p: get_mongolike(taskdoc, tasks_key)}})
-
-        # update the database to reflect that this task_id was already processed
-        self._materials.update_one({"material_id": m_id},
-                                   {"$push": {"_tasksbuilder.all_task_ids": dbid_to_str(
-                                       self._t_prefix, taskdoc["task_id"])}})
+        material = self._materials.find_one({"material_id": m_id},
+                                            {"_tasksbuilder.prop_metadata": 1})
+        updates = _get_material_updates(material, taskdoc, self.property_settings,
+                                        self.properties_root, self._t_prefix)
+
+        # also record that this task_id was processed
+        t_id = dbid_to_str(self._t_prefix, taskdoc["task_id"])
+        u = {"$push": {"_tasksbuilder.all_task_ids": t_id}}
+        if updates:
+            u["$set"] = updates
+        self._materials.update_one({"material_id": m_id}, u)
+
+
+def get_task_map(materials):
+    """
+    Get the collection that maps the task_ids processed by TasksMaterialsBuilder to the
+    material_ids of a materials collection, i.e. the inverse of _tasksbuilder.all_task_ids,
+    with documents {"task_id": "t-132", "material_id": "m-12", "last_updated": datetime}, where
+    last_updated is when the task was added to the material. If it is empty while the
+    materials are not (they were built before the map was introduced), it is filled from the
+    materials.
+
+    Args:
+        materials (pymongo.collection): the materials collection
+
+    Returns:
+        (pymongo.collection) the "<materials>_task_map" collection
+    """
+    task_map = materials.database["{}_task_map".format(materials.name)]
+    task_map.create_index("task_id", unique=True)
+    task_map.create_index("last_updated")
+    if task_map.find_one() is None and \
+            materials.find_one({"_tasksbuilder.all_task_ids.0": {"$exists": True}}):
+        logger.info("Building the task_id -> material_id map of {}".format(materials.name))
+        ops = []
+        for m in materials.find({}, {"material_id": 1, "_tasksbuilder.all_task_ids": 1}):
+            ops.extend(_get_task_map_op(t_id, m["material_id"])
+                       for t_id in m.get("_tasksbuilder", {}).get("all_task_ids", []))
+            if len(ops) >= 1000:
+                task_map.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            task_map.bulk_write(ops, ordered=False)
+    return task_map
+
+
+def _get_task_map_op(t_id, m_id):
+    # upsert of the task_map entry of a task added to a material, see get_task_map
+    return UpdateOne({"task_id": t_id}, {"$set": {"material_id": m_id,
+                                                  "last_updated": datetime.utcnow()}},
+                     upsert=True)
+
+
+# the fields of the materials used to match and update them
+_MATERIAL_FIELDS = ["material_id", "sg_number", "structure", "structure_fingerprint",
+                    "parent_structure", "_tasksbuilder.prop_metadata"]
+
+
+def _new_material_doc(taskdoc):
+    """
+    Args:
+        taskdoc (dict): a JSON-like task document
+
+    Returns:
+        (dict) a new material document (without material_id) for the structure of the task
+    """
+    doc = {"created_at": datetime.utcnow()}
+    doc["_tasksbuilder"] = {"all_task_ids": [], "prop_metadata":
+        {"labels": {}, "task_ids": {}}, "updated_at": datetime.utcnow()}
+    doc["spacegroup"] = taskdoc["output"]["spacegroup"]
+    doc["structure"] = taskdoc["output"]["structure"]
+    doc["structure_fingerprint"] = get_structure_fingerprint(
+        Structure.from_dict(doc["structure"]))
+
+    doc["sg_symbol"] = doc["spacegroup"]["symbol"]
+    doc["sg_number"] = doc["spacegroup"]["number"]
+
+    for x in ["formula_anonymous", "formula_pretty", "formula_reduced_abc", "elements",
+              "nelements", "chemsys"]:
+        doc[x] = taskdoc[x]
+
+    if "parent_structure" in taskdoc:
+        doc["parent_structure"] = taskdoc["parent_structure"]
+        t_struct = Structure.from_dict(taskdoc["parent_structure"]["structure"])
+        doc["parent_structure"]["formula_reduced_abc"] = t_struct.composition.reduced_formula
+        doc["parent_structure"]["fingerprint"] = get_structure_fingerprint(t_struct)
+
+    return doc
+
+
+def _set_mongolike(d, key, value):
+    # set a dict value using dot-notation, see get_mongolike
+    keys = key.split(".")
+    for k in keys[:-1]:
+        d = d.setdefault(k, {})
+    d[keys[-1]] = value
+
+
+def _get_material_updates(material, taskdoc, property_settings, properties_root, t_prefix):
+    """
+    Compute the property updates of a material for a new task (see tasks_materials_settings.yaml)
+    and apply them to the material document in memory.
+
+    Args:
+        material (dict): the material document, with at least its _tasksbuilder.prop_metadata
+        taskdoc (dict): a JSON-like task document
+        property_settings (list): the property settings of the builder
+        properties_root (list): the properties copied to the root of the material document
+        t_prefix (str): the prefix of the task_ids
+
+    Returns:
+        (dict) the updates, as a $set document
+    """
+    prop_metadata = material["_tasksbuilder"]["prop_metadata"]
+    # the labels of the tasks the properties are currently based on
+    prop_tlabels = dict(prop_metadata["labels"])
+    task_label = taskdoc["task_label"]
+    energy = taskdoc["output"]["energy_per_atom"]
+
+    updates = {}
+    for x in property_settings:
+        # check if this is a valid task for getting the properties
+        if task_label not in x["quality_scores"]:
+            continue
+        t_quality = x["quality_scores"][task_label]
+        for p in x["properties"]:
+            # the task is better if there is no data for the property yet, if its quality is
+            # higher, or if its quality is equal and its energy lower
+            m_quality = x["quality_scores"].get(prop_tlabels.get(p, None), None)
+            if not m_quality or t_quality > m_quality \
+                    or (t_quality == m_quality and energy < prop_metadata["energies"][p]):
+                materials_key = "{}.{}".format(x["materials_key"], p) \
+                    if x.get("materials_key") else p
+                tasks_key = "{}.{}".format(x["tasks_key"], p) if x.get("tasks_key") else p
+                u = {materials_key: get_mongolike(taskdoc, tasks_key),
+                     "_tasksbuilder.prop_metadata.labels.{}".format(p): task_label,
+                     "_tasksbuilder.prop_metadata.task_ids.{}".format(p): dbid_to_str(
+                         t_prefix, taskdoc["task_id"]),
+                     "_tasksbuilder.prop_metadata.energies.{}".format(p): energy,
+                     "_tasksbuilder.updated_at": datetime.utcnow()}
+                # copy property to document root if in properties_root
+                if p in properties_root:
+                    u[p] = u[materials_key]
+                for k, v in u.items():
+                    _set_mongolike(material, k, v)
+                updates.update(u)
+    return updates
+
+
+def _is_candidate(material, taskdoc, fingerprint, ltol):
+    # in-memory version of the query of TasksMaterialsBuilder._match_material
+    if "parent_structure" in taskdoc:
+        if material.get("parent_structure", {}).get("spacegroup", {}).get("number") != \
+                taskdoc["parent_structure"]["spacegroup"]["number"]:
+            return False
+        return is_fingerprint_match(material["parent_structure"]["fingerprint"], fingerprint,
+                                    ltol)
+    if material["sg_number"] != taskdoc["output"]["spacegroup"]["number"]:
+        return False
+    m_fingerprint = material["parent_structure"]["fingerprint"] \
+        if "parent_structure" in material else material["structure_fingerprint"]
+    return is_fingerprint_match(m_fingerprint, fingerprint, ltol)
+
+
+def _process_bucket(args, ltol=0.2, stol=0.3, angle_tol=5):
+    """
+    Match a bucket of tasks to materials and compute the material updates, in memory. The
+    tasks are processed in order; a task that matches no material creates a new one.
+
+    Args:
+        args (tuple): the tasks, the materials (see _MATERIAL_FIELDS) that the tasks can
+            match, the property settings, the properties copied to the root and the task_id
+            prefix
+
+    Returns:
+        ([(dict, dict, [str])], [(int, str)]): for each material that is new or updated, the
+            material document (without material_id if it is new), the $set updates and the
+            task_ids pushed; and the task_id and traceback of each task that failed
+    """
+    tasks, materials, property_settings, properties_root, t_prefix = args
+    sm = get_structure_matcher(ltol=ltol, stol=stol, angle_tol=angle_tol)
+    # the match structures of the materials, decoded once per bucket, by position in results
+    m_structs = MatchStructureCache()
+    results = []
+    for m in materials:
+        updates = {}
+        # materials created before the fingerprints were introduced
+        if "structure_fingerprint" not in m:
+            updates["structure_fingerprint"] = get_structure_fingerprint(
+                Structure.from_dict(m["structure"]))
+            if "parent_structure" in m:
+                updates["parent_structure.fingerprint"] = get_structure_fingerprint(
+                    Structure.from_dict(m["parent_structure"]["structure"]))
+            for k, v in updates.items():
+                _set_mongolike(m, k, v)
+        results.append((m, updates, []))
+
+    errors = []
+    for taskdoc in tasks:
+        try:
+            s_dict = taskdoc["parent_structure"]["structure"] if "parent_structure" in taskdoc \
+                else taskdoc["output"]["structure"]
+            t_struct = get_match_structure(Structure.from_dict(s_dict))
+            fingerprint = get_structure_fingerprint(t_struct, reduced=True)
+            match = None
+            for i, (m, updates, t_ids) in enumerate(results):
+                if _is_candidate(m, taskdoc, fingerprint, ltol):
+                    m_struct = m_structs.get(i, m["parent_structure"]["structure"]
+                                             if "parent_structure" in m else m["structure"])
+                    if sm.fit(m_struct, t_struct):
+                        match = (m, updates, t_ids)
+                        break
+            if match is None:
+                # the structure the new material is matched with is the one of the task
+                match = (_new_material_doc(taskdoc), {}, [])
+                m_structs.put(len(results), t_struct)
+                results.append(match)
+            m, updates, t_ids = match
+            updates.update(_get_material_updates(m, taskdoc, property_settings,
+                                                 properties_root, t_prefix))
+            t_ids.append(dbid_to_str(t_prefix, taskdoc["task_id"]))
+        except Exception:
+            errors.append((taskdoc["task_id"], traceback.format_exc()))
+    return [r for r in results if "material_id" not in r[0] or r[1] or r[2]], errors
@@ -0,0 +1,78 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import unittest
+
+import numpy as np
+
+from pymatgen import Lattice, Structure
+from pymatgen.core.operations import SymmOp
+
+from atomate.vasp.builders.utils import get_structure_matcher, get_structure_fingerprint, \
+    get_fingerprint_query, is_fingerprint_match, get_match_structure, MatchStructureCache
+
+
+class StructureFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nacl = Structure(Lattice.cubic(5.69), ["Na"] * 4 + ["Cl"] * 4,
+                              [[0, 0, 0], [0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0],
+                               [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5], [0.5, 0.5, 0.5]])
+        self.mono = Structure(Lattice.monoclinic(3.1, 4.3, 5.2, 101), ["Li", "O", "O"],
+                              [[0, 0, 0], [0.3, 0.2, 0.1], [0.6, 0.7, 0.4]])
+
+    def get_variants(self, s):
+        strained = s.copy()
+        strained.apply_strain([0.05, -0.03, 0.02])
+        rotated = s.copy()
+        rotated.apply_operation(SymmOp.from_axis_angle_and_translation([1, 2, 3], 37))
+        # an equivalent but different choice of lattice vectors
+        sheared = s.copy()
+        sheared.make_supercell([[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+        supercell = s.copy()
+        supercell.make_supercell([2, 1, 1])
+        scaled = s.copy()
+        scaled.scale_lattice(s.volume * 1.3)
+        perturbed = s.copy()
+        perturbed.perturb(0.05)
+        return [strained, rotated, sheared, supercell, scaled, perturbed]
+
+    def test_prefilter_keeps_matches(self):
+        sm = get_structure_matcher()
+        for s in [self.nacl, self.mono]:
+            for variant in self.get_variants(s):
+                for s1, s2 in [(s, variant), (variant, s)]:
+                    self.assertTrue(sm.fit(s1, s2))
+                    self.assertTrue(is_fingerprint_match(get_structure_fingerprint(s1),
+                                                         get_structure_fingerprint(s2)))
+
+    def test_match_structures(self):
+        sm = get_structure_matcher()
+        for s in [self.nacl, self.mono]:
+            match = get_match_structure(s)
+            self.assertEqual(get_structure_fingerprint(match, reduced=True),
+                             get_structure_fingerprint(s))
+            for variant in self.get_variants(s):
+                self.assertTrue(sm.fit(match, get_match_structure(variant)))
+        self.assertFalse(sm.fit(get_match_structure(self.nacl), get_match_structure(self.mono)))
+
+        cache = MatchStructureCache()
+        match = cache.get("m-1", self.nacl.as_dict())
+        self.assertEqual(len(match), 2)
+        self.assertIs(cache.get("m-1", None), match)
+
+    def test_fingerprint(self):
+        fingerprint = get_structure_fingerprint(self.nacl)
+        self.assertEqual(fingerprint["nsites"], 2)
+        # fcc primitive cell: a / sqrt(2) over (a**3 / 4) ** (1/3)
+        self.assertAlmostEqual(fingerprint["lmin"], 4 ** (1 / 3) / np.sqrt(2))
+        q = get_fingerprint_query(fingerprint, "structure_fingerprint")
+        self.assertEqual(q["structure_fingerprint.nsites"], 2)
+        self.assertGreater(q["structure_fingerprint.lmin"]["$lt"], fingerprint["lmin"] * 1.2)
+        self.assertFalse(is_fingerprint_match(get_structure_fingerprint(self.mono),
+                                              fingerprint))
+
+
+if __name__ == "__main__":
+    unittest.main()
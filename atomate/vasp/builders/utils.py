@@ -2,8 +2,17 @@
 This class contains common functions for builders
 """
 
+from __future__ import division
+
+from pymatgen import Structure
+from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator
+
+from atomate.utils.database import ObjectCache
+
 __author__ = 'Anubhav Jain <ajain@lbl.gov>'
 
+_structure_matchers = {}
+
 
 def dbid_to_str(prefix, dbid):
     # converts int dbid to string (adds prefix)
@@ -13,3 +22,137 @@ def dbid_to_str(prefix, dbid):
 def dbid_to_int(dbid):
     # converts string dbid to int (removes prefix)
     return int(dbid.split("-")[1])
+
+
+def get_structure_matcher(ltol=0.2, stol=0.3, angle_tol=5):
+    """
+    Returns the (shared) StructureMatcher used by the builders to match structures to materials,
+    comparing primitive cells scaled to the same volume.
+    """
+    key = (ltol, stol, angle_tol)
+    if key not in _structure_matchers:
+        _structure_matchers[key] = StructureMatcher(ltol=ltol, stol=stol, angle_tol=angle_tol,
+                                                    primitive_cell=True, scale=True,
+                                                    attempt_supercell=False, allow_subset=False,
+                                                    comparator=ElementComparator())
+    return _structure_matchers[key]
+
+
+def get_match_structure(structure):
+    """
+    The niggli reduced primitive cell of a structure, which get_structure_fingerprint measures
+    and the StructureMatcher of get_structure_matcher reduces its inputs to. Fitting the match
+    structures gives the same result as fitting the structures, and they are cheaper to fit.
+
+    Args:
+        structure (Structure): the structure
+
+    Returns:
+        (Structure) the niggli reduced primitive cell
+    """
+    return structure.get_reduced_structure(reduction_algo="niggli").get_primitive_structure()
+
+
+def get_structure_fingerprint(structure, reduced=False):
+    """
+    Cheap structural fingerprint of a structure, stored in the materials documents so that
+    only the candidates that can match reach StructureMatcher.fit (see get_fingerprint_query).
+
+    Args:
+        structure (Structure): the structure
+        reduced (bool): whether the structure is already a match structure (see
+            get_match_structure)
+
+    Returns:
+        (dict) "nsites": number of sites of the primitive cell, "lmin": length of the shortest
+            lattice vector divided by the cube root of the volume of the primitive cell
+    """
+    prim = structure if reduced else get_match_structure(structure)
+    return {"nsites": len(prim), "lmin": min(prim.lattice.abc) / prim.volume ** (1 / 3)}
+
+
+def get_fingerprint_query(fingerprint, key, ltol=0.2):
+    """
+    Query on the fingerprints (see get_structure_fingerprint) of the material structures that
+    can match a structure with get_structure_matcher(ltol, ...).fit(material structure,
+    structure). These are necessary conditions of the fit, so no match is lost: the primitive
+    cells have the same number of sites, and after scaling to the same volume, the lattice of
+    the material has a vector within ltol of the length of the shortest vector of the other
+    lattice. The volume itself is not compared since the matcher scales it.
+
+    Args:
+        fingerprint (dict): the fingerprint of the structure
+        key (str): the field of the fingerprints in the materials documents
+        ltol (float): StructureMatcher length tolerance
+
+    Returns:
+        (dict) query
+    """
+    return {"{}.nsites".format(key): fingerprint["nsites"],
+            "{}.lmin".format(key): {"$lt": _get_max_lmin(fingerprint, ltol)}}
+
+
+def is_fingerprint_match(m_fingerprint, fingerprint, ltol=0.2):
+    """
+    In-memory version of get_fingerprint_query.
+
+    Args:
+        m_fingerprint (dict): the fingerprint of the material structure
+        fingerprint (dict): the fingerprint of the structure
+        ltol (float): StructureMatcher length tolerance
+
+    Returns:
+        (bool) whether the structures can match
+    """
+    return m_fingerprint["nsites"] == fingerprint["nsites"] and \
+        m_fingerprint["lmin"] < _get_max_lmin(fingerprint, ltol)
+
+
+def _get_max_lmin(fingerprint, ltol):
+    # the margin covers the rounding errors of the fingerprints
+    return fingerprint["lmin"] * (1 + ltol) * (1 + 1e-6)
+
+
+class MatchStructureCache(object):
+    """
+    Least-recently-used cache of the match structures (see get_match_structure) of materials,
+    so that the structure of a material is decoded and reduced once, rather than for every
+    task or document it is fitted against. The structures of the materials do not change once
+    they are created; the cache must be cleared when the materials are reset.
+    """
+
+    # estimated size of a cached structure per site, in bytes
+    site_size = 2048
+
+    def __init__(self, max_size=2 ** 28):
+        """
+        Args:
+            max_size (int): maximum total (estimated) size of the cached structures in bytes
+        """
+        self._cache = ObjectCache(max_size)
+
+    def get(self, key, structure_dict):
+        """
+        Args:
+            key: the cache key, e.g. the material_id
+            structure_dict (dict): the structure, decoded and reduced if it is not cached
+
+        Returns:
+            (Structure) the match structure
+        """
+        found, structure = self._cache.get(key)
+        if not found:
+            structure = get_match_structure(Structure.from_dict(structure_dict))
+            self.put(key, structure)
+        return structure
+
+    def put(self, key, structure):
+        """
+        Args:
+            key: the cache key, e.g. the material_id
+            structure (Structure): the match structure
+        """
+        self._cache.put(key, structure, len(structure) * self.site_size)
+
+    def clear(self):
+        self._cache.clear()
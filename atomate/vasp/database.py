@@ -2,24 +2,30 @@
 
 from __future__ import division, print_function, unicode_literals, absolute_import
 
-from monty.json import MontyEncoder, MontyDecoder
+from monty.json import MontyEncoder, MontyDecoder, jsanitize
 
 """
 This module defines the database classes.
 """
 
-import zlib
+import hashlib
 import json
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from bson import ObjectId
 
 from pymatgen.electronic_structure.bandstructure import BandStructure, BandStructureSymmLine
 from pymatgen.electronic_structure.dos import CompleteDos
 
 import gridfs
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 
-from atomate.utils.database import CalcDb
+from atomate.utils import compression
+from atomate.utils.database import CalcDb, ObjectCache
 from atomate.utils.utils import get_logger
+from atomate.vasp.volumetric import VOLUMETRIC_FORMAT, volumetric_to_bytes, volumetric_from_file
 
 __author__ = 'Kiran Mathew'
 __credits__ = 'Anubhav Jain'
@@ -33,25 +39,97 @@ class VaspCalcDb(CalcDb):
     Class to help manage database insertions of Vasp drones
     """
 
+    # default compression codec of each GridFS collection (see atomate.utils.compression): the
+    # fast zlib level 1. Denser codecs, e.g. "zlib-9" or "lzma" for the charge densities, are
+    # opt-in with gridfs_codecs
+    default_codecs = {"dos_fs": "zlib", "bandstructure_fs": "zlib", "dos_boltztrap_fs": "zlib",
+                      "chgcar_fs": "zlib", "aeccar0_fs": "zlib", "aeccar2_fs": "zlib"}
+
+    db_file_kwargs = ["id_block_size", "gridfs_codecs", "cache_size"]
+
+    # where the GridFS files are referenced: {GridFS collection: (collection, field)}, the
+    # collection name formatted with the name of the tasks collection
+    gridfs_references = {
+        "dos_fs": ("{tasks}", "calcs_reversed.dos_fs_id"),
+        "bandstructure_fs": ("{tasks}", "calcs_reversed.bandstructure_fs_id"),
+        "chgcar_fs": ("{tasks}", "calcs_reversed.chgcar_fs_id"),
+        "aeccar0_fs": ("{tasks}", "calcs_reversed.aeccar0_fs_id"),
+        "aeccar2_fs": ("{tasks}", "calcs_reversed.aeccar2_fs_id"),
+        "dos_boltztrap_fs": ("boltztrap", "dos_boltztrap_fs_id")}
+
+    # single field indexes of the tasks collection
+    default_indexes = ["formula_pretty", "formula_anonymous", "formula_reduced_abc",
+                       "output.energy", "output.energy_per_atom", "output.spacegroup.number",
+                       "dir_name", "task_label", "tags", "state", "last_updated"]
+
+    canonical_queries = [
+        ("task by task_id", "{tasks}", {"task_id": 1}),
+        ("duplicates by dir_name", "{tasks}", {"dir_name": {"$in": ["host:/path"]}}),
+        ("analysis input by task_label", "{tasks}",
+         {"task_label": "tag structure optimization"}),
+        ("analysis deformations by task_label prefix", "{tasks}",
+         {"task_label": {"$regex": "^tag bulk_modulus"}, "formula_pretty": "Si"}),
+        ("polarization tasks by workflow tag", "{tasks}",
+         {"tags": "wfid_1", "task_label": {"$regex": ".*polarization"}}),
+        ("TasksMaterialsBuilder tasks", "{tasks}",
+         {"state": "successful", "task_label": {"$in": ["structure optimization"]}}),
+        ("TagsBuilder tasks", "{tasks}", {"tags": {"$exists": True}, "state": "successful"}),
+        ("FixTasksBuilder string spacegroup numbers", "{tasks}",
+         {"output.spacegroup.number": {"$type": 2}}),
+        ("tasks by reduced formula and spacegroup", "{tasks}",
+         {"formula_reduced_abc": "Si1", "output.spacegroup.number": 227}),
+        ("tasks updated since", "{tasks}", {"last_updated": {"$gt": datetime(2000, 1, 1)}}),
+        ("summaries by task_label prefix", "{tasks}_summary",
+         {"task_label": {"$regex": "^tag bulk_modulus"}, "formula_pretty": "Si"}),
+        ("summaries by workflow tag", "{tasks}_summary",
+         {"tags": "wfid_1", "task_label": {"$regex": ".*polarization"}}),
+        ("summaries by task_id", "{tasks}_summary", {"task_id": {"$in": [1]}}),
+        ("GridFS file by content hash", "dos_fs.files", {"metadata.content_hash": "0"}),
+    ]
+
     def __init__(self, host="localhost", port=27017, database="vasp", collection="tasks", user=None,
-                 password=None):
-        super(VaspCalcDb, self).__init__(host, port, database, collection, user, password)
+                 password=None, id_block_size=1, gridfs_codecs=None, cache_size=0):
+        """
+        Args:
+            host (str): database host
+            port (int): database port
+            database (str): database name
+            collection (str): tasks collection name
+            user (str): user name
+            password (str): password
+            id_block_size (int): number of task_ids reserved at a time (see IdAllocator)
+            gridfs_codecs (dict): compression codecs by GridFS collection name, overriding
+                default_codecs, e.g. {"chgcar_fs": "lzma"}
+            cache_size (int): if > 0, keep the decoded DOS, band structure and charge density
+                objects read by get_dos, get_band_structure, get_chgcar and get_aeccar (and the
+                charge densities unpacked by retrieve_tasks) in an in-memory LRU cache, keyed by
+                GridFS file id, of at most this many bytes. The cached objects are shared
+                between the calls and must not be modified. Default: no cache
+        """
+        self.gridfs_codecs = dict(self.default_codecs)
+        self.gridfs_codecs.update(gridfs_codecs or {})
+        self.object_cache = ObjectCache(cache_size) if cache_size > 0 else None
+        super(VaspCalcDb, self).__init__(host, port, database, collection, user, password,
+                                         id_block_size=id_block_size)
+
+    @property
+    def summary_collection(self):
+        """
+        The compact copies of the task documents for analyses, see get_task_summary. (A
+        property, as the indexes are built during CalcDb.__init__.)
+        """
+        return self.db["{}_summary".format(self.collection.name)]
 
     def build_indexes(self, indexes=None, background=True):
         """
-        Build the indexes.
+        Build the indexes. They cover the queries issued by atomate (see canonical_queries and
+        audit_indexes). Existing indexes are left untouched.
 
         Args:
-            indexes (list): list of single field indexes to be built.
+            indexes (list): list of single field indexes to be built. Default: default_indexes
             background (bool): Run in the background or not.
-
-        TODO: make sure that the index building is sensible and check for
-            existing indexes.
         """
-        _indices = indexes if indexes else [
-            "formula_pretty", "formula_anonymous",
-            "output.energy", "output.energy_per_atom", "dir_name"
-        ]
+        _indices = indexes if indexes else self.default_indexes
         self.collection.create_index("task_id", unique=True, background=background)
         # build single field indexes
         for i in _indices:
@@ -66,8 +144,14 @@ class VaspCalcDb(CalcDb):
                                           ("output.energy_per_atom", DESCENDING),
                                           ("completed_at", DESCENDING)],
                                          background=background)
-
-    def insert_task(self, task_doc, use_gridfs=False):
+        self.summary_collection.create_index("task_id", unique=True, background=background)
+        for i in ("task_label", "tags", "formula_pretty"):
+            self.summary_collection.create_index(i, background=background)
+        for fs_collection in self.gridfs_references:
+            self.db[fs_collection].files.create_index("metadata.content_hash",
+                                                      background=background)
+
+    def insert_task(self, task_doc, use_gridfs=False, volumetric_dtype="float64", quantize=None):
         """
         Inserts a task document (e.g., as returned by Drone.assimilate()) into the database.
         Handles putting DOS and band structure into GridFS as needed.
@@ -75,76 +159,289 @@ class VaspCalcDb(CalcDb):
         Args:
             task_doc: (dict) the task document
             use_gridfs (bool) use gridfs for  bandstructures and DOS
+            volumetric_dtype (str): "float64" or "float32", the dtype CHGCAR and AECCAR data is
+                stored with (see atomate.vasp.volumetric)
+            quantize (int): if set (8 or 16 bits), store the CHGCAR and AECCAR data lossily as
+                quantized unsigned integers
         Returns:
             (int) - task_id of inserted document
         """
-        dos = None
-        bs = None
-        chgcar = None
-        aeccar0 = None
+        return self.insert_tasks([task_doc], use_gridfs=use_gridfs,
+                                 volumetric_dtype=volumetric_dtype, quantize=quantize)[0]
 
+    def insert_tasks(self, task_docs, use_gridfs=False, update_duplicates=True, ordered=True,
+                     volumetric_dtype="float64", quantize=None):
+        """
+        Inserts task documents into the database. Duplicates are found with a single query, new
+        task_ids are reserved in one block, the DOS, band structure and charge densities are
+        written to GridFS (if use_gridfs) and the task documents, including the GridFS ids, are
+        written in a single bulk write.
+
+        Args:
+            task_docs ([dict]): the task documents
+            use_gridfs (bool) use gridfs for  bandstructures and DOS
+            update_duplicates (bool): whether to update documents with the same dir_name
+            ordered (bool): whether the bulk write is ordered
+            volumetric_dtype (str): "float64" or "float32", the dtype CHGCAR and AECCAR data is
+                stored with (see atomate.vasp.volumetric)
+            quantize (int): if set (8 or 16 bits), store the CHGCAR and AECCAR data lossily as
+                quantized unsigned integers
+        Returns:
+            ([int]) - task_ids of the inserted documents, None for skipped duplicates
+        """
         # move dos BS and CHGCAR from doc to gridfs
-        if use_gridfs and "calcs_reversed" in task_doc:
-
-            if "dos" in task_doc["calcs_reversed"][0]:  # only store idx=0 (last step)
-                dos = json.dumps(task_doc["calcs_reversed"][0]["dos"], cls=MontyEncoder)
-                del task_doc["calcs_reversed"][0]["dos"]
-
-            if "bandstructure" in task_doc["calcs_reversed"][0]:  # only store idx=0 (last step)
-                bs = json.dumps(task_doc["calcs_reversed"][0]["bandstructure"], cls=MontyEncoder)
-                del task_doc["calcs_reversed"][0]["bandstructure"]
-
-            if "chgcar" in task_doc["calcs_reversed"][0]:  # only store idx=0 DOS
-                chgcar = json.dumps(task_doc["calcs_reversed"][0]["chgcar"], cls=MontyEncoder)
-                del task_doc["calcs_reversed"][0]["chgcar"]
-
-            if "aeccar0" in task_doc["calcs_reversed"][0]:  # only store idx=0 DOS
-                aeccar0 = task_doc["calcs_reversed"][0]["aeccar0"]
-                aeccar0 = json.dumps(task_doc["calcs_reversed"][0]["aeccar0"], cls=MontyEncoder)
-                del task_doc["calcs_reversed"][0]["aeccar0"]
-                try:
-                    # aeccar2 should also be in the task_doc
-                    aeccar2 = json.dumps(task_doc["calcs_reversed"][0]["aeccar2"], cls=MontyEncoder)
-                except:
-                    raise KeyError('aeccar2 data is missing from task_doc')
-                del task_doc["calcs_reversed"][0]["aeccar2"]
-
-        # insert the task document
-        t_id = self.insert(task_doc)
-
-        # insert the dos into gridfs and update the task document
-        if dos:
-            dos_gfs_id, compression_type = self.insert_gridfs(dos, "dos_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.dos_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.dos_fs_id": dos_gfs_id}})
-
-        # insert the bandstructure into gridfs and update the task documents
-        if bs:
-            bfs_gfs_id, compression_type = self.insert_gridfs(bs, "bandstructure_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.bandstructure_compression": compression_type}})
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.bandstructure_fs_id": bfs_gfs_id}})
-
-        # insert the CHGCAR file into gridfs and update the task documents
-        if chgcar:
-            chgcar_gfs_id, compression_type = self.insert_gridfs(chgcar, "chgcar_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.chgcar_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.chgcar_fs_id": chgcar_gfs_id}})
-
-        # insert the AECCARs file into gridfs and update the task documents
-        if aeccar0:
-            aeccar0_gfs_id, compression_type = self.insert_gridfs(aeccar0, "aeccar0_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar0_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar0_fs_id": aeccar0_gfs_id}})
-            aeccar2_gfs_id, compression_type = self.insert_gridfs(aeccar2, "aeccar2_fs", task_id=t_id)
-            self.collection.update_one(
-                {"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar2_compression": compression_type}})
-            self.collection.update_one({"task_id": t_id}, {"$set": {"calcs_reversed.0.aeccar2_fs_id": aeccar2_gfs_id}})
-        return t_id
+        payloads = [self._pop_gridfs_payloads(d) if use_gridfs else {} for d in task_docs]
+
+        task_ids = self.assign_task_ids(task_docs, update_duplicates=update_duplicates)
+        replaced = self._get_gridfs_ids([d["dir_name"] for d, t_id in zip(task_docs, task_ids)
+                                         if t_id is not None])
+
+        # the GridFS references taken by each document written
+        new_refs = {}
+        for task_doc, t_id, payload in zip(task_docs, task_ids, payloads):
+            if t_id is None:
+                continue
+            for key, data in payload.items():
+                if key in ("chgcar", "aeccar0", "aeccar2"):
+                    fs_id, compression_type = self.insert_volumetric(
+                        data, "{}_fs".format(key), task_id=t_id, dtype=volumetric_dtype,
+                        quantize=quantize)
+                else:
+                    fs_id, compression_type = self.insert_gridfs(
+                        json.dumps(data, cls=MontyEncoder), "{}_fs".format(key), task_id=t_id)
+                task_doc["calcs_reversed"][0]["{}_compression".format(key)] = compression_type
+                task_doc["calcs_reversed"][0]["{}_fs_id".format(key)] = fs_id
+                new_refs.setdefault(t_id, []).append(("{}_fs".format(key), fs_id))
+
+        inserted = [d for d, t_id in zip(task_docs, task_ids) if t_id is not None]
+        try:
+            self.bulk_upsert(inserted, ordered=ordered)
+        except BulkWriteError as e:
+            # release the references of the documents that were not written. An ordered bulk
+            # write stops at the first error. (After other errors it is not known which
+            # documents were written, the references they may leak are garbage collected.)
+            failed = sorted(err["index"] for err in e.details["writeErrors"])
+            if ordered and failed:
+                failed = range(failed[0], len(inserted))
+            for i in failed:
+                for collection, fs_id in new_refs.get(inserted[i]["task_id"], []):
+                    self.release_gridfs(fs_id, collection)
+            raise
+        # the GridFS files of the updated duplicates lose a reference
+        for collection, fs_id in replaced:
+            self.release_gridfs(fs_id, collection)
+        self._write_task_summaries(inserted)
+        return task_ids
+
+    def _get_gridfs_ids(self, dir_names):
+        """
+        Returns:
+            ([(str, ObjectId)]) the GridFS collections and file ids referenced by the tasks with
+                the given dir_names
+        """
+        keys = [k[:-len("_fs")] for k, (coll, field) in self.gridfs_references.items()
+                if coll == "{tasks}"]
+        fields = ["calcs_reversed.{}_fs_id".format(k) for k in keys]
+        ids = []
+        if not dir_names:
+            return ids
+        for d in self.collection.find({"dir_name": {"$in": dir_names}}, fields):
+            for calc in d.get("calcs_reversed", []):
+                ids.extend(("{}_fs".format(k), calc["{}_fs_id".format(k)]) for k in keys
+                           if "{}_fs_id".format(k) in calc)
+        return ids
+
+    @staticmethod
+    def get_task_summary(task_doc):
+        """
+        Compact summary of a task document, stored in the tasks_summary collection, with what
+        the analysis firetasks (equation of state, gibbs, thermal expansion, polarization) need:
+        the task_id, task_label, tags and formula, the final energy, structure, volume and
+        stress ("output"), the energy, structure, volume and force constants of the first
+        calculation ("first_calc_output", what the equation of state, gibbs and thermal
+        expansion analyses use), the polarization data of the last calculation when present,
+        and the GridFS ids of the last calculation.
+
+        Args:
+            task_doc (dict): the task document
+
+        Returns:
+            (dict) the summary
+        """
+        summary = {k: task_doc[k] for k in ("task_id", "task_label", "tags", "formula_pretty",
+                                            "dir_name", "state", "last_updated")
+                   if k in task_doc}
+        output = task_doc.get("output", {})
+        summary["output"] = {k: output.get(k) for k in ("energy", "energy_per_atom", "structure",
+                                                        "stress")}
+        if output.get("structure"):
+            summary["output"]["volume"] = output["structure"]["lattice"].get("volume")
+        calcs = task_doc.get("calcs_reversed") or [{}]
+        first_output = calcs[-1].get("output", {})
+        summary["first_calc_output"] = {k: first_output.get(k) for k in ("energy", "structure")}
+        if first_output.get("structure"):
+            summary["first_calc_output"]["volume"] = \
+                first_output["structure"]["lattice"].get("volume")
+        if first_output.get("force_constants") is not None:
+            summary["first_calc_output"]["force_constants"] = first_output["force_constants"]
+        calc = calcs[0]
+        outcar = calc.get("output", {}).get("outcar") or {}
+        if outcar.get("p_elec") is not None:
+            summary["polarization"] = {k: outcar.get(k) for k in ("p_elec", "p_ion", "zval_dict")}
+            summary["polarization"]["input_structure"] = calc["input"]["structure"]
+        for k in calc:
+            if k.endswith("_fs_id"):
+                summary[k] = calc[k]
+        return summary
+
+    def _write_task_summaries(self, task_docs):
+        requests = [ReplaceOne({"task_id": d["task_id"]},
+                               jsanitize(self.get_task_summary(d), allow_bson=True), upsert=True)
+                    for d in task_docs]
+        if requests:
+            self.summary_collection.bulk_write(requests, ordered=False)
+
+    def update_task_summaries(self, criteria=None, batch_size=100):
+        """
+        (Re)build the task summaries of the task documents matching the criteria, e.g. for
+        tasks inserted before the summaries were introduced.
+
+        Args:
+            criteria (dict): query on the tasks collection. Default: all tasks
+            batch_size (int): number of task documents processed at a time
+        """
+        batch = []
+        for d in self.collection.find(criteria or {}):
+            batch.append(d)
+            if len(batch) >= batch_size:
+                self._write_task_summaries(batch)
+                batch = []
+        self._write_task_summaries(batch)
+
+    def find_task_summaries(self, criteria, projection=None, batch_size=1000):
+        """
+        Query the task summaries (see get_task_summary). The summaries of the tasks matching
+        the criteria, and of the summaries matching them, are brought up to date first: missing
+        summaries (e.g. of tasks written directly to the tasks collection) are built, summaries
+        whose last_updated differs from their task's (tasks updated in place) are rebuilt and
+        summaries of deleted tasks are removed.
+
+        Args:
+            criteria (dict): query, on fields present in both the tasks and the summaries, e.g.
+                task_label, tags, formula_pretty
+            projection (dict or list): fields of the summaries to return
+            batch_size (int): number of task_ids checked at a time
+
+        Returns:
+            pymongo cursor over the summaries
+        """
+        for collection in (self.collection, self.summary_collection):
+            batch = []
+            for d in collection.find(criteria, ["task_id"]):
+                batch.append(d["task_id"])
+                if len(batch) >= batch_size:
+                    self._refresh_task_summaries(batch)
+                    batch = []
+            self._refresh_task_summaries(batch)
+        return self.summary_collection.find(criteria, projection)
+
+    def _refresh_task_summaries(self, task_ids):
+        """
+        Build the missing or outdated summaries of the tasks with the given task_ids, and
+        remove those of tasks that no longer exist.
+        """
+        if not task_ids:
+            return
+        q = {"task_id": {"$in": task_ids}}
+        tasks = {d["task_id"]: d.get("last_updated")
+                 for d in self.collection.find(q, ["task_id", "last_updated"])}
+        summaries = {d["task_id"]: d.get("last_updated")
+                     for d in self.summary_collection.find(q, ["task_id", "last_updated"])}
+        stale = [t_id for t_id, last_updated in tasks.items()
+                 if t_id not in summaries or summaries[t_id] != last_updated]
+        if stale:
+            self.update_task_summaries({"task_id": {"$in": stale}})
+        deleted = [t_id for t_id in summaries if t_id not in tasks]
+        if deleted:
+            self.summary_collection.delete_many({"task_id": {"$in": deleted}})
+
+    @staticmethod
+    def _pop_gridfs_payloads(task_doc):
+        """
+        Remove the DOS, band structure and charge densities of the last calculation from the
+        task document.
+
+        Returns:
+            (dict) {key: data}, e.g. {"dos": CompleteDos dict}
+        """
+        payloads = {}
+        if "calcs_reversed" not in task_doc:
+            return payloads
+        calc = task_doc["calcs_reversed"][0]  # only store idx=0 (last step)
+        for key in ("dos", "bandstructure", "chgcar", "aeccar0"):
+            if key in calc:
+                payloads[key] = calc.pop(key)
+        if "aeccar0" in payloads:
+            # aeccar2 should also be in the task_doc
+            if "aeccar2" not in calc:
+                raise KeyError('aeccar2 data is missing from task_doc')
+            payloads["aeccar2"] = calc.pop("aeccar2")
+        return payloads
+
+    def ingest(self, assimilated, use_gridfs=False, batch_size=100):
+        """
+        Insert task documents into the database as they are produced, e.g. by
+        VaspDrone.assimilate_many. Documents are inserted in batches, and failed directories
+        (parsing or insertion) are collected into a report instead of aborting the ingestion.
+
+        Args:
+            assimilated (iterable): (path, task_doc, error) tuples. task_doc is None and error is
+                the formatted traceback if the directory could not be parsed.
+            use_gridfs (bool): use gridfs for bandstructures, DOS and charge densities
+            batch_size (int): number of task documents to insert at a time
+
+        Returns:
+            (dict) report with the inserted task_ids ("inserted": {path: task_id}) and the
+                errors ("failed": {path: traceback})
+        """
+        report = {"inserted": {}, "failed": {}}
+        batch = []
+        for path, task_doc, error in assimilated:
+            if task_doc is None:
+                logger.error("Failed to parse {}".format(path))
+                report["failed"][path] = error
+                continue
+            batch.append((path, task_doc))
+            if len(batch) >= batch_size:
+                self._ingest_batch(batch, use_gridfs, report)
+                batch = []
+        if batch:
+            self._ingest_batch(batch, use_gridfs, report)
+        logger.info("Ingested {} task documents, {} failed".format(len(report["inserted"]),
+                                                                 len(report["failed"])))
+        return report
+
+    def _ingest_batch(self, batch, use_gridfs, report):
+        try:
+            task_ids = self.insert_tasks([task_doc for path, task_doc in batch],
+                                         use_gridfs=use_gridfs, ordered=False)
+        except BulkWriteError as e:
+            # the other documents of the batch are written
+            failed = {err["index"]: err.get("errmsg") for err in e.details["writeErrors"]}
+            for i, (path, task_doc) in enumerate(batch):
+                if i in failed:
+                    logger.error("Failed to insert {}".format(path))
+                    report["failed"][path] = failed[i]
+                else:
+                    report["inserted"][path] = task_doc["task_id"]
+        except Exception:
+            tb = traceback.format_exc()
+            for path, task_doc in batch:
+                logger.error("Failed to insert {}".format(path))
+                report["failed"][path] = tb
+        else:
+            for (path, task_doc), t_id in zip(batch, task_ids):
+                report["inserted"][path] = t_id
 
     def retrieve_task(self, task_id):
         """
@@ -170,6 +467,148 @@ class VaspCalcDb(CalcDb):
             calc["chgcar"] = chgcar
         return task_doc
 
+    def retrieve_tasks(self, task_ids, include=("bandstructure", "dos", "chgcar"), workers=8,
+                       batch_size=100):
+        """
+        Retrieves task documents and unpacks their GridFS objects, like retrieve_task, for many
+        tasks. The task documents are queried in batches, and the GridFS files of each batch are
+        fetched, decompressed and decoded concurrently in a thread pool (the network reads and the
+        decompression release the GIL).
+
+        Args:
+            task_ids ([int]): task_ids to retrieve
+            include ([str]): GridFS objects to unpack, from "bandstructure", "dos", "chgcar",
+                "aeccar0" and "aeccar2". The band structure and DOS are unpacked as dicts, the
+                charge densities as Chgcar objects.
+            workers (int): number of threads
+            batch_size (int): number of task documents queried at a time
+
+        Yields:
+            (dict) task documents, in the order of task_ids. Missing task_ids are skipped.
+        """
+        task_ids = list(task_ids)
+        pool = ThreadPool(workers)
+        try:
+            for i in range(0, len(task_ids), batch_size):
+                batch = task_ids[i:i + batch_size]
+                docs = {d["task_id"]: d for d in
+                        self.collection.find({"task_id": {"$in": batch}})}
+                jobs = [(docs[t_id]["calcs_reversed"][0], key) for t_id in docs for key in include
+                        if "{}_fs_id".format(key) in docs[t_id]["calcs_reversed"][0]]
+                objects = pool.map(self._retrieve_gridfs_object, jobs)
+                for (calc, key), obj in zip(jobs, objects):
+                    calc[key] = obj
+                for t_id in batch:
+                    if t_id in docs:
+                        yield docs[t_id]
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _retrieve_gridfs_object(self, job):
+        calc, key = job
+        fs_id = calc["{}_fs_id".format(key)]
+        collection = "{}_fs".format(key)
+        if key in ("chgcar", "aeccar0", "aeccar2"):
+            return self.get_volumetric(fs_id, collection)
+        return self.get_gridfs_dict(fs_id, collection)
+
+    def _put_gridfs(self, data, collection, metadata, oid=None):
+        """
+        Store data in GridFS, addressed by content: if a file with the same data and metadata
+        (task_id excepted) is stored, its reference count is incremented and its id returned.
+        The time of the last reference is recorded in metadata.last_referenced, so that
+        collect_gridfs_garbage keeps the files that were just re-used.
+
+        Args:
+            data (bytes): the (compressed) data
+            collection (string): the GridFS collection name
+            metadata (dict): the file metadata
+            oid (ObjectId()): the _id of the file; if specified, the data is stored under this
+                id without looking for an identical file
+
+        Returns:
+            file id
+        """
+        content_hash = hashlib.sha256(data)
+        content_hash.update(json.dumps({k: v for k, v in metadata.items() if k != "task_id"},
+                                       sort_keys=True, default=str).encode())
+        content_hash = content_hash.hexdigest()
+        now = datetime.utcnow()
+        if oid is None:
+            f = self.db[collection].files.find_one_and_update(
+                {"metadata.content_hash": content_hash, "metadata.refcount": {"$gt": 0}},
+                {"$inc": {"metadata.refcount": 1}, "$set": {"metadata.last_referenced": now}},
+                projection={"_id": 1})
+            if f:
+                return f["_id"]
+        metadata = dict(metadata, content_hash=content_hash, refcount=1, last_referenced=now)
+        return gridfs.GridFS(self.db, collection).put(data, _id=oid or ObjectId(),
+                                                      metadata=metadata)
+
+    def release_gridfs(self, fs_id, collection):
+        """
+        Remove a reference to a GridFS file, and the file when it is no longer referenced.
+
+        Args:
+            fs_id (ObjectId): the GridFS file id
+            collection (string): the GridFS collection name
+        """
+        files = self.db[collection].files
+        f = files.find_one_and_update({"_id": fs_id}, {"$inc": {"metadata.refcount": -1}},
+                                      projection={"metadata.refcount": 1},
+                                      return_document=ReturnDocument.AFTER)
+        if f and f["metadata"]["refcount"] <= 0:
+            # files revived in the meantime by _put_gridfs are kept
+            if files.delete_one({"_id": fs_id, "metadata.refcount": {"$lte": 0}}).deleted_count:
+                self.db[collection].chunks.delete_many({"files_id": fs_id})
+
+    def collect_gridfs_garbage(self, collections=None, grace_period=3600, dry_run=False,
+                               batch_size=1000):
+        """
+        Remove the GridFS files that are not referenced by any document (see
+        gridfs_references), e.g. the files of task documents that were updated or deleted.
+
+        Args:
+            collections ([str]): GridFS collections to clean up. Default: all of
+                gridfs_references
+            grace_period (float): files uploaded or re-used (see _put_gridfs) less than this many
+                seconds ago are kept, as their documents may not be written yet
+            dry_run (bool): only count the unreferenced files
+            batch_size (int): number of files deleted at a time
+
+        Returns:
+            (dict) {GridFS collection: number of unreferenced files}
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=grace_period)
+        # files written before last_referenced was recorded fall back to the upload date
+        expired = {"$or": [{"metadata.last_referenced": {"$lte": cutoff}},
+                           {"metadata.last_referenced": {"$exists": False},
+                            "uploadDate": {"$lte": cutoff}}]}
+        report = {}
+        for fs_collection in collections or sorted(self.gridfs_references):
+            coll, field = self.gridfs_references[fs_collection]
+            coll = self.db[coll.format(tasks=self.collection.name)]
+            referenced = set()
+            for d in coll.find({field: {"$exists": True}}, [field]):
+                referenced.update(_get_path_values(d, field.split(".")))
+
+            files = self.db[fs_collection].files
+            orphans = [f["_id"] for f in files.find(expired, ["_id"])
+                       if f["_id"] not in referenced]
+            report[fs_collection] = len(orphans)
+            logger.info("{} unreferenced files in {}".format(len(orphans), fs_collection))
+            if dry_run:
+                continue
+            for i in range(0, len(orphans), batch_size):
+                batch = orphans[i:i + batch_size]
+                # the files re-used since they were listed are kept
+                files.delete_many(dict(expired, _id={"$in": batch}))
+                kept = set(f["_id"] for f in files.find({"_id": {"$in": batch}}, ["_id"]))
+                self.db[fs_collection].chunks.delete_many(
+                    {"files_id": {"$in": [fs_id for fs_id in batch if fs_id not in kept]}})
+        return report
+
     def insert_gridfs(self, d, collection="fs", compress=True, oid=None, task_id=None):
         """
         Insert the given document into GridFS.
@@ -177,71 +616,194 @@ class VaspCalcDb(CalcDb):
         Args:
             d (dict): the document
             collection (string): the GridFS collection name
-            compress (bool): Whether to compress the data or not
+            compress (bool or str): True to compress with the codec of the collection (see
+                gridfs_codecs), False for no compression, or a codec name, e.g. "lzma-6"
             oid (ObjectId()): the _id of the file; if specified, it must not already exist in GridFS
-            task_id(int or str): the task_id to store into the gridfs metadata
+            task_id(int or str): the task_id to store into the gridfs metadata. If the same
+                content is already stored, the existing file (and its task_id) is reused.
         Returns:
             file id, the type of compression used.
         """
-        oid = oid or ObjectId()
-        compression_type = None
-
-        if compress:
-            d = zlib.compress(d.encode(), compress)
-            compression_type = "zlib"
+        if compress is True:
+            codec = self.gridfs_codecs.get(collection, "zlib")
+        else:
+            codec = compress or None
+        compression_type = compression.parse_codec(codec)[0] if codec else None
+        d = compression.compress(d.encode(), codec)
 
-        fs = gridfs.GridFS(self.db, collection)
+        # the family is enough to decompress, the codec also records the level
+        metadata = {"compression": compression_type, "codec": codec}
         if task_id:
             # Putting task id in the metadata subdocument as per mongo specs:
             # https://github.com/mongodb/specifications/blob/master/source/gridfs/gridfs-spec.rst#terms
-            fs_id = fs.put(d, _id=oid, metadata={"task_id": task_id, "compression": compression_type})
-        else:
-            fs_id = fs.put(d, _id=oid, metadata={"compression": compression_type})
+            metadata["task_id"] = task_id
+        fs_id = self._put_gridfs(d, collection, metadata, oid=oid)
+
+        return fs_id, compression_type
+
+    def get_gridfs_dict(self, fs_id, collection):
+        """
+        Read a json document inserted with insert_gridfs, decompressed with the codec recorded
+        in the file metadata.
+
+        Args:
+            fs_id (ObjectId): the GridFS file id
+            collection (string): the GridFS collection name
+        Returns:
+            (dict) the document
+        """
+        return self._read_gridfs_dict(fs_id, collection)[0]
+
+    def _read_gridfs_dict(self, fs_id, collection):
+        # returns the document and the size of its json encoding, as an estimate of its size
+        f = gridfs.GridFS(self.db, collection).get(fs_id)
+        codec = (f.metadata or {}).get("compression", "zlib")
+        data = compression.decompress(f.read(), codec)
+        return json.loads(data.decode()), len(data)
+
+    def _get_cached(self, fs_id, collection, load):
+        """
+        Get a decoded GridFS object from the object cache, or load and cache it.
+
+        Args:
+            fs_id (ObjectId): the GridFS file id
+            collection (string): the GridFS collection name
+            load (callable): load() -> (object, estimated size in bytes)
+        Returns:
+            the object
+        """
+        if self.object_cache is None:
+            return load()[0]
+        key = (collection, fs_id)
+        found, obj = self.object_cache.get(key)
+        if not found:
+            obj, size = load()
+            self.object_cache.put(key, obj, size)
+        return obj
+
+    def cache_info(self):
+        """
+        Returns:
+            (dict) hits, misses, entries, size and max_size of the object cache, None if the
+                cache is disabled
+        """
+        return self.object_cache.info() if self.object_cache is not None else None
 
+    def clear_cache(self):
+        if self.object_cache is not None:
+            self.object_cache.clear()
+
+    def insert_volumetric(self, vdata, collection, task_id=None, dtype="float64", quantize=None,
+                          codec=None):
+        """
+        Insert volumetric data (e.g. a Chgcar object) into GridFS in the binary volumetric
+        format of atomate.vasp.volumetric. The header is stored as the file metadata.
+
+        Args:
+            vdata (VolumetricData): the volumetric data
+            collection (string): the GridFS collection name
+            task_id(int or str): the task_id to store into the gridfs metadata
+            dtype (str): "float64" or "float32"
+            quantize (int): if set (8 or 16), store the data lossily as quantized unsigned
+                integers with this many bits
+            codec (str): compression codec. Default: the codec of the collection (see
+                gridfs_codecs)
+        Returns:
+            file id, the type of compression used.
+        """
+        codec = codec or self.gridfs_codecs.get(collection, "zlib")
+        data, metadata = volumetric_to_bytes(vdata, dtype=dtype, quantize=quantize, codec=codec)
+        compression_type = compression.parse_codec(codec)[0]
+        metadata["compression"] = compression_type
+        if task_id:
+            metadata["task_id"] = task_id
+        fs_id = self._put_gridfs(data, collection, metadata)
         return fs_id, compression_type
 
+    def get_volumetric(self, fs_id, collection, components=None, subgrid=None):
+        """
+        Read volumetric data from GridFS. Files written by insert_volumetric are read
+        slab-by-slab, so only the parts covering the requested components and sub-grid are
+        downloaded. Older files (compressed json) are decoded in full.
+
+        Args:
+            fs_id (ObjectId): the GridFS file id
+            collection (string): the GridFS collection name
+            components (list): components to read, e.g. ["total"]. Default: all
+            subgrid (list): [(x0, x1), (y0, y1), (z0, z1)] half-open index ranges of the grid
+                points to read. Default: the full grid
+        Returns:
+            Chgcar object if neither components nor subgrid is given, otherwise a dict
+                {component: numpy array}
+        """
+        if not (components or subgrid):
+            return self._get_cached(fs_id, collection,
+                                    lambda: self._load_volumetric(fs_id, collection))
+        return self._load_volumetric(fs_id, collection, components, subgrid)[0]
+
+    def _load_volumetric(self, fs_id, collection, components=None, subgrid=None):
+        # returns the volumetric data and the size of its grids in bytes
+        fs = gridfs.GridFS(self.db, collection)
+        f = fs.get(fs_id)
+        metadata = f.metadata or {}
+        if metadata.get("format") == VOLUMETRIC_FORMAT:
+            vdata = volumetric_from_file(f, metadata, components=components, subgrid=subgrid)
+        else:
+            vdata = json.loads(compression.decompress(f.read(),
+                                                      metadata.get("compression", "zlib")),
+                               cls=MontyDecoder)
+            if components or subgrid:
+                (x0, x1), (y0, y1), (z0, z1) = subgrid or [(0, n) for n in vdata.dim]
+                vdata = {c: vdata.data[c][x0:x1, y0:y1, z0:z1]
+                         for c in components or vdata.data}
+        arrays = vdata if isinstance(vdata, dict) else vdata.data
+        return vdata, sum(arr.nbytes for arr in arrays.values())
+
     def get_band_structure(self, task_id):
         m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
         fs_id = m_task['calcs_reversed'][0]['bandstructure_fs_id']
-        fs = gridfs.GridFS(self.db, 'bandstructure_fs')
-        bs_json = zlib.decompress(fs.get(fs_id).read())
-        bs_dict = json.loads(bs_json.decode())
+        return self._get_cached(fs_id, 'bandstructure_fs',
+                                lambda: self._load_band_structure(fs_id))
+
+    def _load_band_structure(self, fs_id):
+        bs_dict, size = self._read_gridfs_dict(fs_id, 'bandstructure_fs')
         if bs_dict["@class"] == "BandStructure":
-            return BandStructure.from_dict(bs_dict)
+            return BandStructure.from_dict(bs_dict), size
         elif bs_dict["@class"] == "BandStructureSymmLine":
-            return BandStructureSymmLine.from_dict(bs_dict)
+            return BandStructureSymmLine.from_dict(bs_dict), size
         else:
             raise ValueError("Unknown class for band structure! {}".format(bs_dict["@class"]))
 
     def get_dos(self, task_id):
         m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
         fs_id = m_task['calcs_reversed'][0]['dos_fs_id']
-        fs = gridfs.GridFS(self.db, 'dos_fs')
-        dos_json = zlib.decompress(fs.get(fs_id).read())
-        dos_dict = json.loads(dos_json.decode())
-        return CompleteDos.from_dict(dos_dict)
+        return self._get_cached(fs_id, 'dos_fs', lambda: self._load_dos(fs_id))
+
+    def _load_dos(self, fs_id):
+        dos_dict, size = self._read_gridfs_dict(fs_id, 'dos_fs')
+        return CompleteDos.from_dict(dos_dict), size
 
     def get_chgcar_string(self, task_id):
         # Not really used now, consier deleting
         m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
         fs_id = m_task['calcs_reversed'][0]['chgcar_fs_id']
-        fs = gridfs.GridFS(self.db, 'chgcar_fs')
-        return zlib.decompress(fs.get(fs_id).read())
+        f = gridfs.GridFS(self.db, 'chgcar_fs').get(fs_id)
+        return compression.decompress(f.read(), (f.metadata or {}).get("compression", "zlib"))
 
-    def get_chgcar(self, task_id):
+    def get_chgcar(self, task_id, components=None, subgrid=None):
         """
         Read the CHGCAR grid_fs data into a Chgcar object
         Args:
             task_id(int or str): the task_id containing the gridfs metadata
+            components (list): only read these components, e.g. ["diff"]
+            subgrid (list): only read this sub-grid, [(x0, x1), (y0, y1), (z0, z1)]
         Returns:
-            chgcar: Chgcar object
+            chgcar: Chgcar object, or a dict {component: numpy array} if components or subgrid
+                is given
         """
         m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
         fs_id = m_task['calcs_reversed'][0]['chgcar_fs_id']
-        fs = gridfs.GridFS(self.db, 'chgcar_fs')
-        chgcar_json = zlib.decompress(fs.get(fs_id).read())
-        chgcar= json.loads(chgcar_json, cls=MontyDecoder)
-        return chgcar
+        return self.get_volumetric(fs_id, 'chgcar_fs', components=components, subgrid=subgrid)
 
     def get_aeccar(self, task_id):
         """
@@ -252,14 +814,8 @@ class VaspCalcDb(CalcDb):
             (aeccar0, aeccar2): Chgcar objects
         """
         m_task = self.collection.find_one({"task_id": task_id}, {"calcs_reversed": 1})
-        fs_id = m_task['calcs_reversed'][0]['aeccar0_fs_id']
-        fs = gridfs.GridFS(self.db, 'aeccar0_fs')
-        aeccar_json = zlib.decompress(fs.get(fs_id).read())
-        aeccar0 = json.loads(aeccar_json, cls=MontyDecoder)
-        fs_id = m_task['calcs_reversed'][0]['aeccar2_fs_id']
-        fs = gridfs.GridFS(self.db, 'aeccar2_fs')
-        aeccar_json = zlib.decompress(fs.get(fs_id).read())
-        aeccar2 = json.loads(aeccar_json, cls=MontyDecoder)
+        aeccar0 = self.get_volumetric(m_task['calcs_reversed'][0]['aeccar0_fs_id'], 'aeccar0_fs')
+        aeccar2 = self.get_volumetric(m_task['calcs_reversed'][0]['aeccar2_fs_id'], 'aeccar2_fs')
 
         return {'aeccar0': aeccar0, 'aeccar2': aeccar2}
 
@@ -267,14 +823,29 @@ class VaspCalcDb(CalcDb):
         self.collection.delete_many({})
         self.db.counter.delete_one({"_id": "taskid"})
         self.db.counter.insert_one({"_id": "taskid", "c": 0})
+        self.task_id_allocator.reset()
+        self.clear_cache()
+        self.summary_collection.delete_many({})
         self.db.boltztrap.delete_many({})
-        self.db.dos_fs.files.delete_many({})
-        self.db.dos_fs.chunks.delete_many({})
-        self.db.dos_boltztrap_fs.files.delete_many({})
-        self.db.dos_boltztrap_fs.chunks.delete_many({})
-        self.db.bandstructure_fs.files.delete_many({})
-        self.db.bandstructure_fs.chunks.delete_many({})
+        for fs_collection in self.gridfs_references:
+            self.db[fs_collection].files.delete_many({})
+            self.db[fs_collection].chunks.delete_many({})
         self.build_indexes()
 
 
+def _get_path_values(d, path):
+    """
+    Returns:
+        ([object]) the values of the dotted path (split into a list) in the document, following
+            arrays like a MongoDB query
+    """
+    if isinstance(d, list):
+        return [v for item in d for v in _get_path_values(item, path)]
+    if not path:
+        return [d]
+    if not isinstance(d, dict) or path[0] not in d:
+        return []
+    return _get_path_values(d[path[0]], path[1:])
+
+
 # TODO: @albalu, @matk86, @computron - add BoltztrapCalcDB management here -computron, matk86
@@ -14,8 +14,14 @@ import datetime
 from fnmatch import fnmatch
 from collections import OrderedDict
 import json
-import glob
 import traceback
+import multiprocessing
+import tempfile
+import hashlib
+import gzip
+import xml.etree.ElementTree as ET
+
+from six.moves import cPickle as pickle
 
 from monty.io import zopen
 from monty.json import jsanitize
@@ -25,15 +31,13 @@ import numpy as np
 
 from pymatgen.core.composition import Composition
 from pymatgen.core.structure import Structure
-from pymatgen.core.operations import SymmOp
 from pymatgen.electronic_structure.bandstructure import BandStructureSymmLine
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.io.vasp import BSVasprun, Vasprun, Outcar, Locpot, Chgcar
+from pymatgen.io.vasp import BSVasprun, Vasprun, Outcar, Chgcar
 from pymatgen.io.vasp.inputs import Poscar, Potcar, Incar, Kpoints
 from pymatgen.apps.borg.hive import AbstractDrone
 from pymatgen.command_line.bader_caller import bader_analysis_from_path
 
-from atomate.utils.utils import get_uri
+from atomate.utils.utils import get_uri, get_symmetry_info
 
 from atomate.utils.utils import get_logger
 from atomate import __version__ as atomate_version
@@ -47,6 +51,330 @@ logger = get_logger(__name__)
 
 bader_exe_exists = which("bader") or which("bader.exe")
 
+
+def read_vasprun_incar(vasprun_file):
+    """
+    Read only the <incar> block of a vasprun.xml file. The block is at the top of the file, so
+    this is cheap even for very large vasprun files.
+
+    Args:
+        vasprun_file (str): path to the (possibly gzipped) vasprun.xml file
+
+    Returns:
+        (dict) the INCAR tags, with integer and logical values converted
+    """
+    incar = {}
+    in_incar = False
+    with zopen(vasprun_file, "rb") as f:
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if elem.tag == "incar":
+                if event == "end":
+                    break
+                in_incar = True
+            elif in_incar and event == "end" and elem.tag == "i":
+                val = (elem.text or "").strip()
+                if elem.attrib.get("type") == "int":
+                    val = int(val)
+                elif elem.attrib.get("type") == "logical":
+                    val = val.upper().startswith("T")
+                incar[elem.attrib["name"]] = val
+    return incar
+
+
+def filter_vasprun(vasprun_file, filtered_file, skip_pdos=False, skip_projected=False):
+    """
+    Stream a vasprun.xml file line by line into a new (uncompressed) file, leaving out the
+    sections that are not needed. The skipped sections are never held in memory, neither as
+    text nor as parsed xml, which matters for large LORBIT calculations.
+
+    Args:
+        vasprun_file (str): path to the (possibly gzipped) vasprun.xml file
+        filtered_file (str): path of the filtered vasprun.xml file to write
+        skip_pdos (bool): leave out the projected DOS (<partial> block of <dos>). The total DOS,
+            and thus the Fermi level, is kept.
+        skip_projected (bool): leave out the projected eigenvalues (<projected> block)
+    """
+    skip_tags = []
+    if skip_projected:
+        skip_tags.append("projected")
+    if skip_pdos:
+        skip_tags.append("partial")
+
+    skip_until = None
+    in_dos = False
+    with zopen(vasprun_file, "rt") as fin, open(filtered_file, "w") as fout:
+        for line in fin:
+            if skip_until:
+                if line.lstrip().startswith(skip_until):
+                    skip_until = None
+                continue
+            m = re.match(r"\s*<(/?)(\w+)[\s>]", line)
+            if m:
+                tag = m.group(2)
+                if tag == "dos":
+                    in_dos = not m.group(1)
+                elif not m.group(1) and tag in skip_tags and (tag != "partial" or in_dos):
+                    if "</{}>".format(tag) not in line:
+                        skip_until = "</{}>".format(tag)
+                    continue
+            fout.write(line)
+
+
+class TaskDocCache(object):
+    """
+    A size-bounded on-disk cache of assimilated task documents. Each document is stored as a
+    gzipped pickle named after its key; when the total size of the cache exceeds max_size the
+    least recently used documents are evicted.
+    """
+
+    def __init__(self, cache_dir, max_size=1024 ** 3):
+        """
+        Args:
+            cache_dir (str): directory holding the cached documents. Created if needed.
+            max_size (int): maximum total size of the cached documents in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # created concurrently
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "{}.pkl.gz".format(key))
+
+    def get(self, key):
+        """
+        Returns the cached document for the key or None if it is not in the cache.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with gzip.open(path, "rb") as f:
+                d = pickle.load(f)
+            os.utime(path, None)  # mark as recently used
+            return d
+        except Exception:
+            logger.warning("Removing unreadable cache entry {}".format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, d):
+        """
+        Store the document under the key and evict the least recently used documents if the
+        cache got too large.
+        """
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            with gzip.open(tmp_path, "wb") as f:
+                pickle.dump(d, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except Exception:
+            logger.warning("Could not write cache entry {}".format(path))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used documents until the cache fits in max_size.
+        """
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(".pkl.gz"):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, f))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, f))
+        total_size = sum(e[1] for e in entries)
+        for mtime, size, f in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, f))
+                total_size -= size
+            except OSError:
+                pass
+
+
+def read_outcar_fields(outcar_file):
+    """
+    Read the OUTCAR sections that are used in the task doc (run_stats, magnetization, charge,
+    efermi, nelect, total_magnetization, is_stopped and drift) in a single pass over the file.
+    The values are the same as the corresponding keys of Outcar(outcar_file).as_dict(), which
+    reads the file many times to parse every section. The other keys of as_dict() are not
+    returned: "@module", "@class", ngf, sampling_radii and electrostatic_potential, and the
+    LEPSILON, DFPT, LCALCPOL and NMR sections. Only the collinear magnetization is read.
+
+    Args:
+        outcar_file (str): path to the (possibly gzipped) OUTCAR file
+
+    Returns:
+        (dict) the OUTCAR fields
+    """
+    time_patt = re.compile(r"\((sec|kb)\)")
+    efermi_patt = re.compile(r"E-fermi\s*:\s*(\S+)")
+    nelect_patt = re.compile(r"number of electron\s+(\S+)\s+magnetization")
+    mag_patt = re.compile(r"number of electron\s+\S+\s+magnetization\s+(\S+)")
+    drift_patt = re.compile(r"total drift:\s+([\.\-\d]+)\s+([\.\-\d]+)\s+([\.\-\d]+)")
+    row_patt = re.compile(r"\s*(\d+)\s+(([\d\.\-]+)\s+)+")
+
+    is_stopped = False
+    run_stats = {}
+    cores = None
+    efermi = None
+    nelect = None
+    total_mag = None
+    drift = []
+    charge = []
+    mag = []
+    header = []
+    table = None  # the table currently being read
+    with zopen(outcar_file, "rt") as f:
+        for line in f:
+            clean = line.strip()
+            if cores is None and "running" in line:
+                cores = line.split()[2]
+
+            # charge and magnetization tables; the last ones in the file are kept
+            if table is not None:
+                if clean.startswith("# of ion"):
+                    header = re.split(r"\s{2,}", clean)
+                    header.pop(0)
+                else:
+                    m = row_patt.match(clean)
+                    if m:
+                        toks = [float(i) for i in re.findall(r"[\d\.\-]+", clean)]
+                        toks.pop(0)
+                        table.append(dict(zip(header, toks)))
+                    elif clean.startswith("tot"):
+                        table = None
+            if clean == "total charge":
+                charge = []
+                table = charge
+            elif clean == "magnetization (x)":
+                mag = []
+                table = mag
+            elif clean in ("magnetization (y)", "magnetization (z)"):
+                table = []  # noncollinear components are not read
+            elif "electrostatic" in clean:
+                table = None
+
+            if clean.find("soft stop encountered!  aborting job") != -1:
+                is_stopped = True
+                continue
+            if time_patt.search(line):
+                tok = clean.split(":")
+                run_stats[tok[0].strip()] = float(tok[1].strip())
+                continue
+            m = efermi_patt.search(clean)
+            if m:
+                try:
+                    efermi = float(m.group(1))
+                except ValueError:
+                    # VASP sometimes prints 'E-fermi: ********'
+                    efermi = None
+                continue
+            m = nelect_patt.search(clean)
+            if m:
+                nelect = float(m.group(1))
+            m = mag_patt.search(clean)
+            if m:
+                total_mag = float(m.group(1))
+            m = drift_patt.search(line)
+            if m:
+                drift.append([float(i) for i in m.groups()])
+
+    # as in Outcar, 0 if the OUTCAR has no "running on" line
+    run_stats["cores"] = cores or 0
+    return {"efermi": efermi, "run_stats": run_stats, "magnetization": tuple(mag),
+            "charge": tuple(charge), "total_magnetization": total_mag, "nelect": nelect,
+            "is_stopped": is_stopped, "drift": drift}
+
+
+def read_locpot_axis_averages(locpot_file):
+    """
+    Axis averages of the (total) volumetric data in a LOCPOT file, equal to
+    {i: Locpot.from_file(locpot_file).get_average_along_axis(i) for i in range(3)}. The data is
+    read one xy-plane at a time and summed along each axis, so the full grid is never held in
+    memory.
+
+    Args:
+        locpot_file (str): path to the (possibly gzipped) LOCPOT file
+
+    Returns:
+        (dict) {axis index: numpy array of the average along that axis}
+    """
+    with zopen(locpot_file, "rt") as f:
+        # the structure block ends with the first blank line after the comment line
+        next(f)
+        for line in f:
+            if line.strip() == "":
+                break
+        for line in f:
+            if line.strip():
+                dim = [int(i) for i in line.split()]
+                break
+        nx, ny, nz = dim
+        plane_size = nx * ny
+        sums = [np.zeros(nx), np.zeros(ny), np.zeros(nz)]
+        tokens = []
+        iz = 0
+        # vasp writes x as the fastest index, followed by y then z
+        for line in f:
+            tokens.extend(line.split())
+            while len(tokens) >= plane_size and iz < nz:
+                plane = np.array(tokens[:plane_size], dtype=float).reshape(ny, nx)
+                del tokens[:plane_size]
+                sums[0] += plane.sum(axis=0)
+                sums[1] += plane.sum(axis=1)
+                sums[2][iz] = plane.sum()
+                iz += 1
+            if iz == nz:
+                break
+    return {i: sums[i] / dim[(i + 1) % 3] / dim[(i + 2) % 3] for i in range(3)}
+
+
+def _scandir(path):
+    """
+    Yields the (name, is_dir) of the entries in path from a single directory scan.
+    """
+    if hasattr(os, "scandir"):
+        for entry in list(os.scandir(path)):
+            yield entry.name, entry.is_dir()
+    else:
+        for name in os.listdir(path):
+            yield name, os.path.isdir(os.path.join(path, name))
+
+
+def _assimilate(drone, path):
+    try:
+        return path, drone.assimilate(path), None
+    except Exception:
+        return path, None, traceback.format_exc()
+
+
+_pool_drone = None
+
+
+def _init_pool_drone(drone):
+    global _pool_drone
+    _pool_drone = drone
+
+
+def _assimilate_in_pool(path):
+    return _assimilate(_pool_drone, path)
+
+
 class VaspDrone(AbstractDrone):
     """
     pymatgen-db VaspToDbTaskDrone with updated schema and documents processing methods.
@@ -83,7 +411,10 @@ class VaspDrone(AbstractDrone):
 
     def __init__(self, runs=None, parse_dos="auto", bandstructure_mode="auto",
                  parse_locpot=True, additional_fields=None, use_full_uri=True,
-                 parse_bader=bader_exe_exists, parse_chgcar=False, parse_aeccar=False):
+                 parse_bader=bader_exe_exists, parse_chgcar=False, parse_aeccar=False,
+                 single_parse=False, stream_vasprun=False, cache_dir=None,
+                 cache_size=1024 ** 3, selective_outcar=False, bader_workers=0,
+                 bader_final_only=False):
         """
         Initialize a Vasp drone to parse vasp outputs
         Args:
@@ -106,6 +437,32 @@ class VaspDrone(AbstractDrone):
             parse_bader (bool): Run and parse Bader charge data. Defaults to True if Bader is present
             parse_chgcar (bool): Run and parse CHGCAR file
             parse_aeccar (bool): Run and parse AECCAR0 and AECCAR2 files
+            single_parse (bool): Parse each vasprun.xml only once. The same Vasprun object and
+             band structure are then used for the task doc, the stored bandstructure and the
+             gap/vbm/cbm fields, instead of re-parsing the file with BSVasprun.
+            stream_vasprun (bool): Stream each vasprun.xml through a filter that drops the sections
+             which are not needed, i.e. the projected DOS unless the DOS is parsed (see parse_dos)
+             and the projected eigenvalues unless they are needed for the band structure (see
+             bandstructure_mode), before parsing it. This bounds the peak memory for large LORBIT
+             calculations. The band structure is then built from the same Vasprun object, as
+             with single_parse. The filtered copy is written to cache_dir if set, otherwise next
+             to the vasprun.xml (or to the temporary directory if that is not writable).
+            cache_dir (str): If set, assimilated task docs are cached in this directory, keyed by
+             the path, size and modification time of the output files and the drone settings and
+             version. Assimilating unchanged outputs again loads the cached doc instead of parsing.
+            cache_size (int): Maximum size of the cache in bytes. The least recently used docs are
+             evicted first.
+            selective_outcar (bool): Only parse the OUTCAR sections used in the task doc
+             (run_stats, magnetization, charge, efermi, nelect, total_magnetization, is_stopped and
+             drift) in a single pass, see read_outcar_fields. Runs with LEPSILON, LCALCPOL or
+             noncollinear magnetism are still parsed in full, since their piezo, polarization,
+             zval and magnetization data are needed. Otherwise the outcar of the docs lacks the
+             ngf, sampling_radii and electrostatic_potential keys (and "@module"/"@class"), as
+             well as the DFPT internal strain and NMR data, that the full parse stores.
+            bader_workers (int): If > 0, Bader analysis runs in a pool of this many processes,
+             started before the vasprun.xml and OUTCAR files are parsed and joined before the doc
+             is finalized. Default (0): Bader runs serially after parsing each run.
+            bader_final_only (bool): Only run Bader analysis on the final run.
         """
         self.parse_dos = parse_dos
         self.additional_fields = additional_fields or {}
@@ -117,6 +474,14 @@ class VaspDrone(AbstractDrone):
         self.parse_bader = parse_bader
         self.parse_chgcar = parse_chgcar
         self.parse_aeccar = parse_aeccar
+        self.single_parse = single_parse
+        self.stream_vasprun = stream_vasprun
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.selective_outcar = selective_outcar
+        self.bader_workers = bader_workers
+        self.bader_final_only = bader_final_only
+        self._dir_indexes = None  # directory indexes, only kept during assimilate
 
     def assimilate(self, path):
         """
@@ -132,15 +497,117 @@ class VaspDrone(AbstractDrone):
             (dict): a task dictionary
         """
         logger.info("Getting task doc for base dir :{}".format(path))
-        vasprun_files = self.filter_files(path, file_pattern="vasprun.xml")
-        outcar_files = self.filter_files(path, file_pattern="OUTCAR")
-        if len(vasprun_files) > 0 and len(outcar_files) > 0:
-            d = self.generate_doc(path, vasprun_files, outcar_files)
-            self.post_process(path, d)
-        else:
-            raise ValueError("No VASP files found!")
-        self.validate_doc(d)
-        return d
+        # the directory is scanned once and all file lookups are answered from its index
+        self._dir_indexes = {}
+        try:
+            cache = None
+            if self.cache_dir:
+                cache = TaskDocCache(self.cache_dir, self.cache_size)
+                cache_key = self.get_cache_key(path)
+                d = cache.get(cache_key)
+                if d is not None:
+                    logger.info("Loaded task doc for {} from cache".format(path))
+                    return d
+
+            vasprun_files = self.filter_files(path, file_pattern="vasprun.xml")
+            outcar_files = self.filter_files(path, file_pattern="OUTCAR")
+            if len(vasprun_files) > 0 and len(outcar_files) > 0:
+                d = self.generate_doc(path, vasprun_files, outcar_files)
+                self.post_process(path, d)
+            else:
+                raise ValueError("No VASP files found!")
+            self.validate_doc(d)
+            if cache:
+                cache.put(cache_key, d)
+            return d
+        finally:
+            self._dir_indexes = None
+
+    def get_dir_index(self, path):
+        """
+        Scan a directory and its run subfolders (see self.runs) and return the names of their
+        entries. While a directory is being assimilated, the index is built only once and
+        reused for all file lookups.
+
+        Args:
+            path (str): path to the folder
+
+        Returns:
+            (dict) the names of the entries in path (key "") and in each of its run subfolders
+                (key: run name)
+        """
+        fullpath = os.path.abspath(path)
+        if self._dir_indexes is not None and fullpath in self._dir_indexes:
+            return self._dir_indexes[fullpath]
+        index = {"": []}
+        for name, is_dir in _scandir(fullpath):
+            index[""].append(name)
+            if is_dir and name in self.runs:
+                index[name] = [sub_name for sub_name, _ in _scandir(os.path.join(fullpath, name))]
+        if self._dir_indexes is not None:
+            self._dir_indexes[fullpath] = index
+        return index
+
+    def get_cache_key(self, path):
+        """
+        Key of the task doc of a directory in the parse cache. The key changes whenever any
+        output file (in the directory or in its run subfolders) is added, removed or modified,
+        or the drone settings or version change.
+
+        Args:
+            path (str): Path to the directory containing vasprun.xml and OUTCAR files
+
+        Returns:
+            (str) the key
+        """
+        fullpath = os.path.abspath(path)
+        index = self.get_dir_index(fullpath)
+        files = []
+        for f in sorted(index[""]):
+            if f in index:
+                for sub_f in sorted(index[f]):
+                    st = os.stat(os.path.join(fullpath, f, sub_f))
+                    files.append([os.path.join(f, sub_f), st.st_size, st.st_mtime])
+            else:
+                st = os.stat(os.path.join(fullpath, f))
+                files.append([f, st.st_size, st.st_mtime])
+        drone = self.as_dict()
+        for k in ["cache_dir", "cache_size", "bader_workers"]:
+            drone["init_args"].pop(k, None)
+        key = {"dir_name": get_uri(path) if self.use_full_uri else fullpath,
+               "files": files, "drone": drone}
+        return hashlib.sha1(json.dumps(jsanitize(key), sort_keys=True).encode()).hexdigest()
+
+    def assimilate_many(self, paths, workers=1, chunksize=1):
+        """
+        Assimilate many directories, fanning the parsing out over a process pool. Results are
+        yielded as soon as they are finished (i.e., not in the order of paths), so that they can
+        be inserted into the database while the remaining directories are still being parsed.
+        A failure in one directory does not abort the others; its traceback is returned instead
+        of the task doc.
+
+        Args:
+            paths ([str]): paths to the directories containing vasprun.xml and OUTCAR files
+            workers (int): number of worker processes. 1 parses serially in this process.
+            chunksize (int): number of paths handed to a worker at a time
+
+        Yields:
+            (str, dict, str): path, task doc (None if parsing failed) and the formatted traceback
+                of the failure (None if parsing succeeded)
+        """
+        if workers <= 1:
+            for path in paths:
+                yield _assimilate(self, path)
+            return
+
+        pool = multiprocessing.Pool(workers, initializer=_init_pool_drone, initargs=(self,))
+        try:
+            for result in pool.imap_unordered(_assimilate_in_pool, paths, chunksize):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
     def filter_files(self, path, file_pattern="vasprun.xml"):
         """
@@ -160,11 +627,12 @@ class VaspDrone(AbstractDrone):
             The key is set from list of run types: self.runs
         """
         processed_files = OrderedDict()
-        files = os.listdir(path)
+        index = self.get_dir_index(path)
+        files = index[""]
         for r in self.runs:
             # try subfolder schema
-            if r in files:
-                for f in os.listdir(os.path.join(path, r)):
+            if r in index:
+                for f in index[r]:
                     if fnmatch(f, "{}*".format(file_pattern)):
                         processed_files[r] = os.path.join(r, f)
             # try extension schema
@@ -179,6 +647,15 @@ class VaspDrone(AbstractDrone):
                     processed_files['standard'] = f
         return processed_files
 
+    def _find_files(self, path, pattern):
+        """
+        Full paths of the (non-hidden) entries of path that match the glob pattern, looked up in
+        the directory index.
+        """
+        fullpath = os.path.abspath(path)
+        return [os.path.join(fullpath, f) for f in self.get_dir_index(fullpath)[""]
+                if fnmatch(f, pattern) and not f.startswith(".")]
+
     def generate_doc(self, dir_name, vasprun_files, outcar_files):
         """
         Adapted from matgendb.creator.generate_doc
@@ -189,10 +666,19 @@ class VaspDrone(AbstractDrone):
             d = jsanitize(self.additional_fields, strict=True)
             d["schema"] = {"code": "atomate", "version": VaspDrone.__version__}
             d["dir_name"] = fullpath
-            d["calcs_reversed"] = [self.process_vasprun(dir_name, taskname, filename)
-                                   for taskname, filename in vasprun_files.items()]
-            outcar_data = [Outcar(os.path.join(dir_name, filename)).as_dict()
-                           for taskname, filename in outcar_files.items()]
+            bader_pool, bader_jobs = self.start_bader(dir_name, list(vasprun_files.keys()))
+            try:
+                d["calcs_reversed"] = [self.process_vasprun(dir_name, taskname, filename)
+                                       for taskname, filename in vasprun_files.items()]
+                outcar_data = [self.process_outcar(os.path.join(dir_name, filename),
+                                                   d_calc["input"]["parameters"])
+                               for d_calc, filename in zip(d["calcs_reversed"],
+                                                           outcar_files.values())]
+                self.join_bader(dir_name, bader_jobs, d["calcs_reversed"])
+            finally:
+                if bader_pool is not None:
+                    bader_pool.terminate()
+                    bader_pool.join()
             run_stats = {}
             for i, d_calc in enumerate(d["calcs_reversed"]):
                 run_stats[d_calc["task"]["name"]] = outcar_data[i].pop("run_stats")
@@ -254,12 +740,16 @@ class VaspDrone(AbstractDrone):
                 "forces": d_calc_final["output"]["ionic_steps"][-1].get("forces"),
                 "stress": d_calc_final["output"]["ionic_steps"][-1].get("stress")}
 
+            # build the final structure once and reuse it for the symmetry and the analysis
+            final_structure = Structure.from_dict(d_calc_final["output"]["structure"])
+            output_structure = final_structure
+
             # patch calculated magnetic moments into final structure
             if len(d_calc_final["output"]["outcar"]["magnetization"]) != 0:
                 magmoms = [m["tot"] for m in d_calc_final["output"]["outcar"]["magnetization"]]
-                s = Structure.from_dict(d["output"]["structure"])
-                s.add_site_property('magmom', magmoms)
-                d["output"]["structure"] = s.as_dict()
+                output_structure = final_structure.copy()
+                output_structure.add_site_property('magmom', magmoms)
+                d["output"]["structure"] = output_structure.as_dict()
 
             calc = d["calcs_reversed"][0]
 
@@ -282,29 +772,22 @@ class VaspDrone(AbstractDrone):
                     raise
 
             # Store symmetry information
-            sg = SpacegroupAnalyzer(Structure.from_dict(d_calc_final["output"]["structure"]), 0.1)
-            if not sg.get_symmetry_dataset():
-                sg = SpacegroupAnalyzer(Structure.from_dict(d_calc_final["output"]["structure"]),
-                                        1e-3, 1)
-            d["output"]["spacegroup"] = {
-                "source": "spglib",
-                "symbol": sg.get_space_group_symbol(),
-                "number": sg.get_space_group_number(),
-                "point_group": sg.get_point_group_symbol(),
-                "crystal_system": sg.get_crystal_system(),
-                "hall": sg.get_hall()}
+            symmetry = get_symmetry_info(final_structure, 0.1) or \
+                get_symmetry_info(final_structure, 1e-3, 1)
+            d["output"]["spacegroup"] = symmetry["spacegroup"]
 
             # store dieelctric and piezo information
             if d["input"]["parameters"].get("LEPSILON"):
                 for k in ['epsilon_static', 'epsilon_static_wolfe', 'epsilon_ionic']:
                     d["output"][k] = d_calc_final["output"][k]
-                if SymmOp.inversion() not in sg.get_symmetry_operations():
+                if not symmetry["has_inversion"]:
                     for k in ["piezo_ionic_tensor", "piezo_tensor"]:
                         d["output"][k] = d_calc_final["output"]["outcar"][k]
 
             d["state"] = "successful" if d_calc["has_vasp_completed"] else "unsuccessful"
 
-            self.set_analysis(d)
+            self.set_analysis(d, final_structure=final_structure,
+                              output_structure=output_structure)
 
             d["last_updated"] = datetime.datetime.utcnow()
             return d
@@ -322,9 +805,22 @@ class VaspDrone(AbstractDrone):
         """
         vasprun_file = os.path.join(dir_name, filename)
 
-        vrun = Vasprun(vasprun_file)
+        if self.stream_vasprun:
+            vrun = self._parse_filtered_vasprun(vasprun_file)
+        elif self.single_parse:
+            vrun = Vasprun(vasprun_file, parse_projected_eigen=self._need_projections(
+                read_vasprun_incar(vasprun_file)))
+        else:
+            vrun = Vasprun(vasprun_file)
 
-        d = vrun.as_dict()
+        # the projected eigenvalues are only parsed for the band structure and are not stored in
+        # the doc, so they are not serialized (to nested lists) by as_dict
+        projected_eigenvalues = vrun.projected_eigenvalues
+        vrun.projected_eigenvalues = None
+        try:
+            d = vrun.as_dict()
+        finally:
+            vrun.projected_eigenvalues = projected_eigenvalues
 
         # rename formula keys
         for k, v in {"formula_pretty": "pretty_formula",
@@ -350,10 +846,16 @@ class VaspDrone(AbstractDrone):
             d["output"][k] = d["output"].pop(v)
 
         # Process bandstructure and DOS
+        bs = None
         if self.bandstructure_mode != False:
-            bs = self.process_bandstructure(vrun)
-            if bs:
-                d["bandstructure"] = bs
+            if self.single_parse or self.stream_vasprun:
+                bs, store_bs = self.get_band_structure(vrun, bs_vrun=vrun)
+                if store_bs:
+                    d["bandstructure"] = bs.as_dict()
+            else:
+                bs_dict = self.process_bandstructure(vrun)
+                if bs_dict:
+                    d["bandstructure"] = bs_dict
 
         if self.parse_dos != False:
             dos = self.process_dos(vrun)
@@ -363,7 +865,8 @@ class VaspDrone(AbstractDrone):
         # Parse electronic information if possible.
         # For certain optimizers this is broken and we don't get an efermi resulting in the bandstructure
         try:
-            bs = vrun.get_band_structure()
+            if bs is None:
+                bs = vrun.get_band_structure()
             bs_gap = bs.get_band_gap()
             d["output"]["vbm"] = bs.get_vbm()["energy"]
             d["output"]["cbm"] = bs.get_cbm()["energy"]
@@ -392,8 +895,8 @@ class VaspDrone(AbstractDrone):
 
         # parse axially averaged locpot
         if "locpot" in d["output_file_paths"] and self.parse_locpot:
-            locpot = Locpot.from_file(os.path.join(dir_name, d["output_file_paths"]["locpot"]))
-            d["output"]["locpot"] = {i: locpot.get_average_along_axis(i) for i in range(3)}
+            d["output"]["locpot"] = read_locpot_axis_averages(
+                os.path.join(dir_name, d["output_file_paths"]["locpot"]))
 
         if self.parse_chgcar != False:
             # parse CHGCAR file only for static calculations
@@ -423,15 +926,75 @@ class VaspDrone(AbstractDrone):
             d["output"]["normalmode_eigenvals"] = vrun.normalmode_eigenvals.tolist()
             d["output"]["normalmode_eigenvecs"] = vrun.normalmode_eigenvecs.tolist()
 
-        # Try and perform bader
-        if self.parse_bader:
+        return d
+
+    def start_bader(self, dir_name, tasknames):
+        """
+        Start the Bader analysis of the given runs. With bader_workers > 0 the analyses are
+        submitted to a new process pool (Bader runs in a scratch directory, so it cannot run in
+        threads), otherwise they are deferred to join_bader.
+
+        Args:
+            dir_name (str): the calculation directory
+            tasknames (list): the run names, in the order of the runs
+
+        Returns:
+            (Pool, dict): the pool (None if not used) and {taskname: AsyncResult or None}
+        """
+        if not self.parse_bader:
+            return None, {}
+        if self.bader_final_only:
+            tasknames = tasknames[-1:]
+        # pool workers (e.g. from assimilate_many) are daemonic and cannot start a pool
+        if self.bader_workers < 1 or multiprocessing.current_process().daemon:
+            return None, {taskname: None for taskname in tasknames}
+        path = os.path.abspath(dir_name)
+        pool = multiprocessing.Pool(min(self.bader_workers, len(tasknames)))
+        jobs = {taskname: pool.apply_async(bader_analysis_from_path, (path,),
+                                           {"suffix": ".{}".format(taskname)})
+                for taskname in tasknames}
+        pool.close()
+        return pool, jobs
+
+    @staticmethod
+    def join_bader(dir_name, jobs, calcs):
+        """
+        Wait for the Bader analyses started by start_bader (or run the deferred ones) and store
+        the results in the calc docs.
+
+        Args:
+            dir_name (str): the calculation directory
+            jobs (dict): {taskname: AsyncResult or None}
+            calcs (list): the calc docs
+        """
+        for d_calc in calcs:
+            taskname = d_calc["task"]["name"]
+            if taskname not in jobs:
+                continue
             try:
-                bader = bader_analysis_from_path(dir_name, suffix=".{}".format(taskname))
+                if jobs[taskname] is None:
+                    bader = bader_analysis_from_path(dir_name, suffix=".{}".format(taskname))
+                else:
+                    bader = jobs[taskname].get()
             except Exception as e:
                 bader = "Bader analysis failed: {}".format(e)
-            d["bader"] = bader
+            d_calc["bader"] = bader
 
-        return d
+    def process_outcar(self, outcar_file, parameters):
+        """
+        Parse an OUTCAR file.
+
+        Args:
+            outcar_file (str): path to the OUTCAR file
+            parameters (dict): the VASP parameters of the run (from the vasprun file)
+
+        Returns:
+            (dict) the OUTCAR data
+        """
+        if self.selective_outcar and not any(parameters.get(k) for k in
+                                             ["LEPSILON", "LCALCPOL", "LNONCOLLINEAR", "LSORBIT"]):
+            return read_outcar_fields(outcar_file)
+        return Outcar(outcar_file).as_dict()
 
     @classmethod
     def process_chgcar(cls, chg_file):
@@ -441,14 +1004,27 @@ class VaspDrone(AbstractDrone):
             raise ValueError("Unable to open CHGCAR/AECCAR file" )
         return chgcar
 
-    def process_bandstructure(self, vrun):
+    def get_band_structure(self, vrun, bs_vrun=None):
+        """
+        Build the band structure according to self.bandstructure_mode.
+
+        Args:
+            vrun (Vasprun): the parsed vasprun, used for the INCAR settings
+            bs_vrun (Vasprun): an already parsed vasprun (with projections if they are needed)
+                to build the band structure from. If None, the vasprun file is re-parsed with
+                BSVasprun.
 
+        Returns:
+            (BandStructure, bool): the band structure (None if not parsed) and whether it should
+                be saved in the task doc
+        """
         vasprun_file = vrun.filename
         # Band structure parsing logic
         if str(self.bandstructure_mode).lower() == "auto":
             # if NSCF calculation
             if vrun.incar.get("ICHARG", 0) > 10:
-                bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=True)
+                if bs_vrun is None:
+                    bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=True)
                 try:
                     # Try parsing line mode
                     bs = bs_vrun.get_band_structure(line_mode=True)
@@ -457,21 +1033,65 @@ class VaspDrone(AbstractDrone):
                     bs = bs_vrun.get_band_structure()
             # else just regular calculation
             else:
-                bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=False)
+                if bs_vrun is None:
+                    bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=False)
                 bs = bs_vrun.get_band_structure()
 
             # only save the bandstructure if not moving ions
-            if vrun.incar.get("NSW", 0) <= 1:
-                return bs.as_dict()
+            return bs, vrun.incar.get("NSW", 0) <= 1
 
         # legacy line/True behavior for bandstructure_mode
         elif self.bandstructure_mode:
-            bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=True)
+            if bs_vrun is None:
+                bs_vrun = BSVasprun(vasprun_file, parse_projected_eigen=True)
             bs = bs_vrun.get_band_structure(line_mode=(str(self.bandstructure_mode).lower() == "line"))
-            return bs.as_dict()
+            return bs, True
+
+        return None, False
 
+    def process_bandstructure(self, vrun):
+        bs, store_bs = self.get_band_structure(vrun)
+        if store_bs:
+            return bs.as_dict()
         return None
 
+    def _need_projections(self, incar):
+        """
+        Whether the band structure requested by self.bandstructure_mode needs the projected
+        eigenvalues. In "auto" mode only NSCF runs (ICHARG > 10) are parsed with projections.
+        """
+        if str(self.bandstructure_mode).lower() == "auto":
+            return incar.get("ICHARG", 0) > 10
+        return bool(self.bandstructure_mode)
+
+    def _parse_filtered_vasprun(self, vasprun_file):
+        """
+        Parse the vasprun file after streaming it through filter_vasprun, so that the sections
+        not needed for the requested outputs are skipped at parse time.
+        """
+        incar = read_vasprun_incar(vasprun_file)
+        parse_projected = self._need_projections(incar)
+        parse_pdos = self.parse_dos == True or (str(self.parse_dos).lower() == "auto"
+                                                and incar.get("NSW", 0) < 1)
+        # the default temporary directory is often a small tmpfs on compute nodes
+        try:
+            fd, filtered_file = tempfile.mkstemp(
+                prefix=".filtered_", suffix=".xml",
+                dir=self.cache_dir or os.path.dirname(os.path.abspath(vasprun_file)))
+        except OSError:
+            fd, filtered_file = tempfile.mkstemp(prefix=".filtered_", suffix=".xml")
+        os.close(fd)
+        try:
+            filter_vasprun(vasprun_file, filtered_file, skip_pdos=not parse_pdos,
+                           skip_projected=not parse_projected)
+            # the POTCAR is looked up next to the original vasprun file
+            vrun = Vasprun(filtered_file, parse_projected_eigen=parse_projected,
+                           parse_potcar_file=os.path.dirname(os.path.abspath(vasprun_file)))
+        finally:
+            os.remove(filtered_file)
+        vrun.filename = vasprun_file
+        return vrun
+
     def process_dos(self, vrun):
         # parse dos if forced to or auto mode set and  0 ionic steps were performed -> static calculation and not DFPT
         if self.parse_dos == True or (str(self.parse_dos).lower() == "auto" and vrun.incar.get("NSW", 0) < 1):
@@ -499,11 +1119,21 @@ class VaspDrone(AbstractDrone):
         return d
 
     @staticmethod
-    def set_analysis(d, max_force_threshold=0.5, volume_change_threshold=0.2):
+    def set_analysis(d, max_force_threshold=0.5, volume_change_threshold=0.2,
+                     final_structure=None, output_structure=None):
         """
         Adapted from matgendb.creator
 
         set the 'analysis' key
+
+        Args:
+            d (dict): task doc
+            max_force_threshold (float): unused
+            volume_change_threshold (float): relative volume change above which a warning is set
+            final_structure (Structure): the final structure of the last calculation, if already
+                built. Otherwise it is built from d.
+            output_structure (Structure): the structure in d["output"], if already built.
+                Otherwise it is built from d.
         """
         initial_vol = d["input"]["structure"]["lattice"]["volume"]
         final_vol = d["output"]["structure"]["lattice"]["volume"]
@@ -524,13 +1154,16 @@ class VaspDrone(AbstractDrone):
             # calculate max forces
             forces = np.array(calc['output']['ionic_steps'][-1]['forces'])
             # account for selective dynamics
-            final_structure = Structure.from_dict(calc['output']['structure'])
+            if final_structure is None:
+                final_structure = Structure.from_dict(calc['output']['structure'])
             sdyn = final_structure.site_properties.get('selective_dynamics')
             if sdyn:
                 forces[np.logical_not(sdyn)] = 0
             max_force = max(np.linalg.norm(forces, axis=1))
 
-            s = Structure.from_dict(d["output"]["structure"])
+            s = output_structure
+            if s is None:
+                s = Structure.from_dict(d["output"]["structure"])
             if not s.is_valid():
                 error_msgs.append("Bad structure (atoms are too close!)")
                 d["state"] = "error"
@@ -559,7 +1192,7 @@ class VaspDrone(AbstractDrone):
         # the origin of a particular structure. If such a file is found, it is inserted into the
         # task doc as d["transformations"]
         transformations = {}
-        filenames = glob.glob(os.path.join(fullpath, "transformations.json*"))
+        filenames = self._find_files(fullpath, "transformations.json*")
         if len(filenames) >= 1:
             with zopen(filenames[0], "rt") as f:
                 transformations = json.load(f)
@@ -592,7 +1225,7 @@ class VaspDrone(AbstractDrone):
         # This is useful for tracking what has actually be done to get a
         # result. If such a file is found, it is inserted into the task doc
         # as d["custodian"]
-        filenames = glob.glob(os.path.join(fullpath, "custodian.json*"))
+        filenames = self._find_files(fullpath, "custodian.json*")
         if len(filenames) >= 1:
             with zopen(filenames[0], "rt") as f:
                 d["custodian"] = json.load(f)
@@ -605,7 +1238,7 @@ class VaspDrone(AbstractDrone):
         # Calculations using custodian generate a *.orig file for the inputs
         # This is useful to know how the calculation originally started
         # if such files are found they are inserted into orig_inputs
-        filenames = glob.glob(os.path.join(fullpath, "*.orig*"))
+        filenames = self._find_files(fullpath, "*.orig*")
 
         if len(filenames) >= 1:
             d["orig_inputs"] = {}
@@ -652,7 +1285,7 @@ class VaspDrone(AbstractDrone):
         if set(self.runs).intersection(subdirs):
             return [parent]
         if not any([parent.endswith(os.sep + r) for r in self.runs]) and \
-                len(glob.glob(os.path.join(parent, "vasprun.xml*"))) > 0:
+                any(fnmatch(f, "vasprun.xml*") for f in files):
             return [parent]
         return []
 
@@ -662,7 +1295,18 @@ class VaspDrone(AbstractDrone):
             "bandstructure_mode": self.bandstructure_mode,
             "additional_fields": self.additional_fields,
             "use_full_uri": self.use_full_uri,
-            "runs": self.runs}
+            "runs": self.runs,
+            "parse_locpot": self.parse_locpot,
+            "parse_bader": self.parse_bader,
+            "parse_chgcar": self.parse_chgcar,
+            "parse_aeccar": self.parse_aeccar,
+            "single_parse": self.single_parse,
+            "stream_vasprun": self.stream_vasprun,
+            "cache_dir": self.cache_dir,
+            "cache_size": self.cache_size,
+            "selective_outcar": self.selective_outcar,
+            "bader_workers": self.bader_workers,
+            "bader_final_only": self.bader_final_only}
         return {"@module": self.__class__.__module__,
                 "@class": self.__class__.__name__,
                 "version": self.__class__.__version__,
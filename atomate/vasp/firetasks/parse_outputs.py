@@ -23,15 +23,15 @@ from pymatgen.analysis.elasticity.strain import Strain, Deformation
 from pymatgen.analysis.elasticity.stress import Stress
 from pymatgen.electronic_structure.boltztrap import BoltztrapAnalyzer
 from pymatgen.io.vasp.sets import get_vasprun_outcar
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.analysis.ferroelectricity.polarization import Polarization, get_total_ionic_dipole, \
     EnergyTrend
 
 from atomate.common.firetasks.glue_tasks import get_calc_loc
-from atomate.utils.utils import env_chk, get_meta_from_structure
+from atomate.utils.utils import env_chk, get_meta_from_structure, get_symmetry_info
 from atomate.utils.utils import get_logger
 from atomate.vasp.database import VaspCalcDb
 from atomate.vasp.drones import VaspDrone
+from atomate.vasp.spool import write_spool
 
 __author__ = 'Anubhav Jain, Kiran Mathew, Shyam Dwaraknath'
 __email__ = 'ajain@lbl.gov, kmathew@lbl.gov, shyamd@lbl.gov'
@@ -71,10 +71,20 @@ class VaspToDb(FiretaskBase):
             The path is a full mongo-style path so subdocuments can be referneced
             using dot notation and array keys can be referenced using the index.
             E.g "calcs_reversed.0.output.outar.run_stats"
+        single_parse (bool): if True, parse each vasprun.xml only once and reuse the same
+            band structure for the stored band structure and the gap fields. Default: False.
+        cache_dir (str): directory of the on-disk cache of parsed task docs (see VaspDrone).
+            Supports env_chk. Default: no caching.
+        selective_outcar (bool): if True, only parse the OUTCAR sections stored in the task doc
+            in a single pass (see VaspDrone). Default: False.
+        spool (bool): if True and db_file is not set, write the task doc to a compressed spool
+            (see atomate.vasp.spool) instead of task.json, to be ingested later with
+            "atdb ingest_spool". Default: False.
     """
     optional_params = ["calc_dir", "calc_loc", "parse_dos", "bandstructure_mode",
                        "additional_fields", "db_file", "fw_spec_field", "defuse_unsuccessful",
-                       "task_fields_to_push", "parse_chgcar", "parse_aeccar"]
+                       "task_fields_to_push", "parse_chgcar", "parse_aeccar", "single_parse",
+                       "cache_dir", "selective_outcar", "spool"]
 
     def run_task(self, fw_spec):
         # get the directory that contains the VASP dir to parse
@@ -91,7 +101,10 @@ class VaspToDb(FiretaskBase):
                           parse_dos=self.get("parse_dos", False),
                           bandstructure_mode=self.get("bandstructure_mode", False),
                           parse_chgcar=self.get("parse_chgcar", False),
-                          parse_aeccar=self.get("parse_aeccar", False))
+                          parse_aeccar=self.get("parse_aeccar", False),
+                          single_parse=self.get("single_parse", False),
+                          cache_dir=env_chk(self.get("cache_dir"), fw_spec, strict=False),
+                          selective_outcar=self.get("selective_outcar", False))
 
         # assimilate (i.e., parse)
         task_doc = drone.assimilate(calc_dir)
@@ -104,7 +117,9 @@ class VaspToDb(FiretaskBase):
         db_file = env_chk(self.get('db_file'), fw_spec)
 
         # db insertion or taskdoc dump
-        if not db_file:
+        if not db_file and self.get("spool"):
+            write_spool([task_doc])
+        elif not db_file:
             with open("task.json", "w") as f:
                 f.write(json.dumps(task_doc, default=DATETIME_HANDLER))
         else:
@@ -164,8 +179,10 @@ class JsonToDb(FiretaskBase):
         db_file (str): path to file containing the database credentials. Supports env_chk.
         calc_dir (str): path to dir (on current filesystem) that contains VASP output files.
             Default: use current working directory.
+        spool (bool): if True and db_file is not set, write the task doc to a compressed spool
+            (see atomate.vasp.spool) instead of task.json. Default: False.
     """
-    optional_params = ["json_filename", "db_file", "calc_dir"]
+    optional_params = ["json_filename", "db_file", "calc_dir", "spool"]
 
     def run_task(self, fw_spec):
 
@@ -175,7 +192,9 @@ class JsonToDb(FiretaskBase):
             task_doc = json.load(fp)
 
         db_file = env_chk(self.get('db_file'), fw_spec)
-        if not db_file:
+        if not db_file and self.get("spool"):
+            write_spool([task_doc])
+        elif not db_file:
             with open("task.json", "w") as f:
                 f.write(json.dumps(task_doc, default=DATETIME_HANDLER))
         else:
@@ -230,13 +249,7 @@ class BoltztrapToDb(FiretaskBase):
         d.update(get_meta_from_structure(structure))
 
         # add the spacegroup
-        sg = SpacegroupAnalyzer(Structure.from_dict(d["structure"]), 0.1)
-        d["spacegroup"] = {"symbol": sg.get_space_group_symbol(),
-                           "number": sg.get_space_group_number(),
-                           "point_group": sg.get_point_group_symbol(),
-                           "source": "spglib",
-                           "crystal_system": sg.get_crystal_system(),
-                           "hall": sg.get_hall()}
+        d["spacegroup"] = get_symmetry_info(structure, 0.1)["spacegroup"]
 
         d["created_at"] = datetime.utcnow()
 
@@ -254,6 +267,7 @@ class BoltztrapToDb(FiretaskBase):
             fsid, compression = mmdb.insert_gridfs(dos, collection="dos_boltztrap_fs",
                                                    compress=True)
             d["dos_boltztrap_fs_id"] = fsid
+            d["dos_boltztrap_compression"] = compression
             del d["dos"]
 
             mmdb.db.boltztrap.insert(d)
@@ -281,10 +295,15 @@ class ElasticTensorToDb(FiretaskBase):
             "independent", "pseudoinverse", and "finite_difference."
             Note that order 3 and higher required finite difference
             fitting, and will override.
+        cache_dir (str): directory of the on-disk cache of parsed task docs (see VaspDrone),
+            used when parsing the optimization directory. Supports env_chk.
+        spool (bool): if True and db_file is not set, write the results to a compressed spool
+            (see atomate.vasp.spool) instead of elasticity.json. Default: False.
     """
 
     required_params = ['structure']
-    optional_params = ['db_file', 'order', 'fw_spec_field', 'fitting_method']
+    optional_params = ['db_file', 'order', 'fw_spec_field', 'fitting_method', 'cache_dir',
+                       'spool']
 
     def run_task(self, fw_spec):
         ref_struct = self['structure']
@@ -298,7 +317,7 @@ class ElasticTensorToDb(FiretaskBase):
         if calc_locs_opt:
             optimize_loc = calc_locs_opt[-1]['path']
             logger.info("Parsing initial optimization directory: {}".format(optimize_loc))
-            drone = VaspDrone()
+            drone = VaspDrone(cache_dir=env_chk(self.get("cache_dir"), fw_spec, strict=False))
             optimize_doc = drone.assimilate(optimize_loc)
             opt_struct = Structure.from_dict(optimize_doc["calcs_reversed"][0]["output"]["structure"])
             d.update({"optimized_structure": opt_struct.as_dict()})
@@ -378,7 +397,9 @@ class ElasticTensorToDb(FiretaskBase):
 
         # Save analysis results in json or db
         db_file = env_chk(self.get('db_file'), fw_spec)
-        if not db_file:
+        if not db_file and self.get("spool"):
+            write_spool([d], collection="elasticity")
+        elif not db_file:
             with open("elasticity.json", "w") as f:
                 f.write(json.dumps(d, default=DATETIME_HANDLER))
         else:
@@ -401,9 +422,11 @@ class RamanTensorToDb(FiretaskBase):
 
     optional_params:
         db_file (str): path to the db file
+        spool (bool): if True and db_file is not set, write the results to a compressed spool
+            (see atomate.vasp.spool) instead of raman.json. Default: False.
     """
 
-    optional_params = ["db_file"]
+    optional_params = ["db_file", "spool"]
 
     def run_task(self, fw_spec):
         nm_eigenvecs = np.array(fw_spec["normalmodes"]["eigenvecs"])
@@ -450,7 +473,9 @@ class RamanTensorToDb(FiretaskBase):
 
         # store the results
         db_file = env_chk(self.get("db_file"), fw_spec)
-        if not db_file:
+        if not db_file and self.get("spool"):
+            write_spool([d], collection="raman")
+        elif not db_file:
             with open("raman.json", "w") as f:
                 f.write(json.dumps(d, default=DATETIME_HANDLER))
         else:
@@ -473,7 +498,7 @@ class GibbsAnalysisToDb(FiretaskBase):
     1. use the phonopy package quasi-harmonic approximation interface or
     2. use the debye model.
     Note: Instead of relying on fw_spec, this task gets the required data directly from the
-    tasks collection for processing. The summary dict is written to 'gibbs.json' file.
+    task summaries (see VaspCalcDb.get_task_summary) for processing. The summary dict is written to 'gibbs.json' file.
 
     required_params:
         tag (str): unique tag appended to the task labels in other fireworks so that all the
@@ -521,25 +546,27 @@ class GibbsAnalysisToDb(FiretaskBase):
         db_file = env_chk(self.get("db_file"), fw_spec)
         mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         # get the optimized structure
-        d = mmdb.collection.find_one({"task_label": "{} structure optimization".format(tag)},
-                                     {"calcs_reversed": 1})
-        structure = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
+        d = mmdb.find_task_summaries({"task_label": "{} structure optimization".format(tag)},
+                                     ["first_calc_output.structure"])[0]
+        structure = Structure.from_dict(d["first_calc_output"]['structure'])
         gibbs_dict["structure"] = structure.as_dict()
         gibbs_dict["formula_pretty"] = structure.composition.reduced_formula
 
         # get the data(energy, volume, force constant) from the deformation runs
-        docs = mmdb.collection.find({"task_label": {"$regex": "{} gibbs*".format(tag)},
-                                     "formula_pretty": structure.composition.reduced_formula},
-                                    {"calcs_reversed": 1})
+        fields = ["first_calc_output.energy", "first_calc_output.volume"]
+        if qha_type not in ["debye_model"]:
+            fields.append("first_calc_output.force_constants")
+        docs = mmdb.find_task_summaries(
+            {"task_label": {"$regex": "^{} gibbs".format(re.escape(tag))},
+             "formula_pretty": structure.composition.reduced_formula}, fields)
         energies = []
         volumes = []
         force_constants = []
         for d in docs:
-            s = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
-            energies.append(d["calcs_reversed"][-1]["output"]['energy'])
+            energies.append(d["first_calc_output"]['energy'])
             if qha_type not in ["debye_model"]:
-                force_constants.append(d["calcs_reversed"][-1]["output"]['force_constants'])
-            volumes.append(s.volume)
+                force_constants.append(d["first_calc_output"]['force_constants'])
+            volumes.append(d["first_calc_output"]['volume'])
         gibbs_dict["energies"] = energies
         gibbs_dict["volumes"] = volumes
         if qha_type not in ["debye_model"]:
@@ -635,21 +662,23 @@ class FitEOSToDb(FiretaskBase):
 
         mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         # get the optimized structure
-        d = mmdb.collection.find_one({"task_label": "{} structure optimization".format(tag)})
+        d = mmdb.find_task_summaries({"task_label": "{} structure optimization".format(tag)},
+                                     ["task_id", "first_calc_output.structure"])[0]
         all_task_ids.append(d["task_id"])
-        structure = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
+        structure = Structure.from_dict(d["first_calc_output"]['structure'])
         summary_dict["structure"] = structure.as_dict()
         summary_dict["formula_pretty"] = structure.composition.reduced_formula
 
         # get the data(energy, volume, force constant) from the deformation runs
-        docs = mmdb.collection.find({"task_label": {"$regex": "{} bulk_modulus*".format(tag)},
-                                     "formula_pretty": structure.composition.reduced_formula})
+        docs = mmdb.find_task_summaries(
+            {"task_label": {"$regex": "^{} bulk_modulus".format(re.escape(tag))},
+             "formula_pretty": structure.composition.reduced_formula},
+            ["task_id", "first_calc_output.energy", "first_calc_output.volume"])
         energies = []
         volumes = []
         for d in docs:
-            s = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
-            energies.append(d["calcs_reversed"][-1]["output"]['energy'])
-            volumes.append(s.volume)
+            energies.append(d["first_calc_output"]['energy'])
+            volumes.append(d["first_calc_output"]['volume'])
             all_task_ids.append(d["task_id"])
         summary_dict["energies"] = energies
         summary_dict["volumes"] = volumes
@@ -719,22 +748,25 @@ class ThermalExpansionCoeffToDb(FiretaskBase):
 
         mmdb = VaspCalcDb.from_db_file(db_file, admin=True)
         # get the optimized structure
-        d = mmdb.collection.find_one({"task_label": "{} structure optimization".format(tag)})
-        structure = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
+        d = mmdb.find_task_summaries({"task_label": "{} structure optimization".format(tag)},
+                                     ["first_calc_output.structure"])[0]
+        structure = Structure.from_dict(d["first_calc_output"]['structure'])
         summary_dict["structure"] = structure.as_dict()
         summary_dict["formula_pretty"] = structure.composition.reduced_formula
 
         # get the data(energy, volume, force constant) from the deformation runs
-        docs = mmdb.collection.find({"task_label": {"$regex": "{} thermal_expansion*".format(tag)},
-                                     "formula_pretty": structure.composition.reduced_formula})
+        docs = mmdb.find_task_summaries(
+            {"task_label": {"$regex": "^{} thermal_expansion".format(re.escape(tag))},
+             "formula_pretty": structure.composition.reduced_formula},
+            ["first_calc_output.energy", "first_calc_output.volume",
+             "first_calc_output.force_constants"])
         energies = []
         volumes = []
         force_constants = []
         for d in docs:
-            s = Structure.from_dict(d["calcs_reversed"][-1]["output"]['structure'])
-            energies.append(d["calcs_reversed"][-1]["output"]['energy'])
-            volumes.append(s.volume)
-            force_constants.append(d["calcs_reversed"][-1]["output"]['force_constants'])
+            energies.append(d["first_calc_output"]['energy'])
+            volumes.append(d["first_calc_output"]['volume'])
+            force_constants.append(d["first_calc_output"]['force_constants'])
         summary_dict["energies"] = energies
         summary_dict["volumes"] = volumes
         summary_dict["force_constants"] = force_constants
@@ -769,7 +801,11 @@ class PolarizationToDb(FiretaskBase):
         vaspdb = VaspCalcDb.from_db_file(db_file, admin=True)
 
         # ferroelectric workflow groups calculations by generated wfid tag
-        polarization_tasks = vaspdb.collection.find({"tags": wfid, "task_label": {"$regex": ".*polarization"}})
+        # tasks whose outcar has no polarization data are skipped
+        polarization_tasks = vaspdb.find_task_summaries(
+            {"tags": wfid, "task_label": {"$regex": ".*polarization"},
+             "polarization": {"$exists": True}},
+            ["task_label", "output.energy", "output.energy_per_atom", "polarization"])
 
         tasks = []
         outcars = []
@@ -781,12 +817,13 @@ class PolarizationToDb(FiretaskBase):
 
         for p in polarization_tasks:
             # Grab data from each polarization task
-            energies_per_atom.append(p['calcs_reversed'][0]['output']['energy_per_atom'])
-            energies.append(p['calcs_reversed'][0]['output']['energy'])
+            energies_per_atom.append(p['output']['energy_per_atom'])
+            energies.append(p['output']['energy'])
             tasks.append(p['task_label'])
-            outcars.append(p['calcs_reversed'][0]['output']['outcar'])
-            structure_dicts.append(p['calcs_reversed'][0]['input']['structure'])
-            zval_dicts.append(p['calcs_reversed'][0]['output']['outcar']['zval_dict'])
+            structure_dicts.append(p['polarization'].pop('input_structure'))
+            # the polarization fields of the outcar: p_elec, p_ion and zval_dict
+            outcars.append(p['polarization'])
+            zval_dicts.append(p['polarization']['zval_dict'])
 
             # Add weight for sorting
             # Want polarization calculations in order of nonpolar to polar for Polarization object
@@ -0,0 +1,194 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+"""
+This module defines a local spool for documents that are meant for the database, written when
+no database is reachable (e.g. on air-gapped compute clusters) and ingested later.
+
+A spool is a directory holding a gzipped file with one JSON record per line and a binary
+side-car file per large payload. Each record holds the target collection ("tasks" for task
+documents), the document, the ObjectId it is inserted with (so that ingesting a spool twice
+does not duplicate the documents of the other collections; task documents are matched by
+dir_name) and the side-car files of its payloads. The documents are encoded with MontyEncoder,
+so that numpy arrays and datetimes survive the round trip. For task documents these are
+the DOS, band structure (compressed JSON) and charge densities (the binary volumetric format of
+atomate.vasp.volumetric) of the last calculation, i.e. the objects VaspCalcDb stores in GridFS.
+"""
+
+import gzip
+import json
+import multiprocessing
+import os
+import traceback
+from uuid import uuid4
+
+from bson import ObjectId
+from monty.json import MontyEncoder, MontyDecoder
+from pymongo import ReplaceOne
+
+from atomate.utils.compression import compress, decompress
+from atomate.utils.utils import get_logger
+from atomate.vasp.database import VaspCalcDb
+from atomate.vasp.volumetric import volumetric_to_bytes, volumetric_from_file
+
+logger = get_logger(__name__)
+
+SPOOL_DIR = "task_spool"
+SPOOL_FILE = "docs.jsonl.gz"
+
+VOLUMETRIC_KEYS = ("chgcar", "aeccar0", "aeccar2")
+
+
+def write_spool(docs, spool_dir=SPOOL_DIR, collection="tasks", codec="zlib",
+                volumetric_dtype="float64"):
+    """
+    Append documents to a spool. The GridFS payloads of task documents are removed from the
+    documents and written to side-car files.
+
+    Args:
+        docs ([dict]): the documents
+        spool_dir (str): the spool directory, created if needed
+        collection (str): the collection the documents are meant for. "tasks" is the tasks
+            collection of the database they are ingested into
+        codec (str): compression codec of the side-car files (see atomate.utils.compression)
+        volumetric_dtype (str): "float64" or "float32", the dtype the charge densities are
+            stored with
+    """
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+    with gzip.open(os.path.join(spool_dir, SPOOL_FILE), "ab") as f:
+        for doc in docs:
+            blobs = {}
+            payloads = VaspCalcDb._pop_gridfs_payloads(doc) if collection == "tasks" else {}
+            for key, data in payloads.items():
+                if key in VOLUMETRIC_KEYS:
+                    raw, header = volumetric_to_bytes(data, dtype=volumetric_dtype, codec=codec)
+                else:
+                    raw = compress(json.dumps(data, cls=MontyEncoder).encode(), codec)
+                    header = {"format": "json", "codec": codec}
+                blobs[key] = {"file": "{}_{}.bin".format(uuid4().hex, key), "header": header}
+                with open(os.path.join(spool_dir, blobs[key]["file"]), "wb") as bf:
+                    bf.write(raw)
+            record = {"collection": collection, "doc": doc, "blobs": blobs,
+                      "oid": str(ObjectId())}
+            f.write((json.dumps(record, cls=MontyEncoder) + "\n").encode())
+    logger.info("Spooled {} documents to {}".format(len(docs), spool_dir))
+
+
+def read_spool(spool_dir=SPOOL_DIR):
+    """
+    Read the documents of a spool. The payloads of task documents are put back into the last
+    calculation: the DOS and band structure as dicts, the charge densities as Chgcar objects.
+    The documents are ready to be inserted: datetimes are decoded, numpy arrays are lists.
+
+    Args:
+        spool_dir (str): the spool directory
+
+    Yields:
+        (str, dict, ObjectId): the collection, the document and the ObjectId it is meant to be
+            inserted with
+    """
+    with gzip.open(os.path.join(spool_dir, SPOOL_FILE), "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line.decode(), object_hook=_decode_object)
+            doc = record["doc"]
+            for key, blob in record["blobs"].items():
+                with open(os.path.join(spool_dir, blob["file"]), "rb") as bf:
+                    if blob["header"]["format"] == "json":
+                        data = json.loads(decompress(bf.read(), blob["header"]["codec"]).decode())
+                    else:
+                        data = volumetric_from_file(bf, blob["header"])
+                doc["calcs_reversed"][0][key] = data
+            yield record["collection"], doc, ObjectId(record["oid"])
+
+
+def _decode_object(d):
+    # json.loads object_hook for the objects encoded by MontyEncoder that are stored as is in
+    # the database. The other serialized objects stay dicts, as in the task documents.
+    if d.get("@module") == "datetime":
+        return MontyDecoder().process_decoded(d)
+    if d.get("@module") == "numpy" and d.get("@class") == "array":
+        return d["data"]
+    return d
+
+
+def find_spools(roots):
+    """
+    Args:
+        roots ([str]): directories to search
+
+    Returns:
+        ([str]) the spool directories under the roots
+    """
+    spools = []
+    for root in roots:
+        for path, dirs, files in os.walk(root):
+            if SPOOL_FILE in files:
+                spools.append(path)
+    return spools
+
+
+def _read_spool_in_pool(spool_dir):
+    try:
+        return spool_dir, list(read_spool(spool_dir)), None
+    except Exception:
+        logger.error("Failed to read the spool {}".format(spool_dir))
+        return spool_dir, None, traceback.format_exc()
+
+
+def ingest_spools(mmdb, spool_dirs, workers=1, use_gridfs=True, batch_size=100):
+    """
+    Insert the documents of many spools into the database. The spools are read and decoded in
+    a process pool, the task documents are inserted in batches with VaspCalcDb.ingest (so
+    tasks spooled twice are updated, not duplicated), the other documents with one bulk upsert
+    per spool and collection, on the ObjectId assigned when they were spooled (so they are not
+    duplicated either).
+
+    Args:
+        mmdb (VaspCalcDb): the database
+        spool_dirs ([str]): the spool directories
+        workers (int): number of worker processes. 1 reads the spools in this process.
+        use_gridfs (bool): store the DOS, band structures and charge densities in GridFS
+        batch_size (int): number of task documents inserted at a time
+
+    Returns:
+        (dict) report of VaspCalcDb.ingest, with the inserted task_ids by dir_name and the
+            errors by dir_name (or spool directory if it could not be read or its other
+            documents could not be written)
+    """
+    if workers <= 1:
+        results = (_read_spool_in_pool(s) for s in spool_dirs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_read_spool_in_pool, spool_dirs)
+
+    def assimilated():
+        for spool_dir, records, error in results:
+            if error:
+                yield spool_dir, None, error
+                continue
+            ops = {}
+            for collection, doc, oid in records:
+                if collection == "tasks":
+                    yield doc.get("dir_name", spool_dir), doc, None
+                else:
+                    doc["_id"] = oid
+                    ops.setdefault(collection, []).append(ReplaceOne({"_id": oid}, doc,
+                                                                     upsert=True))
+            try:
+                for collection, coll_ops in ops.items():
+                    mmdb.db[collection].bulk_write(coll_ops, ordered=False)
+            except Exception:
+                logger.error("Failed to insert the documents of the spool {}".format(spool_dir))
+                yield spool_dir, None, traceback.format_exc()
+
+    try:
+        return mmdb.ingest(assimilated(), use_gridfs=use_gridfs, batch_size=batch_size)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -6,11 +6,13 @@ from __future__ import division, print_function, unicode_literals, \
     absolute_import
 
 import os
+import shutil
+import tempfile
 import unittest
 
-from pymatgen.io.vasp import Outcar, Oszicar
+from pymatgen.io.vasp import Outcar, Oszicar, Locpot
 
-from atomate.vasp.drones import VaspDrone
+from atomate.vasp.drones import VaspDrone, read_outcar_fields, read_locpot_axis_averages
 
 import numpy as np
 
@@ -28,6 +30,8 @@ class VaspToDbTaskDroneTest(unittest.TestCase):
                                  "outputs")
         cls.Al = os.path.join(module_dir, "..", "test_files", "Al")
         cls.Si_static = os.path.join(module_dir, "..", "test_files", "Si_static", "outputs")
+        cls.Si_nscf_line = os.path.join(module_dir, "..", "test_files", "Si_nscf_line",
+                                        "outputs")
 
     def test_assimilate(self):
         drone = VaspDrone()
@@ -115,6 +119,82 @@ class VaspToDbTaskDroneTest(unittest.TestCase):
             self.assertTrue(d["is_metal"])
             self.assertEqual(doc["calcs_reversed"][0]["bandstructure"]["@class"],"BandStructureSymmLine")
 
+    def test_single_parse(self):
+        drone = VaspDrone()
+        single_drone = VaspDrone(single_parse=True)
+        for path in [self.relax2, self.Si_static, self.Al, self.Si_nscf_line]:
+            doc = drone.assimilate(path)
+            single_doc = single_drone.assimilate(path)
+            for k in ["vbm", "cbm", "bandgap", "is_gap_direct", "is_metal"]:
+                self.assertEqual(doc["output"][k], single_doc["output"][k])
+            self.assertEqual("bandstructure" in doc["calcs_reversed"][0],
+                             "bandstructure" in single_doc["calcs_reversed"][0])
+            self.assertNotIn("projected_eigenvalues", single_doc["calcs_reversed"][0]["output"])
+            if "bandstructure" in doc["calcs_reversed"][0]:
+                bs = doc["calcs_reversed"][0]["bandstructure"]
+                single_bs = single_doc["calcs_reversed"][0]["bandstructure"]
+                self.assertEqual(bs["@class"], single_bs["@class"])
+                self.assertEqual(bs.get("projections"), single_bs.get("projections"))
+        # the NSCF line mode run is parsed with projections
+        self.assertEqual(single_doc["calcs_reversed"][0]["bandstructure"]["@class"],
+                         "BandStructureSymmLine")
+        self.assertTrue(single_doc["calcs_reversed"][0]["bandstructure"].get("projections"))
+
+    def test_stream_vasprun(self):
+        drone = VaspDrone()
+        for stream_drone in [VaspDrone(stream_vasprun=True, single_parse=True),
+                             VaspDrone(stream_vasprun=True)]:
+            for path in [self.relax2, self.Si_static, self.Si_nscf_line]:
+                doc = drone.assimilate(path)
+                stream_doc = stream_drone.assimilate(path)
+                for k in ["energy", "vbm", "cbm", "bandgap", "is_gap_direct", "is_metal"]:
+                    self.assertEqual(doc["output"][k], stream_doc["output"][k])
+                self.assertEqual(doc["input"]["potcar_spec"], stream_doc["input"]["potcar_spec"])
+                self.assertEqual("dos" in doc["calcs_reversed"][0],
+                                 "dos" in stream_doc["calcs_reversed"][0])
+                if "bandstructure" in doc["calcs_reversed"][0]:
+                    self.assertEqual(
+                        doc["calcs_reversed"][0]["bandstructure"].get("projections"),
+                        stream_doc["calcs_reversed"][0]["bandstructure"].get("projections"))
+                # the filtered copy is removed
+                self.assertFalse([f for f in os.listdir(path) if f.startswith(".filtered_")])
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            drone = VaspDrone(cache_dir=cache_dir)
+            key = drone.get_cache_key(self.relax)
+            self.assertNotEqual(key, VaspDrone(cache_dir=cache_dir,
+                                               parse_dos=False).get_cache_key(self.relax))
+            self.assertNotEqual(key, drone.get_cache_key(self.Si_static))
+            doc = drone.assimilate(self.relax)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached_doc = drone.assimilate(self.relax)
+            self.assertEqual(doc["output"], cached_doc["output"])
+            self.assertEqual(doc["last_updated"], cached_doc["last_updated"])
+
+            # eviction of the least recently used docs
+            drone = VaspDrone(cache_dir=cache_dir, cache_size=1)
+            drone.assimilate(self.Si_static)
+            self.assertEqual(len(os.listdir(cache_dir)), 0)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_assimilate_many(self):
+        drone = VaspDrone()
+        bad_path = os.path.join(module_dir, "..", "test_files", "POT_GGA_PAW_PBE")
+        paths = [self.relax, self.Si_static, bad_path]
+        results = {path: (doc, error) for path, doc, error in
+                   drone.assimilate_many(paths, workers=2)}
+        self.assertEqual(set(results.keys()), set(paths))
+        for path in [self.relax, self.Si_static]:
+            doc, error = results[path]
+            self.assertIsNone(error)
+            self.assertEqual(doc["formula_pretty"], "Si")
+        doc, error = results[bad_path]
+        self.assertIsNone(doc)
+        self.assertIn("No VASP files found!", error)
+
     def test_detect_output_file_paths(self):
         drone = VaspDrone()
         doc = drone.assimilate(self.Si_static)
@@ -134,6 +214,55 @@ class VaspToDbTaskDroneTest(unittest.TestCase):
                               'wavecar': 'WAVECAR.relax1.gz'},
                              doc['calcs_reversed'][1]['output_file_paths'])
 
+    def test_dir_index(self):
+        drone = VaspDrone(runs=["relax1", "relax2"])
+        index = drone.get_dir_index(self.relax2)
+        self.assertEqual(set(index.keys()), {""})
+        self.assertEqual(set(index[""]), set(os.listdir(self.relax2)))
+        self.assertEqual(list(drone.filter_files(self.relax2, "vasprun.xml").keys()),
+                         ["relax1", "relax2"])
+        self.assertEqual(drone.get_valid_paths((self.relax2, [], index[""])), [self.relax2])
+
+    def test_read_outcar_fields(self):
+        for path in [os.path.join(self.relax2, "OUTCAR.relax2.gz"),
+                     os.path.join(self.Si_static, "OUTCAR.gz")]:
+            d = read_outcar_fields(path)
+            d_full = Outcar(path).as_dict()
+            for k in ["efermi", "run_stats", "magnetization", "charge", "total_magnetization",
+                      "nelect", "is_stopped", "drift"]:
+                self.assertEqual(d[k], d_full[k])
+
+        # no core count in the OUTCAR: 0, as in Outcar.as_dict()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "OUTCAR")
+            with open(path, "w") as f:
+                f.write(" E-fermi :   5.5000     XC(G=0):  -8.5000     alpha+bet : -4.0000\n")
+            d = read_outcar_fields(path)
+            self.assertEqual(d["run_stats"]["cores"], 0)
+            self.assertEqual(d["efermi"], 5.5)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        drone = VaspDrone(runs=["relax1", "relax2"], selective_outcar=True)
+        doc = drone.assimilate(self.relax2)
+        doc_full = VaspDrone(runs=["relax1", "relax2"]).assimilate(self.relax2)
+        self.assertEqual(doc["run_stats"], doc_full["run_stats"])
+        self.assertEqual(doc["calcs_reversed"][0]["output"]["outcar"]["magnetization"],
+                         doc_full["calcs_reversed"][0]["output"]["outcar"]["magnetization"])
+
+    def test_bader_runs(self):
+        drone = VaspDrone(runs=["relax1", "relax2"], parse_bader=True, bader_workers=2,
+                          bader_final_only=True)
+        doc = drone.assimilate(self.relax2)
+        self.assertIn("bader", doc["calcs_reversed"][0])
+        self.assertNotIn("bader", doc["calcs_reversed"][1])
+
+        drone = VaspDrone(runs=["relax1", "relax2"], parse_bader=True, bader_workers=2)
+        doc = drone.assimilate(self.relax2)
+        self.assertIn("bader", doc["calcs_reversed"][0])
+        self.assertIn("bader", doc["calcs_reversed"][1])
+
     def test_parse_locpot(self):
         drone = VaspDrone(parse_locpot=True)
         doc = drone.assimilate(self.Si_static)
@@ -148,6 +277,13 @@ class VaspToDbTaskDroneTest(unittest.TestCase):
         self.assertAlmostEqual(np.sum(doc['calcs_reversed'][0]['output']['locpot'][1]),0)
         self.assertAlmostEqual(np.sum(doc['calcs_reversed'][0]['output']['locpot'][2]),0)
 
+    def test_read_locpot_axis_averages(self):
+        locpot_file = os.path.join(self.Si_static, "LOCPOT.gz")
+        averages = read_locpot_axis_averages(locpot_file)
+        locpot = Locpot.from_file(locpot_file)
+        for i in range(3):
+            self.assertTrue(np.allclose(averages[i], locpot.get_average_along_axis(i)))
+
     def test_parse_chrgcar(self):
         drone = VaspDrone(parse_chgcar=True, parse_aeccar=True)
         doc = drone.assimilate(self.Si_static)
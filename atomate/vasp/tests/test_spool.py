@@ -0,0 +1,60 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from pymatgen.io.vasp import Chgcar
+
+from atomate.vasp.spool import write_spool, read_spool, find_spools
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.chgcar = Chgcar.from_file(os.path.join(module_dir, "..", "test_files", "Si_static",
+                                                    "outputs", "CHGCAR.gz"))
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch_dir)
+
+    def test_round_trip(self):
+        spool_dir = os.path.join(self.scratch_dir, "calc", "task_spool")
+        last_updated = datetime(2018, 10, 1, 12, 30, 15, 123000)
+        doc = {"dir_name": "host:/calc", "last_updated": last_updated,
+               "nsites": np.int64(2),
+               "calcs_reversed": [{"output": {"energy": -10.0,
+                                              "locpot": {0: np.array([1.5, 2.5])}},
+                                   "dos": {"efermi": 5.0, "energies": [1.0, 2.0]},
+                                   "chgcar": self.chgcar}]}
+        write_spool([doc], spool_dir)
+        # the payloads are moved to side-car files
+        self.assertNotIn("chgcar", doc["calcs_reversed"][0])
+        write_spool([{"elastic_tensor": [[1.0]]}], spool_dir, collection="elasticity")
+
+        records = list(read_spool(spool_dir))
+        self.assertEqual([c for c, d, oid in records], ["tasks", "elasticity"])
+        # numpy objects and datetimes are kept, ready for the database
+        self.assertEqual(records[0][1]["last_updated"], last_updated)
+        self.assertEqual(records[0][1]["nsites"], 2)
+        calc = records[0][1]["calcs_reversed"][0]
+        self.assertEqual(calc["output"]["energy"], -10.0)
+        self.assertEqual(calc["output"]["locpot"], {"0": [1.5, 2.5]})
+        self.assertEqual(calc["dos"], {"efermi": 5.0, "energies": [1.0, 2.0]})
+        self.assertTrue(np.array_equal(calc["chgcar"].data["total"], self.chgcar.data["total"]))
+        self.assertEqual(records[1][1], {"elastic_tensor": [[1.0]]})
+
+        self.assertEqual(find_spools([self.scratch_dir]), [spool_dir])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import io
+import os
+import unittest
+
+import numpy as np
+
+from pymatgen.io.vasp import Chgcar
+
+from atomate.vasp.volumetric import volumetric_to_bytes, volumetric_from_file
+
+module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+
+
+class VolumetricTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.chgcar = Chgcar.from_file(os.path.join(module_dir, "..", "test_files", "Si_static",
+                                                   "outputs", "CHGCAR.gz"))
+
+    def test_round_trip(self):
+        data, header = volumetric_to_bytes(self.chgcar)
+        chgcar = volumetric_from_file(io.BytesIO(data), header)
+        self.assertEqual(chgcar.structure, self.chgcar.structure)
+        self.assertEqual(set(chgcar.data_aug.keys()), set(self.chgcar.data_aug.keys()))
+        for k in ["total", "diff"]:
+            self.assertTrue(np.array_equal(chgcar.data[k], self.chgcar.data[k]))
+
+        data, header = volumetric_to_bytes(self.chgcar, dtype="float32")
+        chgcar = volumetric_from_file(io.BytesIO(data), header)
+        self.assertTrue(np.allclose(chgcar.data["total"], self.chgcar.data["total"]))
+
+    def test_quantize(self):
+        data, header = volumetric_to_bytes(self.chgcar, quantize=16)
+        total = volumetric_from_file(io.BytesIO(data), header, components=["total"])["total"]
+        ref = self.chgcar.data["total"]
+        self.assertLessEqual(abs(total - ref).max(), (ref.max() - ref.min()) / (2 ** 16 - 1))
+        self.assertRaises(ValueError, volumetric_to_bytes, self.chgcar, quantize=12)
+
+    def test_subgrid(self):
+        # small slabs, so that the sub-grid spans several of them
+        data, header = volumetric_to_bytes(self.chgcar, slab_bytes=60 * 60 * 8 * 7)
+        self.assertEqual(len(header["components"]["total"]["blocks"]), 9)
+        d = volumetric_from_file(io.BytesIO(data), header, components=["diff"],
+                                 subgrid=[(10, 30), (0, 5), (3, 4)])
+        self.assertEqual(list(d.keys()), ["diff"])
+        self.assertTrue(np.array_equal(d["diff"], self.chgcar.data["diff"][10:30, 0:5, 3:4]))
+        self.assertRaises(ValueError, volumetric_from_file, io.BytesIO(data), header,
+                          subgrid=[(0, 61), (0, 60), (0, 60)])
+
+
+if __name__ == '__main__':
+    unittest.main()
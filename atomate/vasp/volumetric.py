@@ -0,0 +1,150 @@
+# coding: utf-8
+
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+"""
+This module defines a binary storage format for VASP volumetric data (CHGCAR, AECCAR0, ...).
+
+The grid of each component ("total", "diff", ...) is stored as raw little-endian float32/float64
+(or quantized unsigned integer) values, cut into slabs along the first axis. Each slab is
+compressed separately (zlib by default, see atomate.utils.compression), so that a sub-grid or a single component can be read by seeking
+to the slabs it covers instead of decoding the whole file. The header (structure, grid
+dimensions, dtype, slab offsets and quantization parameters) is returned as a dict meant to be
+stored as the GridFS file metadata, the augmentation charges are stored as a trailing
+compressed JSON block.
+"""
+
+import json
+
+import numpy as np
+
+from monty.json import MontyEncoder, MontyDecoder
+from pymatgen.io.vasp import Poscar, Chgcar
+
+from atomate.utils.compression import compress, decompress
+
+VOLUMETRIC_FORMAT = "volumetric"
+VOLUMETRIC_FORMAT_VERSION = 1
+
+# uncompressed size of a slab, in bytes
+SLAB_BYTES = 1 << 20
+
+
+def volumetric_to_bytes(vdata, dtype="float64", quantize=None, slab_bytes=SLAB_BYTES,
+                        codec="zlib"):
+    """
+    Encode volumetric data into the binary format.
+
+    Args:
+        vdata (VolumetricData): e.g. a Chgcar object
+        dtype (str): "float64" or "float32"
+        quantize (int): if set (8 or 16), store each component as unsigned integers with this
+            many bits, scaled linearly between the minimum and the maximum of the component. This
+            is lossy: the error is at most half of (max - min) / (2**quantize - 1).
+        slab_bytes (int): approximate uncompressed size of a slab in bytes
+        codec (str): compression codec of the slabs, e.g. "zlib-9" (see
+            atomate.utils.compression)
+
+    Returns:
+        (bytes, dict): the encoded data and the header
+    """
+    dim = [int(i) for i in vdata.dim]
+    if quantize:
+        if quantize not in (8, 16):
+            raise ValueError("quantize must be 8 or 16 bits, got {}".format(quantize))
+        store_dtype = np.dtype("<u{}".format(quantize // 8))
+    else:
+        store_dtype = np.dtype(dtype).newbyteorder("<")
+    slab_size = max(1, slab_bytes // (dim[1] * dim[2] * store_dtype.itemsize))
+
+    parts = []
+    offset = 0
+    components = {}
+    for comp in ("total", "diff", "diff_x", "diff_y", "diff_z"):
+        if comp not in vdata.data:
+            continue
+        arr = np.asarray(vdata.data[comp], dtype=float)
+        quantization = None
+        if quantize:
+            lo, hi = float(arr.min()), float(arr.max())
+            scale = (hi - lo) / (2 ** quantize - 1) or 1.0
+            arr = np.round((arr - lo) / scale)
+            quantization = [lo, scale]
+        arr = arr.astype(store_dtype)
+        blocks = []
+        for x0 in range(0, dim[0], slab_size):
+            raw = compress(np.ascontiguousarray(arr[x0:x0 + slab_size]).tobytes(), codec)
+            blocks.append([offset, len(raw)])
+            parts.append(raw)
+            offset += len(raw)
+        components[comp] = {"blocks": blocks, "quantization": quantization}
+
+    data_aug = None
+    if getattr(vdata, "data_aug", None):
+        raw = compress(json.dumps(vdata.data_aug, cls=MontyEncoder).encode(), codec)
+        data_aug = [offset, len(raw)]
+        parts.append(raw)
+
+    poscar = vdata.poscar if hasattr(vdata, "poscar") else Poscar(vdata.structure)
+    header = {"format": VOLUMETRIC_FORMAT,
+              "version": VOLUMETRIC_FORMAT_VERSION,
+              "dim": dim,
+              "dtype": store_dtype.str,
+              "codec": codec,
+              "slab_size": slab_size,
+              "components": components,
+              "data_aug": data_aug,
+              "poscar": poscar.as_dict()}
+    return b"".join(parts), header
+
+
+def volumetric_from_file(f, header, components=None, subgrid=None):
+    """
+    Decode volumetric data stored in the binary format. Only the slabs that are needed are read.
+
+    Args:
+        f: seekable file-like object, e.g. a GridOut
+        header (dict): the header returned by volumetric_to_bytes
+        components (list): components to read, e.g. ["total"]. Default: all
+        subgrid (list): [(x0, x1), (y0, y1), (z0, z1)] half-open index ranges of the grid points
+            to read. Default: the full grid
+
+    Returns:
+        Chgcar object if neither components nor subgrid is given, otherwise a dict
+            {component: numpy array}
+    """
+    dim = header["dim"]
+    slab_size = header["slab_size"]
+    dtype = np.dtype(str(header["dtype"]))
+    codec = header.get("codec", "zlib")
+    (x0, x1), (y0, y1), (z0, z1) = subgrid or [(0, n) for n in dim]
+    if not (0 <= x0 < x1 <= dim[0] and 0 <= y0 < y1 <= dim[1] and 0 <= z0 < z1 <= dim[2]):
+        raise ValueError("Invalid subgrid {} for grid {}".format(subgrid, dim))
+    first, last = x0 // slab_size, (x1 - 1) // slab_size
+
+    data = {}
+    for comp in components or list(header["components"].keys()):
+        if comp not in header["components"]:
+            raise KeyError("No component {} in the volumetric data".format(comp))
+        comp_header = header["components"][comp]
+        slabs = []
+        for start, length in comp_header["blocks"][first:last + 1]:
+            f.seek(start)
+            raw = decompress(f.read(length), codec)
+            slabs.append(np.frombuffer(raw, dtype=dtype).reshape(-1, dim[1], dim[2]))
+        arr = np.concatenate(slabs)
+        arr = arr[x0 - first * slab_size:x1 - first * slab_size, y0:y1, z0:z1]
+        if comp_header["quantization"]:
+            lo, scale = comp_header["quantization"]
+            arr = arr * scale + lo
+        data[comp] = arr.astype(float)
+
+    if components or subgrid:
+        return data
+
+    data_aug = None
+    if header["data_aug"]:
+        start, length = header["data_aug"]
+        f.seek(start)
+        data_aug = json.loads(decompress(f.read(length), codec).decode(), cls=MontyDecoder)
+    return Chgcar(Poscar.from_dict(header["poscar"]), data, data_aug=data_aug)
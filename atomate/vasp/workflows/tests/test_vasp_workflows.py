@@ -4,10 +4,14 @@ from __future__ import division, print_function, unicode_literals, absolute_impo
 
 import json
 import os
+import shutil
+import tempfile
 import unittest
 import zlib
+from datetime import datetime
 
 import gridfs
+import numpy as np
 from pymongo import DESCENDING
 
 from fireworks import FWorker
@@ -19,8 +23,10 @@ from atomate.vasp.workflows.base.core import get_wf
 from atomate.utils.testing import AtomateTest
 from atomate.vasp.firetasks.parse_outputs import VaspDrone
 from atomate.vasp.database import VaspCalcDb
+from atomate.vasp.spool import write_spool, ingest_spools
 
 
+from pymatgen.core.structure import Structure
 from pymatgen.io.vasp.sets import MPRelaxSet, MPStaticSet
 from pymatgen.util.testing import PymatgenTest
 
@@ -298,6 +304,171 @@ class TestVaspWorkflows(AtomateTest):
         dcc = mmdb.get_aeccar(task_id=t_id)
         self.assertAlmostEqual(dcc['aeccar0'].data['total'].sum()/cc.ngridpts, 23.253588293583313, 4)
         self.assertAlmostEqual(dcc['aeccar2'].data['total'].sum()/cc.ngridpts, 8.01314480789829, 4)
+        # partial reads of the binary volumetric format
+        total = mmdb.get_chgcar(task_id=t_id, components=["total"],
+                                subgrid=[(0, 10), (0, 60), (0, 60)])["total"]
+        self.assertEqual(total.shape, (10, 60, 60))
+        self.assertAlmostEqual(abs(total - cc.data["total"][:10]).max(), 0)
+
+    def test_audit_indexes(self):
+        mmdb = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        mmdb.build_indexes()
+        self.assertFalse([r["name"] for r in mmdb.audit_indexes() if r["collscan"]])
+        mmdb.collection.drop_indexes()
+        reports = mmdb.audit_indexes([("by task_label", "{tasks}", {"task_label": "static"})])
+        self.assertTrue(reports[0]["collscan"])
+
+    def _insert_si_tasks(self, use_gridfs=True):
+        # the Si structure optimization and static tasks, inserted in one bulk write
+        docs = [VaspDrone().assimilate(os.path.join(ref_dirs_si[k], "outputs"))
+                for k in ["structure optimization", "static"]]
+        mmdb = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        return mmdb, mmdb.insert_tasks(docs, use_gridfs=use_gridfs), docs
+
+    def test_insert_tasks(self):
+        mmdb, t_ids, docs = self._insert_si_tasks()
+        self.assertEqual(len(set(t_ids)), 2)
+        self.assertEqual([d["task_id"] for d in docs], t_ids)
+        self.assertEqual(mmdb.collection.count(), 2)
+        d = mmdb.collection.find_one({"task_id": t_ids[1]})
+        self.assertIn("dos_fs_id", d["calcs_reversed"][0])
+        self.assertEqual(d["calcs_reversed"][0]["dos_compression"], "zlib")
+
+        # duplicates are updated with the same task_ids, or skipped
+        docs = [VaspDrone().assimilate(os.path.join(ref_dirs_si[k], "outputs"))
+                for k in ["structure optimization", "static"]]
+        self.assertEqual(mmdb.insert_tasks(docs[:1]), t_ids[:1])
+        self.assertEqual(mmdb.insert_tasks(docs[1:], update_duplicates=False), [None])
+        self.assertEqual(mmdb.collection.count(), 2)
+
+    def test_retrieve_tasks(self):
+        mmdb, t_ids, _ = self._insert_si_tasks()
+        # batched retrieval, in the order of the task_ids
+        docs = list(mmdb.retrieve_tasks(t_ids[::-1] + [-1], include=["dos"], workers=2))
+        self.assertEqual([d["task_id"] for d in docs], t_ids[::-1])
+        self.assertEqual(docs[0]["calcs_reversed"][0]["dos"]["efermi"],
+                         mmdb.get_dos(t_ids[1]).efermi)
+
+    def test_object_cache(self):
+        mmdb, t_ids, _ = self._insert_si_tasks()
+        # decoded objects come from the cache when it is enabled
+        cached_db = VaspCalcDb(mmdb.host, mmdb.port, mmdb.db_name, mmdb.collection.name,
+                               mmdb.user, mmdb.password, cache_size=1 << 30)
+        dos = cached_db.get_dos(t_ids[1])
+        self.assertIs(cached_db.get_dos(t_ids[1]), dos)
+        info = cached_db.cache_info()
+        self.assertEqual((info["hits"], info["misses"], info["entries"]), (1, 1, 1))
+        self.assertIsNot(mmdb.get_dos(t_ids[1]), mmdb.get_dos(t_ids[1]))
+
+    def test_task_summaries(self):
+        mmdb, t_ids, _ = self._insert_si_tasks()
+        d = mmdb.collection.find_one({"task_id": t_ids[1]})
+        summary = mmdb.find_task_summaries({"task_id": t_ids[1]})[0]
+        self.assertEqual(summary["output"]["energy"], d["output"]["energy"])
+        self.assertAlmostEqual(summary["output"]["volume"],
+                               Structure.from_dict(d["output"]["structure"]).volume)
+        self.assertEqual(summary["dos_fs_id"], d["calcs_reversed"][0]["dos_fs_id"])
+        self.assertNotIn("calcs_reversed", summary)
+        self.assertNotIn("polarization", summary)
+
+        # summaries of tasks updated in place are rebuilt
+        mmdb.collection.update_one({"task_id": t_ids[1]}, {"$set": {
+            "tags": ["updated"], "last_updated": datetime(2030, 1, 1)}})
+        self.assertEqual([d["task_id"] for d in mmdb.find_task_summaries({"tags": "updated"})],
+                         t_ids[1:])
+        mmdb.collection.update_one({"task_id": t_ids[1]}, {"$set": {
+            "tags": [], "last_updated": datetime(2030, 1, 2)}})
+        self.assertEqual(mmdb.find_task_summaries({"tags": "updated"}).count(), 0)
+
+    def test_polarization_summary(self):
+        doc = VaspDrone().assimilate(os.path.join(ref_dirs_si["static"], "outputs"))
+        # LCALCPOL outcars hold the polarizations as numpy arrays
+        doc["calcs_reversed"][0]["output"]["outcar"].update({
+            "p_elec": np.array([0.1, 0.2, 0.3]), "p_ion": np.array([1.0, 2.0, 3.0]),
+            "zval_dict": {"Si": 4.0}})
+        mmdb = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        t_id = mmdb.insert_task(doc)
+        summary = mmdb.find_task_summaries({"task_id": t_id})[0]
+        self.assertEqual(summary["polarization"]["p_elec"], [0.1, 0.2, 0.3])
+        self.assertEqual(summary["polarization"]["p_ion"], [1.0, 2.0, 3.0])
+        self.assertEqual(summary["polarization"]["zval_dict"], {"Si": 4.0})
+        self.assertEqual(summary["polarization"]["input_structure"],
+                         mmdb.collection.find_one({"task_id": t_id})
+                         ["calcs_reversed"][0]["input"]["structure"])
+
+        # polarization-labelled tasks without polarization data are left out by PolarizationToDb
+        doc = VaspDrone().assimilate(os.path.join(ref_dirs_si["static"], "outputs"))
+        doc["task_label"] = "nonpolar_polarization"
+        doc["dir_name"] = "no_polarization"
+        mmdb.insert_task(doc)
+        summaries = mmdb.find_task_summaries({"task_label": {"$regex": ".*polarization"},
+                                              "polarization": {"$exists": True}})
+        self.assertEqual([d["task_id"] for d in summaries], [t_id])
+
+    def test_gridfs_dedup_and_gc(self):
+        mmdb, t_ids, _ = self._insert_si_tasks()
+        d = mmdb.collection.find_one({"task_id": t_ids[1]})
+
+        # identical GridFS payloads are stored once, replaced ones are released
+        dos_fs_id = d["calcs_reversed"][0]["dos_fs_id"]
+        n_files = mmdb.db.dos_fs.files.count()
+        doc = VaspDrone().assimilate(os.path.join(ref_dirs_si["static"], "outputs"))
+        self.assertEqual(mmdb.insert_tasks([doc], use_gridfs=True), t_ids[1:])
+        d = mmdb.collection.find_one({"task_id": t_ids[1]})
+        self.assertEqual(d["calcs_reversed"][0]["dos_fs_id"], dos_fs_id)
+        self.assertEqual(mmdb.db.dos_fs.files.count(), n_files)
+        self.assertEqual(mmdb.db.dos_fs.files.find_one(dos_fs_id)["metadata"]["refcount"], 1)
+
+        # an old unreferenced file that was just re-used is kept
+        orphan_id, _ = mmdb.insert_gridfs("{}", "dos_fs")
+        mmdb.db.dos_fs.files.update_one({"_id": orphan_id}, {"$set": {
+            "uploadDate": datetime(2000, 1, 1), "metadata.last_referenced": datetime(2000, 1, 1)}})
+        self.assertEqual(mmdb.collect_gridfs_garbage(dry_run=True)["dos_fs"], 1)
+        self.assertEqual(mmdb.insert_gridfs("{}", "dos_fs")[0], orphan_id)
+        self.assertEqual(mmdb.collect_gridfs_garbage()["dos_fs"], 0)
+
+        # unreferenced files are garbage collected
+        self.assertEqual(mmdb.collect_gridfs_garbage(grace_period=0, dry_run=True)["dos_fs"], 1)
+        mmdb.collect_gridfs_garbage(grace_period=0)
+        self.assertIsNone(mmdb.db.dos_fs.files.find_one(orphan_id))
+        self.assertIsNotNone(mmdb.db.dos_fs.files.find_one(dos_fs_id))
+        self.assertEqual(mmdb.db.dos_fs.chunks.find({"files_id": orphan_id}).count(), 0)
+
+    def test_summary_first_calc(self):
+        # the equation of state, gibbs and thermal expansion analyses read the first calculation
+        doc = VaspDrone(runs=["relax1", "relax2"]).assimilate(
+            os.path.join(reference_dir, "Si_structure_optimization_relax2", "outputs"))
+        mmdb = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+        t_id = mmdb.insert_task(doc)
+        summary = mmdb.find_task_summaries({"task_id": t_id})[0]
+        first, last = doc["calcs_reversed"][-1]["output"], doc["calcs_reversed"][0]["output"]
+        self.assertNotEqual(first["energy"], last["energy"])
+        self.assertEqual(summary["first_calc_output"]["energy"], first["energy"])
+        self.assertAlmostEqual(summary["first_calc_output"]["volume"],
+                               Structure.from_dict(first["structure"]).volume)
+        self.assertEqual(summary["output"]["energy"], doc["output"]["energy"])
+
+    def test_ingest_spool(self):
+        doc = VaspDrone().assimilate(os.path.join(ref_dirs_si["static"], "outputs"))
+        spool_dir = os.path.join(tempfile.mkdtemp(), "task_spool")
+        try:
+            write_spool([doc], spool_dir)
+            write_spool([{"elastic_tensor": [[1.0]]}], spool_dir, collection="elasticity")
+            mmdb = VaspCalcDb.from_db_file(os.path.join(db_dir, "db.json"))
+            report = ingest_spools(mmdb, [spool_dir])
+            self.assertEqual(report["failed"], {})
+            d = mmdb.collection.find_one()
+            self.assertIsInstance(d["last_updated"], datetime)
+            self.assertIn("dos_fs_id", d["calcs_reversed"][0])
+
+            # ingesting again updates the documents instead of duplicating them
+            report = ingest_spools(mmdb, [spool_dir])
+            self.assertEqual(report["failed"], {})
+            self.assertEqual(mmdb.collection.count(), 1)
+            self.assertEqual(mmdb.db.elasticity.count(), 1)
+            mmdb.db.elasticity.drop()
+        finally:
+            shutil.rmtree(os.path.dirname(spool_dir))
 
     def test_chgcar_db_read(self):
         # add the workflow